@@ -1,6 +1,7 @@
 from .voc0712 import VOCDetection, VOCAnnotationTransform, VOC_CLASSES
 from .vocxlab import XLDetection, XLAnnotationTransform, XL_CLASSES
 from .weishi import WeishiDetection, WeishiAnnotationTransform, WEISHI_CLASSES
+from .shards import ShardDetection, pack_shards
 # from .coco import COCODetection, COCOAnnotationTransform, COCO_CLASSES, get_label_map
 from .config import *
 import torch
@@ -33,6 +34,45 @@ def detection_collate(batch):
     return torch.stack(imgs, 0), targets
 
 
+def padded_collate(batch):
+    """detection_collate with the annotations padded into one tensor, which is what
+    MultiBoxLoss matches anyway: 3 tensors to pin and copy to the gpu per batch instead of
+    one per image.
+
+    In the main process (num_workers=0) the batch is directly allocated in pinned memory;
+    in the DataLoader workers it is moved to shared memory before it is filled, so the worker
+    queue sends it without another copy (like default_collate), and the pin_memory thread of
+    the DataLoader pins it (pinned memory can't be shared between processes).
+
+    Arguments:
+        batch: (tuple) A tuple of tensor images and lists of annotations
+
+    Return:
+        A tuple containing:
+            1) (tensor) batch of images stacked on their 0 dim
+            2) (tensor) annotations of each image, zero padded, Shape: [batch,max(1,max_objs),5]
+            3) (tensor) number of annotations of each image, Shape: [batch]
+    """
+    in_worker = torch.utils.data.get_worker_info() is not None
+    pin = torch.cuda.is_available() and not in_worker
+    num_objs = [len(sample[1]) for sample in batch]
+    # explicit cpu: don't follow a cuda default tensor type
+    imgs = torch.empty((len(batch),) + tuple(batch[0][0].shape), dtype=batch[0][0].dtype,
+                       device='cpu', pin_memory=pin)
+    targets = torch.zeros(len(batch), max([1] + num_objs), 5, device='cpu', pin_memory=pin)
+    if in_worker:
+        imgs.share_memory_()
+        targets.share_memory_()
+    for i, sample in enumerate(batch):
+        imgs[i] = sample[0]
+        if num_objs[i]:
+            targets[i, :num_objs[i]] = torch.from_numpy(np.asarray(sample[1], dtype=np.float32))
+    num_objs = torch.tensor(num_objs, dtype=torch.long, device='cpu')
+    if pin:
+        num_objs = num_objs.pin_memory()
+    return imgs, targets, num_objs
+
+
 def base_transform(image, size, mean):
     x = cv2.resize(image, (size, size),
                     interpolation=cv2.INTER_LINEAR).astype(np.float32)
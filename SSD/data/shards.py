@@ -0,0 +1,252 @@
+"""Packed image shards
+
+A dataset packed by pack_shards() is a directory with:
+    shard_00000.bin, ...   the original JPEG files, back to back
+    meta.json              name, classes, use_07_metric and shard files of the dataset
+    <column>.npy           the index, one image per row in the order of the original dataset:
+                               ids (str), shard (int32), start (int64), length (int64), and the
+                               annotations of load_annots(): boxes, labels, difficult, offsets,
+                               sizes (height, width of the decoded image), names
+One file per few thousand images instead of one open() per image and per annotation, which is
+what limits the dataloading on a network filesystem. ShardDetection memory-maps the shards and
+decodes the images straight from the mapped buffer.
+"""
+import json
+import os
+import os.path as osp
+import torch
+import torch.utils.data as data
+import cv2
+cv2.setNumThreads(0) # pytorch issue 1355: possible deadlock in DataLoader
+# OpenCL may be enabled by default in OpenCV3;
+# disable it because it because it's not thread safe and causes unwanted GPU memory allocations
+cv2.ocl.setUseOpenCL(False)
+import numpy as np
+from .voc0712 import VOCAnnotationTransform
+from .voc_eval import voc_eval_all, summarize_aps
+
+SHARD_COLUMNS = ['ids', 'shard', 'start', 'length',
+                 'boxes', 'labels', 'difficult', 'offsets', 'sizes', 'names']
+
+
+def pack_shards(dataset, out_dir, classes, use_07_metric=True, shard_size=1 << 30, drop_empty=False):
+    """Pack the images and the pre-parsed annotations of a VOCDetection/XLDetection into shards
+    Args:
+        dataset: VOCDetection or XLDetection, its transforms are not used
+        out_dir: directory of the packed dataset
+        classes: class names of the dataset, background first (e.g. VOC_CLASSES)
+        use_07_metric: VOC07 11 point AP when evaluating the packed dataset
+        shard_size: bytes per shard file, a shard is closed once it is larger
+        drop_empty: also drop the images without any non-difficult object (XLDetection skips them)
+    Return:
+        number of packed images, images which can't be decoded are always dropped
+    """
+    if not osp.isdir(out_dir):
+        os.makedirs(out_dir)
+    names = sorted(set(name for annots in dataset.annots for name in annots['names']))
+    name_to_ind = dict(zip(names, range(len(names))))
+    index = {k: [] for k in SHARD_COLUMNS if k not in ('offsets', 'names')}
+    offsets = [0]
+    shards = []
+    f = None
+    for i, img_id in enumerate(dataset.ids):
+        k, j = dataset._annots_ind[i]
+        annots = dataset.annots[k]
+        start, end = annots['offsets'][j], annots['offsets'][j + 1]
+        difficult = np.asarray(annots['difficult'][start:end], dtype=bool)
+        if drop_empty and difficult.all():
+            continue
+        with open(dataset._imgpath % img_id, 'rb') as img_file:
+            buf = img_file.read()
+        img = cv2.imdecode(np.frombuffer(buf, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            print('Dropping {:s}, the image can\'t be decoded'.format(img_id[1]))
+            continue
+
+        if f is None or f.tell() >= shard_size: # next shard
+            if f is not None:
+                f.close()
+            shards.append('shard_{:05d}.bin'.format(len(shards)))
+            f = open(osp.join(out_dir, shards[-1]), 'wb')
+        index['ids'].append(img_id[1])
+        index['shard'].append(len(shards) - 1)
+        index['start'].append(f.tell())
+        index['length'].append(len(buf))
+        f.write(buf)
+
+        index['boxes'].append(np.asarray(annots['boxes'][start:end]))
+        index['labels'] += [name_to_ind[name] for name in annots['names'][annots['labels'][start:end]]]
+        index['difficult'].append(difficult)
+        index['sizes'].append(img.shape[:2])
+        offsets.append(offsets[-1] + end - start)
+
+        if len(offsets) % 1000 == 0:
+            print('Packed {:d}/{:d} images'.format(len(offsets) - 1, len(dataset.ids)))
+    if f is not None:
+        f.close()
+
+    columns = {'ids': np.array(index['ids'], dtype=str),
+               'shard': np.array(index['shard'], dtype=np.int32),
+               'start': np.array(index['start'], dtype=np.int64),
+               'length': np.array(index['length'], dtype=np.int64),
+               'boxes': np.concatenate(index['boxes'] or [np.zeros((0, 4))]).astype(np.int32).reshape(-1, 4),
+               'labels': np.array(index['labels'], dtype=np.int32),
+               'difficult': np.concatenate(index['difficult'] or [np.zeros(0)]).astype(bool),
+               'offsets': np.array(offsets, dtype=np.int64),
+               'sizes': np.array(index['sizes'], dtype=np.int32).reshape(-1, 2),
+               'names': np.array(names, dtype=str)}
+    for k in SHARD_COLUMNS:
+        np.save(osp.join(out_dir, k + '.npy'), columns[k])
+    # meta.json last: a packed dataset without it is incomplete
+    with open(osp.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump({'name': dataset.name, 'classes': list(classes),
+                   'use_07_metric': bool(use_07_metric), 'shards': shards}, f, indent=2)
+    print('Packed {:d} images into {:d} shards in {:s}'.format(len(offsets) - 1, len(shards), out_dir))
+    return len(offsets) - 1
+
+
+#inheritance of data.Dataset
+#For a dataset object, you should have functions to get an item/image for use (from a directory in "root")
+class ShardDetection(data.Dataset):
+    """Detection Dataset Object of a dataset packed by pack_shards()
+
+    input is image, target is annotation, same items as VOCDetection
+
+    Arguments:
+        root (string): directory of the packed dataset
+        transform (callable, optional): transformation to perform on the
+            input image (eg: SSDAugmentation, BaseTransform)
+        target_transform (callable, optional): transformation to perform on the
+            pre-parsed annotations, it must have from_annots()
+            (default: VOCAnnotationTransform with the classes of the packed dataset)
+        dataset_name (string, optional): name of the packed dataset by default
+    """
+
+    def __init__(self, root, transform=None, target_transform=None, dataset_name=None):
+        self.root = root
+        with open(osp.join(root, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.classes = tuple(self.meta['classes'])
+        self.transform = transform
+        self.target_transform = target_transform or VOCAnnotationTransform(
+            dict(zip(self.classes, range(len(self.classes)))))
+        self.name = dataset_name or self.meta['name']
+        self.annots = {k: np.load(osp.join(root, k + '.npy'), mmap_mode='r') for k in SHARD_COLUMNS}
+        self.ids = [(root, img_id) for img_id in self.annots['ids']]
+        self._shards = None # memory-mapped on first use, in each DataLoader worker
+
+    def __getstate__(self):
+        # don't pickle the mapped shards to the DataLoader workers
+        state = self.__dict__.copy()
+        state['_shards'] = None
+        return state
+
+    def __getitem__(self, index):
+        im, gt, h, w = self.pull_item(index)
+
+        return im, gt
+
+    def __len__(self):
+        return len(self.ids)
+
+    def pull_item(self, index):
+        img = self.pull_image(index)
+        height, width, channels = img.shape
+        target = self.pull_target(index, width, height)
+
+        if self.transform is not None:
+            target = np.array(target)
+            img, boxes, labels = self.transform(img, target[:, :4], target[:, 4])
+            # to rgb
+            img = img[:, :, (2, 1, 0)]
+            # height, width, channels = img.shape #DONT update height and width after transform
+            target = np.hstack((boxes, np.expand_dims(labels, axis=1)))
+        return torch.from_numpy(img).permute(2, 0, 1), target, height, width
+
+    def pull_target(self, index, width, height):
+        '''Returns the annotation of image at index through target_transform'''
+        annots = self.annots
+        start, end = annots['offsets'][index], annots['offsets'][index + 1]
+        return self.target_transform.from_annots(annots['boxes'][start:end],
+                                                 annots['names'][annots['labels'][start:end]],
+                                                 annots['difficult'][start:end], width, height)
+
+    def pull_image(self, index):
+        '''Returns the original image object at index, decoded from the mapped shard
+
+        Argument:
+            index (int): index of img to show
+        Return:
+            BGR img like cv2.imread
+        '''
+        if self._shards is None:
+            self._shards = [np.memmap(osp.join(self.root, shard), dtype=np.uint8, mode='r')
+                            for shard in self.meta['shards']]
+        start = int(self.annots['start'][index])
+        buf = self._shards[self.annots['shard'][index]][start:start + int(self.annots['length'][index])]
+        return cv2.imdecode(buf, cv2.IMREAD_COLOR)
+
+    def pull_anno(self, index):
+        '''Returns the original annotation of image at index
+
+        Argument:
+            index (int): index of img to get annotation of
+        Return:
+            list:  [img_id, [(label, bbox coords),...]]
+                eg: ('001718', [('dog', (96, 13, 438, 332))])
+        '''
+        gt = self.pull_target(index, 1, 1)
+        return self.ids[index][1], [box[:4] + [int(box[4])] for box in gt.tolist()]
+
+    def pull_tensor(self, index):
+        '''Returns the original image at an index in tensor form
+
+        Argument:
+            index (int): index of img to show
+        Return:
+            tensorized version of img, squeezed
+        '''
+        return torch.Tensor(self.pull_image(index)).unsqueeze_(0)
+
+    def evaluate_detections(self, all_boxes, output_dir=None, in_memory=True, write_results=False,
+                            num_workers=0):
+        """
+        all_boxes[class][image] = [] or np.array of shape #dets x 5, see VOCDetection
+
+        in_memory: must be True, the packed dataset has no annotation files to evaluate results
+            files against, the APs are always computed from the packed annotations
+        write_results: also write the comp4_det_test_<cls>.txt results files to <root>/results
+        num_workers: size of the process pool evaluating the classes in parallel
+        """
+        if not in_memory:
+            raise ValueError('a packed dataset is only evaluated in memory, in_memory must be True')
+        if write_results:
+            self._write_voc_results_file(all_boxes)
+        if output_dir is not None and not os.path.isdir(output_dir):
+            os.mkdir(output_dir)
+        use_07_metric = self.meta['use_07_metric']
+        print('VOC07 metric? ' + ('Yes' if use_07_metric else 'No'))
+        results = voc_eval_all(all_boxes, self.annots, self.classes, ovthresh=0.5,
+                               use_07_metric=use_07_metric, num_workers=num_workers)
+        return summarize_aps(self.classes, results, output_dir)
+
+    def _write_voc_results_file(self, all_boxes):
+        # same files as VOCDetection: <root>/results/comp4_det_test_<cls>.txt
+        filedir = osp.join(self.root, 'results')
+        if not osp.exists(filedir):
+            os.makedirs(filedir)
+        for cls_ind, cls in enumerate(self.classes):
+            if cls_ind == 0: # background
+                continue
+            print('Writing {} VOC results file'.format(cls))
+            with open(osp.join(filedir, 'comp4_det_test_{:s}.txt'.format(cls)), 'wt') as f:
+                for im_ind, index in enumerate(self.ids):
+                    dets = all_boxes[cls_ind][im_ind]
+                    if len(dets) == 0:
+                        continue
+                    for k in range(dets.shape[0]):
+                        # for a class in an image: {image_id} {score} {xcor} {xcor} {ycor} {ycor}
+                        f.write('{:s} {:.3f} {:.1f} {:.1f} {:.1f} {:.1f}\n'.
+                                format(index[1], dets[k, -1],
+                                       dets[k, 0] + 1, dets[k, 1] + 1,
+                                       dets[k, 2] + 1, dets[k, 3] + 1))
@@ -18,7 +18,7 @@ cv2.setNumThreads(0) # pytorch issue 1355: possible deadlock in DataLoader
 # disable it because it because it's not thread safe and causes unwanted GPU memory allocations
 cv2.ocl.setUseOpenCL(False)
 import numpy as np
-from .voc_eval import voc_eval
+from .voc_eval import voc_eval, load_annots, voc_eval_all, summarize_aps
 
 if sys.version_info[0] == 2:
     import xml.etree.cElementTree as ET
@@ -84,6 +84,24 @@ class VOCAnnotationTransform(object):
 
         return res  # [[xmin, ymin, xmax, ymax, label_ind], ... ]
 
+    def from_annots(self, boxes, names, difficult, width, height):
+        """
+        Same as __call__() but from the pre-parsed annotations of an image, see load_annots()
+        Arguments:
+            boxes (ndarray): xml bbox coords - 1, Shape: [num_objs, 4]
+            names (ndarray): class name of each object
+            difficult (ndarray): difficult flag of each object
+        Returns:
+            (ndarray) [[xmin, ymin, xmax, ymax, label_ind], ... ], Shape: [num_kept_objs, 5]
+        """
+        keep = slice(None) if self.keep_difficult else ~np.asarray(difficult, dtype=bool)
+        boxes, names = boxes[keep], names[keep]
+        res = np.empty((len(names), 5))
+        # same float64 divisions as __call__()
+        res[:, :4] = boxes / np.array([width, height, width, height], dtype=np.float64)
+        res[:, 4] = [self.class_to_ind[name] for name in names]
+        return res
+
 #inheritance of data.Dataset
 #For a dataset object, you should have functions to get an item/image for use (from a directory in "root")
 class VOCDetection(data.Dataset):
@@ -115,11 +133,19 @@ class VOCDetection(data.Dataset):
         self._annopath = osp.join('%s', 'Annotations', '%s.xml') # wait for self.ids
         self._imgpath = osp.join('%s', 'JPEGImages', '%s.jpg')
         self.ids = list() # store the names for each image
+        # annotations parsed once for all the images of each image set and cached on disk,
+        # see load_annots(), so that pull_item() doesn't parse the xml at every epoch
+        self.annots = list()
+        self._annots_ind = list() # (image set, index in the image set) for each image
         for (year, name) in image_sets:#2007/2012 ， trainval
             self._year = year
             rootpath = osp.join(self.root, 'VOC' + year)
-            for line in open(osp.join(rootpath, 'ImageSets', 'Main', name + '.txt')):
-                self.ids.append((rootpath, line.strip()))
+            imagesetfile = osp.join(rootpath, 'ImageSets', 'Main', name + '.txt')
+            imagenames = [line.strip() for line in open(imagesetfile)]
+            self.ids += [(rootpath, imagename) for imagename in imagenames]
+            self._annots_ind += [(len(self.annots), i) for i in range(len(imagenames))]
+            self.annots.append(load_annots(imagenames, osp.join(rootpath, 'Annotations', '%s.xml'),
+                                           imagesetfile, osp.join(self.root, 'annotations_cache')))
 
     def __getitem__(self, index):
         im, gt, h, w = self.pull_item(index)
@@ -132,12 +158,9 @@ class VOCDetection(data.Dataset):
     def pull_item(self, index):
         img_id = self.ids[index]
 
-        target = ET.parse(self._annopath % img_id).getroot()
         img = cv2.imread(self._imgpath % img_id)
         height, width, channels = img.shape
-
-        if self.target_transform is not None:
-            target = self.target_transform(target, width, height)
+        target = self.pull_target(index, width, height)
 
         if self.transform is not None:
             target = np.array(target)
@@ -148,6 +171,24 @@ class VOCDetection(data.Dataset):
             target = np.hstack((boxes, np.expand_dims(labels, axis=1)))
         return torch.from_numpy(img).permute(2, 0, 1), target, height, width
 
+    def pull_target(self, index, width, height):
+        '''Returns the annotation of image at index through target_transform
+
+        The pre-parsed annotations are used when target_transform supports them (from_annots()),
+        any other target_transform gets the xml tree like before.
+        '''
+        if not hasattr(self.target_transform, 'from_annots'):
+            target = ET.parse(self._annopath % self.ids[index]).getroot()
+            if self.target_transform is not None:
+                target = self.target_transform(target, width, height)
+            return target
+        k, i = self._annots_ind[index]
+        annots = self.annots[k]
+        start, end = annots['offsets'][i], annots['offsets'][i + 1]
+        return self.target_transform.from_annots(annots['boxes'][start:end],
+                                                 annots['names'][annots['labels'][start:end]],
+                                                 annots['difficult'][start:end], width, height)
+
     def pull_image(self, index):
         '''Returns the original image object at index in PIL form
 
@@ -175,9 +216,10 @@ class VOCDetection(data.Dataset):
                 eg: ('001718', [('dog', (96, 13, 438, 332))])
         '''
         img_id = self.ids[index]
-        anno = ET.parse(self._annopath % img_id).getroot()
         #target_transfrom will transform a target "anno" to [(label, bbox coords)
-        gt = self.target_transform(anno, 1, 1)
+        gt = self.pull_target(index, 1, 1)
+        if isinstance(gt, np.ndarray): # pre-parsed annotations, back to the lists of __call__()
+            gt = [box[:4] + [int(box[4])] for box in gt.tolist()]
         return img_id[1], gt
 
     def pull_tensor(self, index):
@@ -194,7 +236,8 @@ class VOCDetection(data.Dataset):
         #returns a new tensor with a dimension of size 1 inserted at the specified position
         return torch.Tensor(self.pull_image(index)).unsqueeze_(0)
 
-    def evaluate_detections(self, all_boxes, output_dir=None):
+    def evaluate_detections(self, all_boxes, output_dir=None, in_memory=True, write_results=False,
+                            num_workers=0):
         """
         all_boxes is a list of length number-of-classes.
         Each list element is a list of length number-of-images.
@@ -202,11 +245,19 @@ class VOCDetection(data.Dataset):
         or a numpy array of detection.
 
         all_boxes[class][image] = [] or np.array of shape #dets x 5
+
+        in_memory: compute the APs straight from all_boxes, otherwise from the results files
+        write_results: also write the comp4_det_test_<cls>.txt results files when in_memory
+        num_workers: size of the process pool evaluating the classes in parallel when in_memory
         """
-        # write down the detection results
-        self._write_voc_results_file(all_boxes)
-        # after getting the result file, do evaluation and store in output_dir
-        aps, map = self._do_python_eval(output_dir)
+        if not in_memory or write_results:
+            # write down the detection results
+            self._write_voc_results_file(all_boxes)
+        if in_memory:
+            aps, map = self._do_memory_eval(all_boxes, output_dir, num_workers)
+        else:
+            # after getting the result file, do evaluation and store in output_dir
+            aps, map = self._do_python_eval(output_dir)
         return aps, map
 
     def _get_voc_results_file_template(self):
@@ -229,7 +280,7 @@ class VOCDetection(data.Dataset):
                 for im_ind, index in enumerate(self.ids):
                     index = index[1]
                     dets = all_boxes[cls_ind][im_ind]
-                    if dets == []:
+                    if len(dets) == 0:
                         continue
                     for k in range(dets.shape[0]):
                         # for a class in an image: {image_id} {score} {xcor} {xcor} {ycor} {ycor}
@@ -238,7 +289,8 @@ class VOCDetection(data.Dataset):
                                        dets[k, 0] + 1, dets[k, 1] + 1,
                                        dets[k, 2] + 1, dets[k, 3] + 1))
 
-    def _do_python_eval(self, output_dir='output'):
+    def _get_eval_paths(self):
+        # annotations, list of the evaluated images and annotation cache
         rootpath = os.path.join(self.root, 'VOC' + self._year)
         name = self.image_set[0][1]
         annopath = os.path.join(
@@ -251,34 +303,37 @@ class VOCDetection(data.Dataset):
             'Main',
             name + '.txt')
         cachedir = os.path.join(self.root, 'annotations_cache')
-        aps = []
+        return annopath, imagesetfile, cachedir
+
+    def _do_python_eval(self, output_dir='output'):
+        annopath, imagesetfile, cachedir = self._get_eval_paths()
         # The PASCAL VOC metric changed in 2010
         use_07_metric = True if int(self._year) < 2010 else False
         print('VOC07 metric? ' + ('Yes' if use_07_metric else 'No'))
         if output_dir is not None and not os.path.isdir(output_dir):
             os.mkdir(output_dir)
+        results = []
         for i, cls in enumerate(VOC_CLASSES):
 
             if cls == '__background__':
                 continue
 
             filename = self._get_voc_results_file_template().format(cls)
-            rec, prec, ap = voc_eval(
+            results += [voc_eval(
                 filename, annopath, imagesetfile, cls, cachedir, ovthresh=0.5,
-                use_07_metric=use_07_metric)
-            # AP = AVG(Precision for each of 11 Recalls's precision)
-            aps += [ap]
-            print('AP for {} = {:.4f}'.format(cls, ap))
-            if output_dir is not None:
-                with open(os.path.join(output_dir, cls + '_pr.pkl'), 'wb') as f:
-                    pickle.dump({'rec': rec, 'prec': prec, 'ap': ap}, f)
-        # MAP = AVG(AP for each object class)
-        print('Mean AP = {:.4f}'.format(np.mean(aps)))
-        print('~~~~~~~~')
-        print('Results:')
-        for ap in aps:
-            print('{:.3f}'.format(ap))
-        print('{:.3f}'.format(np.mean(aps)))
-        print('~~~~~~~~')
-        print('')
-        return aps, np.mean(aps)
+                use_07_metric=use_07_metric)]
+        return summarize_aps(VOC_CLASSES, results, output_dir)
+
+    def _do_memory_eval(self, all_boxes, output_dir='output', num_workers=0):
+        # same as _do_python_eval() but straight from all_boxes, without the results files
+        annopath, imagesetfile, cachedir = self._get_eval_paths()
+        imagenames = [index[1] for index in self.ids]
+        # The PASCAL VOC metric changed in 2010
+        use_07_metric = True if int(self._year) < 2010 else False
+        print('VOC07 metric? ' + ('Yes' if use_07_metric else 'No'))
+        if output_dir is not None and not os.path.isdir(output_dir):
+            os.mkdir(output_dir)
+        annots = load_annots(imagenames, annopath, imagesetfile, cachedir, num_workers)
+        results = voc_eval_all(all_boxes, annots, VOC_CLASSES, ovthresh=0.5,
+                               use_07_metric=use_07_metric, num_workers=num_workers)
+        return summarize_aps(VOC_CLASSES, results, output_dir)
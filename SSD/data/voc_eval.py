@@ -2,21 +2,37 @@
 # eval tools for VOC dataset or other VOC-like dataset
 # --------------------------------
 
+import hashlib
 import pickle
+import shutil
+import tempfile
 import xml.etree.ElementTree as ET
 
 import numpy as np
 import os
+import multiprocessing
 
 def parse_rec(filename):
     """ Parse a PASCAL VOC xml file """
     tree = ET.parse(filename) #filename is the path
+    return parse_objects(tree)
+
+def parse_rec_size(filename):
+    """ parse_rec() and the (height, width) of the image, (0, 0) if the xml has no size """
+    tree = ET.parse(filename)
+    size = tree.find('size')
+    if size is None:
+        return parse_objects(tree), (0, 0)
+    return parse_objects(tree), (int(size.find('height').text), int(size.find('width').text))
+
+def parse_objects(tree):
     objects = []
     for obj in tree.findall('object'):
         obj_struct = {}
         obj_struct['name'] = obj.find('name').text.lower().strip()
-        obj_struct['pose'] = obj.find('pose').text
-        obj_struct['truncated'] = int(obj.find('truncated').text)
+        # optional tags, VOCAnnotationTransform never read them and custom VOC xmls may not have them
+        obj_struct['pose'] = obj.findtext('pose')
+        obj_struct['truncated'] = int(obj.findtext('truncated', 0))
         obj_struct['difficult'] = int(obj.find('difficult').text)
         bbox = obj.find('bndbox')
         obj_struct['bbox'] = [int(bbox.find('xmin').text) - 1,
@@ -60,6 +76,69 @@ def voc_ap(rec, prec, use_07_metric=True):
         ap = np.sum((mrec[i + 1] - mrec[i]) * mpre[i + 1])
     return ap
 
+# columns of the annotation cache, see load_annots()
+ANNOTS_COLUMNS = ['boxes', 'labels', 'difficult', 'offsets', 'sizes', 'names']
+
+def annots_fingerprint(imagenames, annopath, imagesetfile):
+    """ Hash of the cache columns, the imageset file and the size + mtime of every annotation file """
+    sha = hashlib.sha1()
+    sha.update(' '.join(ANNOTS_COLUMNS).encode())
+    with open(imagesetfile, 'rb') as f:
+        sha.update(f.read())
+    for imagename in imagenames:
+        st = os.stat(annopath % (imagename))
+        sha.update(('%s %d %d\n' % (imagename, st.st_size, st.st_mtime_ns)).encode())
+    return sha.hexdigest()
+
+
+def load_annots(imagenames, annopath, imagesetfile, cachedir, num_workers=0):
+    """
+    Annotations of every image as columns, cached in cachedir/annots_<fingerprint>/ as .npy files
+    which are memory-mapped on load. The fingerprint covers the imageset file and the annotation
+    files, so a changed dataset gets a new cache instead of silently reusing an old one.
+    num_workers: > 1 to parse the xml files with a process pool when the cache is built
+    Return a dict of arrays, the objects of image i are [offsets[i], offsets[i+1]):
+        boxes (N, 4) int32 (parse_rec() bbox), labels (N,) index in names, difficult (N,) bool,
+        offsets (num_images+1,) int64, sizes (num_images, 2) int32 (height, width) from the xml,
+        names (#names,) str
+    """
+    if not os.path.isdir(cachedir):
+        os.mkdir(cachedir)
+    cache = os.path.join(cachedir, 'annots_' + annots_fingerprint(imagenames, annopath, imagesetfile))
+    if not os.path.isdir(cache):
+        # load annots
+        print('Reading annotation for {:d} images'.format(len(imagenames)))
+        paths = [annopath % (imagename) for imagename in imagenames]
+        if num_workers > 1:
+            with multiprocessing.Pool(num_workers) as pool:
+                parsed = pool.map(parse_rec_size, paths, chunksize=64)
+        else:
+            parsed = [parse_rec_size(path) for path in paths]
+        recs = [rec for rec, size in parsed]
+        objs = [obj for rec in recs for obj in rec]
+        names = sorted(set(obj['name'] for obj in objs))
+        name_to_ind = dict(zip(names, range(len(names))))
+        annots = {'boxes': np.array([obj['bbox'] for obj in objs], dtype=np.int32).reshape(-1, 4),
+                  'labels': np.array([name_to_ind[obj['name']] for obj in objs], dtype=np.int32),
+                  'difficult': np.array([obj['difficult'] for obj in objs], dtype=bool),
+                  'offsets': np.cumsum([0] + [len(rec) for rec in recs]).astype(np.int64),
+                  'sizes': np.array([size for rec, size in parsed], dtype=np.int32).reshape(-1, 2),
+                  'names': np.array(names, dtype=str)}
+        # save, renaming the complete directory so that other processes never see half a cache
+        print('Saving cached annotations to {:s}'.format(cache))
+        tmp = tempfile.mkdtemp(dir=cachedir)
+        for k in ANNOTS_COLUMNS:
+            np.save(os.path.join(tmp, k + '.npy'), annots[k])
+        try:
+            os.rename(tmp, cache)
+        except OSError: # built by another process meanwhile
+            shutil.rmtree(tmp)
+    # load
+    annots = {k: np.load(os.path.join(cache, k + '.npy'), mmap_mode='r') for k in ANNOTS_COLUMNS}
+    if len(annots['offsets']) != len(imagenames) + 1:
+        raise ValueError('annotation cache {:s} does not match the imageset'.format(cache))
+    return annots
+
 """
 rec, prec, ap = voc_eval(...)
 
@@ -86,44 +165,29 @@ def voc_eval(detpath,
 # assumes detections are in detpath.format(classname)
 # assumes annotations are in annopath.format(imagename)
 # assumes imagesetfile is a text file with each line an image name
-# cachedir caches the annotations in a pickle file
+# cachedir caches the annotations, see load_annots()
 # first load gt
-    if not os.path.isdir(cachedir):
-        os.mkdir(cachedir)
-    cachefile = os.path.join(cachedir, 'annots.pkl') # if dataset changed, you need to delete old annots.pkl first
     # read list of images
     with open(imagesetfile, 'r') as f:
         lines = f.readlines()
     imagenames = [x.strip() for x in lines]
-    if not os.path.isfile(cachefile):
-        # load annots
-        recs = {}
-        for i, imagename in enumerate(imagenames):
-            recs[imagename] = parse_rec(annopath % (imagename))
-            if i % 100 == 0:
-                print('Reading annotation for {:d}/{:d}'.format(
-                   i + 1, len(imagenames)))
-        # save
-        print('Saving cached annotations to {:s}'.format(cachefile))
-        with open(cachefile, 'wb') as f:
-            pickle.dump(recs, f)
-    else:
-        # load
-        with open(cachefile, 'rb') as f:
-            recs = pickle.load(f)
-    # recs stores the annots for each images
+    annots = load_annots(imagenames, annopath, imagesetfile, cachedir)
+    # annots stores the annots for each images
     # class_recs stores the gt for a class
 
     # extract gt objects for this class
     class_recs = {}
     npos = 0
+    names = list(annots['names'])
+    is_class = annots['labels'] == (names.index(classname) if classname in names else -1)
+    offsets = annots['offsets']
     # go through every image
-    for imagename in imagenames:
+    for i, imagename in enumerate(imagenames):
         # and extract those objects in this image that are under this designated class
-        R = [obj for obj in recs[imagename] if obj['name'] == classname]
-        bbox = np.array([x['bbox'] for x in R]) # the object belongs to this class
-        difficult = np.array([x['difficult'] for x in R]).astype(np.bool)
-        det = [False] * len(R)
+        R = is_class[offsets[i]:offsets[i + 1]]
+        bbox = annots['boxes'][offsets[i]:offsets[i + 1]][R] # the object belongs to this class
+        difficult = annots['difficult'][offsets[i]:offsets[i + 1]][R]
+        det = [False] * len(bbox)
         npos = npos + sum(~difficult)
         # for each image, store the bboxs for this class inside this image
         class_recs[imagename] = {'bbox': bbox,
@@ -198,3 +262,197 @@ def voc_eval(detpath,
         ap = -1.
 
     return rec, prec, ap
+
+# --------------------------------
+# in-memory evaluation: same metric as voc_eval() but straight from all_boxes,
+# without writing/reading one results file per class
+# --------------------------------
+
+def gt_index(annots, classes):
+    """
+    Index the ground truths of every image once, for all classes together.
+    annots: load_annots(), images in the order of all_boxes[cls][image]
+    classes: class names in the order of all_boxes[cls], objects of other classes are ignored
+    Return a dict of flat arrays, the objects of image i are [offsets[i], offsets[i+1]):
+        boxes (N, 4) float64, labels (N,) index in classes, difficult (N,) bool, offsets (num_images+1,)
+    """
+    class_to_ind = dict(zip(classes, range(len(classes))))
+    # index in classes of every name of annots, -1 for the other names
+    name_to_cls = np.array([class_to_ind.get(name, -1) for name in annots['names']] + [-1], dtype=np.int64)
+    labels = name_to_cls[annots['labels']]
+    keep = labels >= 0
+    # number of kept objects before each image
+    offsets = np.concatenate(([0], np.cumsum(keep)))[annots['offsets']]
+    return {'boxes': np.asarray(annots['boxes'], dtype=np.float64)[keep],
+            'labels': labels[keep],
+            'difficult': np.asarray(annots['difficult'])[keep],
+            'offsets': offsets.astype(np.int64)}
+
+
+def match_detections(all_boxes, gt, start=0, end=None):
+    """
+    For every detection of all_boxes, its best overlap with the ground truths of the same
+    class in the same image, computed for all classes of an image in one vectorized step.
+    all_boxes[cls][image] = [] or np.array of shape #dets x 5 (x1, y1, x2, y2, score)
+    gt: gt_index()
+    start, end: only match the images [start, end), all of them by default
+    Return a dict of flat arrays, one entry per detection, ordered by class, image, detection:
+        labels, scores, ovmax (-inf when the image has no ground truth of the class),
+        jmax (index of the best ground truth in gt arrays)
+    """
+    num_classes = len(all_boxes)
+    end = len(gt['offsets']) - 1 if end is None else end
+    labels, scores, ovmax, jmax = [], [], [], []
+    for i in range(start, end):
+        dets = [all_boxes[j][i] for j in range(1, num_classes)]
+        det_labels = np.concatenate([np.full(len(d), j + 1, dtype=np.int64) for j, d in enumerate(dets)])
+        if det_labels.size == 0:
+            continue
+        dets = np.concatenate([np.asarray(d, dtype=np.float64).reshape(-1, 5) for d in dets])
+        # same boxes as written by _write_voc_results_file: 1-based
+        bb = dets[:, :4] + 1
+        g_start, g_end = gt['offsets'][i], gt['offsets'][i + 1]
+        BBGT = gt['boxes'][g_start:g_end]
+        if g_end > g_start:
+            # compute overlaps [#dets, #gts]
+            # intersection
+            ixmin = np.maximum(BBGT[None, :, 0], bb[:, None, 0])
+            iymin = np.maximum(BBGT[None, :, 1], bb[:, None, 1])
+            ixmax = np.minimum(BBGT[None, :, 2], bb[:, None, 2])
+            iymax = np.minimum(BBGT[None, :, 3], bb[:, None, 3])
+            iw = np.maximum(ixmax - ixmin, 0.)
+            ih = np.maximum(iymax - iymin, 0.)
+            inters = iw * ih
+            uni = ((bb[:, None, 2] - bb[:, None, 0]) * (bb[:, None, 3] - bb[:, None, 1]) +
+                   (BBGT[None, :, 2] - BBGT[None, :, 0]) *
+                   (BBGT[None, :, 3] - BBGT[None, :, 1]) - inters)
+            overlaps = inters / uni
+            # a detection is only compared to the ground truths of its class
+            overlaps[det_labels[:, None] != gt['labels'][None, g_start:g_end]] = -np.inf
+            ovmax.append(overlaps.max(1))
+            jmax.append(overlaps.argmax(1) + g_start)
+        else:
+            ovmax.append(np.full(len(dets), -np.inf))
+            jmax.append(np.zeros(len(dets), dtype=np.int64))
+        labels.append(det_labels)
+        scores.append(dets[:, 4])
+    return group_matches([{'labels': labels, 'scores': scores, 'ovmax': ovmax, 'jmax': jmax}])
+
+
+def group_matches(parts):
+    """
+    Concatenate match_detections() results of consecutive image ranges (or lists of
+    arrays) and group them by class, keeping the image order inside a class like the results files
+    """
+    matches = {}
+    for k, dtype in [('labels', np.int64), ('scores', np.float64), ('ovmax', np.float64), ('jmax', np.int64)]:
+        arrays = []
+        for part in parts:
+            arrays += part[k] if isinstance(part[k], list) else [part[k]]
+        matches[k] = np.concatenate(arrays) if len(arrays) else np.zeros(0, dtype=dtype)
+    order = np.argsort(matches['labels'], kind='mergesort')
+    return {k: v[order] for k, v in matches.items()}
+
+
+def class_eval(cls_ind, matches, gt, ovthresh=0.5, use_07_metric=True):
+    """
+    voc_eval() of one class from match_detections() and gt_index()
+    Return rec, prec, ap (-1 for all of them when the class has no detection, like voc_eval())
+    """
+    start, end = np.searchsorted(matches['labels'], [cls_ind, cls_ind + 1])
+    npos = np.sum((gt['labels'] == cls_ind) & ~gt['difficult'])
+    if end == start:
+        print("Exception: line == 1!")
+        return -1., -1., -1.
+    # sort by confidence, stable: ties keep the order of the results files
+    sorted_ind = np.argsort(-matches['scores'][start:end], kind='mergesort')
+    ovmax = matches['ovmax'][start:end][sorted_ind]
+    jmax = matches['jmax'][start:end][sorted_ind]
+
+    # go down dets and mark TPs and FPs: a detection above the threshold is a TP
+    # if it is the first one to hit its (not difficult) ground truth, detections hitting
+    # a difficult ground truth are ignored
+    nd = len(sorted_ind)
+    hit = ovmax > ovthresh
+    counted = np.flatnonzero(hit & ~gt['difficult'][jmax])
+    _, first = np.unique(jmax[counted], return_index=True)
+    tp = np.zeros(nd)
+    tp[counted[first]] = 1.
+    fp = np.zeros(nd)
+    fp[counted] = 1.
+    fp[counted[first]] = 0.
+    fp[~hit] = 1. #false positive
+
+    # compute precision recall
+    fp = np.cumsum(fp)
+    tp = np.cumsum(tp)
+    rec = tp / float(npos)
+    # avoid divide by zero in case the first detection matches a difficult
+    # ground truth
+    prec = tp / np.maximum(tp + fp, np.finfo(np.float64).eps)
+    ap = voc_ap(rec, prec, use_07_metric)
+    return rec, prec, ap
+
+
+# shared by the workers of voc_eval_all(): inherited without any copy when they are forked
+_pool_data = {}
+
+def _init_pool(all_boxes, gt):
+    _pool_data['all_boxes'] = all_boxes
+    _pool_data['gt'] = gt
+
+def _pool_match(bounds):
+    return match_detections(_pool_data['all_boxes'], _pool_data['gt'], *bounds)
+
+def _pool_class_eval(cls_ind, matches, ovthresh, use_07_metric):
+    return class_eval(cls_ind, matches, _pool_data['gt'], ovthresh, use_07_metric)
+
+
+def voc_eval_all(all_boxes, annots, classes, ovthresh=0.5, use_07_metric=True,
+                 num_workers=0):
+    """
+    voc_eval() for every class (but the background all_boxes[0]) straight from all_boxes
+    num_workers: > 1 to spread the matching (by image ranges) and the AP of each class over
+        a process pool, all_boxes and the ground truths are loaded once and shared with the workers
+    Return a list of (rec, prec, ap), one per class in class order
+    """
+    gt = gt_index(annots, classes)
+    num_images = len(gt['offsets']) - 1
+    if num_workers <= 1:
+        matches = match_detections(all_boxes, gt)
+        return [class_eval(cls_ind, matches, gt, ovthresh, use_07_metric)
+                for cls_ind in range(1, len(classes))]
+    bounds = np.linspace(0, num_images, 4 * num_workers + 1).astype(int)
+    with multiprocessing.Pool(num_workers, initializer=_init_pool, initargs=(all_boxes, gt)) as pool:
+        matches = group_matches(pool.map(_pool_match, zip(bounds[:-1], bounds[1:])))
+        # each worker only receives the detections of its class, results come back in class order
+        args = []
+        for cls_ind in range(1, len(classes)):
+            start, end = np.searchsorted(matches['labels'], [cls_ind, cls_ind + 1])
+            args.append((cls_ind, {k: v[start:end] for k, v in matches.items()}, ovthresh, use_07_metric))
+        return pool.starmap(_pool_class_eval, args)
+
+
+def summarize_aps(classes, results, output_dir=None):
+    """
+    Print the AP of each class (but the background classes[0]) and the mAP,
+    store each (rec, prec, ap) in output_dir/<cls>_pr.pkl
+    """
+    aps = []
+    for cls, (rec, prec, ap) in zip(classes[1:], results):
+        # AP = AVG(Precision for each of 11 Recalls's precision)
+        aps += [ap]
+        print('AP for {} = {:.4f}'.format(cls, ap))
+        if output_dir is not None:
+            with open(os.path.join(output_dir, cls + '_pr.pkl'), 'wb') as f:
+                pickle.dump({'rec': rec, 'prec': prec, 'ap': ap}, f)
+    # MAP = AVG(AP for each object class)
+    print('Mean AP = {:.4f}'.format(np.mean(aps)))
+    print('~~~~~~~~')
+    print('Results:')
+    for ap in aps:
+        print('{:.3f}'.format(ap))
+    print('{:.3f}'.format(np.mean(aps)))
+    print('~~~~~~~~')
+    print('')
+    return aps, np.mean(aps)
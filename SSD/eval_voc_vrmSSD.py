@@ -21,9 +21,12 @@ import torch.backends.cudnn as cudnn
 from torch.autograd import Variable
 from data import *
 import torch.utils.data as data
+from layers import Detect
+from utils.eval_engine import detect_all, EvalImageCache
 
 from models.SSD_vggres import build_ssd
 from models.SSD_mobile import build_mssd
+from models.fusion import fuse_for_inference, detections
 
 import sys
 import os
@@ -59,8 +62,27 @@ parser.add_argument('--confidence_threshold', default=0.01, type=float,
 # 200 in SSD paper, 200 for COCO, 300 for VOC
 parser.add_argument('--max_per_image', default=200, type=int,
                     help='Top number of detections kept per image, further restrict the number of predictions to parse')
+# 'batched' runs threshold + nms for all classes of all images together
+parser.add_argument('--detect_mode', default='loop', choices=['loop', 'batched'],
+                    type=str, help='Post-processing mode of Detect')
+parser.add_argument('--nms_method', default='loop', choices=['loop', 'matrix'],
+                    type=str, help='nms used by Detect in loop mode')
+parser.add_argument('--top_k', default=-1, type=int,
+                    help='Max candidates per class sent to nms (<= 0: max_per_image)')
+parser.add_argument('--keep_top_k', default=-1, type=int,
+                    help='Max detections kept per image over all classes (<= 0: no cap)')
+parser.add_argument('--eval_batch_size', default=8, type=int,
+                    help='Number of images per forward pass in test_net')
+parser.add_argument('--eval_workers', default=4, type=int,
+                    help='Number of workers used in test_net dataloading and AP evaluation')
+parser.add_argument('--eval_cache', default=None, type=str,
+                    help='Local directory caching the resized test images between evaluations (off by default)')
+parser.add_argument('--eval_cache_size', default=16, type=int,
+                    help='Size limit of the eval_cache directory in GB')
 parser.add_argument('--cuda', default=True, type=str2bool,
                     help='Use cuda to train model')
+parser.add_argument('--fuse', default=False, type=str2bool,
+                    help='Fold BN and L2Norm scales into the convs before evaluating (see models/fusion.py)')
 parser.add_argument('--voc_root', default= VOC_ROOT,# XL_ROOT, for VOC_xlab_products dataset
                     help='Location of XL root directory')
 parser.add_argument('--cleanup', default=True, type=str2bool,
@@ -77,6 +99,9 @@ parser.set_defaults(use_m2=False)
 
 args = parser.parse_args()
 
+# resized test images kept between the evaluations, see EvalImageCache
+eval_cache = EvalImageCache(args.eval_cache, args.eval_cache_size << 30) if args.eval_cache else None
+
 if not os.path.exists(args.save_folder):
     os.mkdir(args.save_folder)
 
@@ -102,65 +127,29 @@ cfg = voc #xl, for VOC_xlab_products dataset
         transform: BaseTransform - not used here
 """
 def test_net(save_folder, net, cuda,
-             testset, transform, max_per_image=300, thresh=0.05):
+             testset, transform, max_per_image=300, thresh=0.05,
+             batch_size=8, num_workers=4, cache=None):
 
     if not os.path.exists(save_folder):
         os.mkdir(save_folder)
 
-    num_images = len(testset)
     num_classes = cfg['num_classes']
-    # all detections are collected into:
-    #    all_boxes[cls][image] = N x 5 array of detections in
-    #    (x1, y1, x2, y2, score)
-    all_boxes = [[[] for _ in range(num_images)]
-                 for _ in range(num_classes)]
-
-    # timers
-    _t = {'im_detect': Timer(), 'misc': Timer()}
     #output_dir = get_output_dir('ssd300_120000', set_type) #directory storing output results
     #det_file = os.path.join(output_dir, 'detections.pkl') #file storing output result under output_dir
     det_file = os.path.join(save_folder, 'detections.pkl')
 
-    for i in range(num_images):
-        im, gt, h, w = testset.pull_item(i) # include BaseTransform inside
-
-        x = Variable(im.unsqueeze(0)) #insert a dimension of size one at the dim 0
-        if cuda:
-            x = x.cuda()
-
-        _t['im_detect'].tic()
-        detections = net(x=x, test=True).data # get the detection results
-        detect_time = _t['im_detect'].toc(average=False) #store the detection time
-
-        # skip j = 0, because it's the background class
-        for j in range(1, detections.size(1)): # for every class
-            dets = detections[0, j, :]#size( ** , 5)
-            mask = dets[:, 0].gt(0.).expand(5, dets.size(0)).t()
-            dets = torch.masked_select(dets, mask).view(-1, 5)
-            if dets.dim() == 0:
-                continue
-            #if dets.size(0) == 0:
-            #    continue
-            boxes = dets[:, 1:]
-            boxes[:, 0] *= w
-            boxes[:, 2] *= w
-            boxes[:, 1] *= h
-            boxes[:, 3] *= h
-            scores = dets[:, 0].cpu().numpy()
-            cls_dets = np.hstack((boxes.cpu().numpy(),
-                                  scores[:, np.newaxis])).astype(np.float32,
-                                                                 copy=False)
-            all_boxes[j][i] = cls_dets #[class][imageID] = 1 x 5 where 5 is box_coord + score
-        if (i + 1) % 100 == 0:
-            print('im_detect: {:d}/{:d} {:.3f}s'.format(i + 1,
-                                                        num_images, detect_time))
+    # all detections are collected into:
+    #    all_boxes[cls][image] = N x 5 array of detections in
+    #    (x1, y1, x2, y2, score)
+    all_boxes = detect_all(detections(net), testset, num_classes, cuda,
+                           batch_size=batch_size, num_workers=num_workers, cache=cache)
 
     #write the detection results into det_file
     with open(det_file, 'wb') as f:
         pickle.dump(all_boxes, f, pickle.HIGHEST_PROTOCOL)
 
     print('Evaluating detections')
-    APs,mAP = testset.evaluate_detections(all_boxes, save_folder)
+    APs,mAP = testset.evaluate_detections(all_boxes, save_folder, num_workers=num_workers)
 
 if __name__ == '__main__':
     # load net
@@ -173,6 +162,8 @@ if __name__ == '__main__':
         net = build_mssd('test', cfg, 300, num_classes, base='m2', max_per_image = args.max_per_image) # backbone network is m2
     else:
         net = build_ssd('test', cfg, 300, num_classes, base='vgg', max_per_image = args.max_per_image) # initialize SSD (vgg)
+    net.detect = Detect(num_classes, cfg, args.max_per_image, args.confidence_threshold, 0.45, mode=args.detect_mode,
+                    nms_method=args.nms_method, top_k=args.top_k, keep_top_k=args.keep_top_k)
     # if you want to eval SSD from original version ssd.pytorch because self.vgg was changed to self.base
     '''
     # load resume SSD network
@@ -192,6 +183,8 @@ if __name__ == '__main__':
     net.load_state_dict(torch.load(args.trained_model))
     net.eval()
     print('Finished loading model!')
+    if args.fuse:
+        fuse_for_inference(net)
     # load data
 #    dataset = XLDetection(args.voc_root, [set_type], # for VOC_xlab_products dataset
 #                           BaseTransform(300, cfg['dataset_mean']),
@@ -205,4 +198,6 @@ if __name__ == '__main__':
     # evaluation
     test_net(args.save_folder, net, args.cuda, dataset,
              BaseTransform(net.size, cfg['dataset_mean']), args.max_per_image,
-             thresh=args.confidence_threshold)
+             thresh=args.confidence_threshold, batch_size=args.eval_batch_size,
+             num_workers=args.eval_workers,
+             cache=eval_cache)
@@ -0,0 +1,84 @@
+'''
+    Export a trained SSD model for the android app (PyTorch Mobile lite interpreter), see models/export.py:
+    writes <out>.ptl and its manifest <out>.json (input size, mean, classes, priors hash)
+
+    Export vggSSD from a state_dict
+    Execute: python3 export_ssd.py --trained_model weights/ssd300_mAP_77.43_v2.pth --out weights/ssd300_vgg.ptl
+
+    Export mobileSSD v2 from a state_dict
+    Execute: python3 export_ssd.py --use_m2 --trained_model weights/_your_trained_SSD_model_.pth --out weights/ssd300_mobilev2.ptl
+
+    Export a pruned/finetuned model saved whole with torch.save (finetune_vggresSSD.py)
+    Execute: python3 export_ssd.py --pruned_model prunes/vggSSD_finetuned_71.73.pth --out weights/ssd300_pruned.ptl
+'''
+import torch
+from data import *
+from layers import Detect
+from models.SSD_vggres import build_ssd
+from models.SSD_mobile import build_mssd
+from models.export import export_model
+import argparse
+
+
+def str2bool(v):
+    return v.lower() in ("yes", "true", "t", "1")
+
+
+parser = argparse.ArgumentParser(
+    description='Export a Single Shot MultiBox Detector for PyTorch Mobile')
+parser.add_argument('--trained_model',
+                    default='weights/ssd300_mAP_77.43_v2.pth', type=str,
+                    help='Trained state_dict file path to open')
+parser.add_argument('--pruned_model', default=None, type=str,
+                    help='Whole model saved with torch.save (pruned/finetuned), used instead of --trained_model')
+parser.add_argument('--dataset', default='VOC', choices=['VOC', 'XL'],
+                    type=str, help='Config and classes of the model, VOC or XL')
+parser.add_argument('--out', default='weights/ssd300.ptl', type=str,
+                    help='Exported .ptl file, the manifest is written next to it (.json)')
+parser.add_argument('--confidence_threshold', default=0.01, type=float,
+                    help='Detection confidence threshold of the exported Detect')
+parser.add_argument('--max_per_image', default=200, type=int,
+                    help='Detections kept per class in the output of the exported model')
+parser.add_argument('--detect_mode', default='loop', choices=['loop', 'batched'],
+                    type=str, help='Post-processing mode of Detect')
+parser.add_argument('--nms_method', default='loop', choices=['loop', 'matrix'],
+                    type=str, help='nms used by Detect in loop mode')
+parser.add_argument('--top_k', default=-1, type=int,
+                    help='Max candidates per class sent to nms (<= 0: max_per_image)')
+parser.add_argument('--keep_top_k', default=-1, type=int,
+                    help='Max detections kept per image over all classes (<= 0: no cap)')
+parser.add_argument('--check', default=True, type=str2bool,
+                    help='Compare the detections of the exported model to the eager ones')
+# for resnet backbone
+parser.add_argument("--use_res", dest="use_res", action="store_true")
+parser.set_defaults(use_res=False)
+# for mobilev1 backbone
+parser.add_argument("--use_m1", dest="use_m1", action="store_true")
+parser.set_defaults(use_m1=False)
+# for mobilev2 backbone
+parser.add_argument("--use_m2", dest="use_m2", action="store_true")
+parser.set_defaults(use_m2=False)
+args = parser.parse_args()
+
+if __name__ == '__main__':
+    # exported on the cpu, like it runs on the phone
+    torch.set_default_tensor_type('torch.FloatTensor')
+    cfg, classes = (voc, VOC_CLASSES) if args.dataset == 'VOC' else (xl, XL_CLASSES)
+    num_classes = cfg['num_classes']
+    if args.pruned_model:
+        net = torch.load(args.pruned_model, map_location='cpu')
+    else:
+        if args.use_res:
+            net = build_ssd('test', cfg, 300, num_classes, base='resnet', max_per_image=args.max_per_image)
+        elif args.use_m1:
+            net = build_mssd('test', cfg, 300, num_classes, base='m1', max_per_image=args.max_per_image)
+        elif args.use_m2:
+            net = build_mssd('test', cfg, 300, num_classes, base='m2', max_per_image=args.max_per_image)
+        else:
+            net = build_ssd('test', cfg, 300, num_classes, base='vgg', max_per_image=args.max_per_image)
+        net.load_state_dict(torch.load(args.trained_model, map_location='cpu'))
+    net.detect = Detect(num_classes, cfg, args.max_per_image, args.confidence_threshold, 0.45, mode=args.detect_mode,
+                        nms_method=args.nms_method, top_k=args.top_k, keep_top_k=args.keep_top_k)
+    net.eval()
+    print('Finished loading model!')
+    export_model(net, cfg, args.out, classes, check=args.check)
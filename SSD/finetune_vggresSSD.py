@@ -4,6 +4,9 @@
 
     Finetune prunned model resnetSSD (Train/Test on VOC)
     Execute: python3 finetune_vggresSSD.py --use_res --pruned_model prunes/_your_prunned_model_ --lr x --epoch y
+
+    Quantization-aware finetuning of a prunned model vggSSD, evaluated and saved in int8 too (see models/quantization.py)
+    Execute: python3 finetune_vggresSSD.py --qat True --pruned_model prunes/_your_prunned_model_ --lr x --epoch y --qat_freeze_bn 3 --qat_freeze_observer 4
 '''
 import torch
 from torch.autograd import Variable
@@ -31,7 +34,13 @@ from data import *
 from data import VOC_CLASSES as labelmap
 import torch.utils.data as data
 from utils.augmentations import SSDAugmentation
+from utils.batch_augmentations import BatchSSDAugmentation, raw_collate
 from layers.modules import MultiBoxLoss
+from utils.eval_engine import detect_all, EvalImageCache
+from models.fusion import detections
+from models.quantization import prepare_qat_model, convert_qat
+from torch.ao.quantization import disable_observer
+from torch.ao.nn.intrinsic.qat import freeze_bn_stats
 
 def str2bool(v):
     return v.lower() in ("yes", "true", "t", "1")
@@ -45,96 +54,115 @@ parser.add_argument("--lr", default=0.001, type=float)
 parser.add_argument("--momentum", default=0.9, type=float)
 parser.add_argument("--epoch", default=20, type=int)
 parser.add_argument('--cuda', default=True, type=str2bool, help='Use cuda to train model')
+parser.add_argument('--gpu_augment', default=False, type=str2bool,
+                    help='Augment the training batches with torch ops on the gpu, the workers only decode the images')
+parser.add_argument('--amp', default=False, type=str2bool,
+                    help='Mixed precision training: float16 autocast + loss scaling with cuda, bfloat16 autocast on the cpu')
+parser.add_argument('--channels_last', default=False, type=str2bool,
+                    help='Finetune in the channels_last (NHWC) memory format')
+# quantization-aware training: finetune with fake int8 quantization, evaluate/save the int8 model
+parser.add_argument('--qat', default=False, type=str2bool,
+                    help='Quantization-aware finetuning, the converted int8 model is evaluated and saved too')
+parser.add_argument('--qat_backend', default='fbgemm', choices=['fbgemm', 'qnnpack'],
+                    type=str, help='Quantized engine of the int8 model: fbgemm for x86, qnnpack for arm')
+parser.add_argument('--qat_freeze_bn', default=-1, type=int,
+                    help='Epoch (counted from 1, as logged) from which the BN statistics are frozen (<= 0: never)')
+parser.add_argument('--qat_freeze_observer', default=-1, type=int,
+                    help='Epoch (counted from 1, as logged) from which the quantization ranges are frozen (<= 0: never)')
 # for test_net: 200 in SSD paper, 200 for COCO, 300 for VOC
 parser.add_argument('--max_per_image', default=200, type=int,
                     help='Top number of detections kept per image, further restrict the number of predictions to parse')
+parser.add_argument('--eval_batch_size', default=8, type=int,
+                    help='Number of images per forward pass in test_net')
+parser.add_argument('--eval_workers', default=4, type=int,
+                    help='Number of workers used in test_net dataloading and AP evaluation')
+parser.add_argument('--eval_cache', default=None, type=str,
+                    help='Local directory caching the resized test images between evaluations (off by default)')
+parser.add_argument('--eval_cache_size', default=16, type=int,
+                    help='Size limit of the eval_cache directory in GB')
+# datasets packed by pack_shards.py, used instead of the VOC dataset_root
+parser.add_argument('--train_shards', default=None, type=str,
+                    help='Directory of the packed training dataset')
+parser.add_argument('--test_shards', default=None, type=str,
+                    help='Directory of the packed test dataset')
 # use resnet or not
 parser.add_argument("--use_res", dest="use_res", action="store_true")
 parser.set_defaults(use_res=False)
 args = parser.parse_args()
+if args.qat and args.amp:
+    parser.error('--qat fake quantizes in float32, without --amp')
+
+# resized test images kept between the evaluations, see EvalImageCache
+eval_cache = EvalImageCache(args.eval_cache, args.eval_cache_size << 30) if args.eval_cache else None
 
 cfg = voc
 
 def test_net(save_folder, net, cuda,
-             testset, transform, max_per_image=200, thresh=0.05):
+             testset, transform, max_per_image=200, thresh=0.05,
+             batch_size=8, num_workers=4, cache=None):
 
     if not os.path.exists(save_folder):
         os.mkdir(save_folder)
 
-    num_images = len(testset)
     num_classes = len(labelmap)                      # +1 for background
-    # all detections are collected into:
-    #    all_boxes[cls][image] = N x 5 array of detections in
-    #    (x1, y1, x2, y2, score)
-    all_boxes = [[[] for _ in range(num_images)]
-                 for _ in range(num_classes)]
-
-    # timers
-    _t = {'im_detect': Timer(), 'misc': Timer()}
     #output_dir = get_output_dir('ssd300_120000', set_type) #directory storing output results
     #det_file = os.path.join(output_dir, 'detections.pkl') #file storing output result under output_dir
     det_file = os.path.join(save_folder, 'detections.pkl')
 
-    for i in range(num_images):
-        im, gt, h, w = testset.pull_item(i) # include BaseTransform inside
-
-        x = Variable(im.unsqueeze(0)) #insert a dimension of size one at the dim 0
-        if cuda:
-            x = x.cuda()
-
-        _t['im_detect'].tic()
-        net.phase = 'test'
-        detections = net(x=x).data #, test=True # get the detection results, max_per_image = 300 takes effect inside
-        detect_time = _t['im_detect'].toc(average=False) #store the detection time
-
-        # skip j = 0, because it's the background class
-        for j in range(1, detections.size(1)): # for every class
-            dets = detections[0, j, :]#size( ** , 5)
-            mask = dets[:, 0].gt(0.).expand(5, dets.size(0)).t()
-            dets = torch.masked_select(dets, mask).view(-1, 5)
-            if dets.dim() == 0:
-                continue
-            #if dets.size(0) == 0:
-            #    continue
-            boxes = dets[:, 1:]
-            boxes[:, 0] *= w
-            boxes[:, 2] *= w
-            boxes[:, 1] *= h
-            boxes[:, 3] *= h
-            scores = dets[:, 0].cpu().numpy()
-            cls_dets = np.hstack((boxes.cpu().numpy(),
-                                  scores[:, np.newaxis])).astype(np.float32,
-                                                                 copy=False)
-            all_boxes[j][i] = cls_dets #[class][imageID] = 1 x 5 where 5 is box_coord + score
-
-        if (i + 1) % 100 == 0:
-            print('im_detect: {:d}/{:d} {:.3f}s'.format(i + 1, num_images, detect_time))
+    # all detections are collected into:
+    #    all_boxes[cls][image] = N x 5 array of detections in
+    #    (x1, y1, x2, y2, score)
+    # get the detection results, max_per_image = 300 takes effect inside
+    all_boxes = detect_all(detections(net), testset, num_classes, cuda,
+                           batch_size=batch_size, num_workers=num_workers, cache=cache)
 
     #write the detection results into det_file
     with open(det_file, 'wb') as f:
         pickle.dump(all_boxes, f, pickle.HIGHEST_PROTOCOL)
 
     print('Evaluating detections')
-    APs,mAP = testset.evaluate_detections(all_boxes, save_folder)
+    APs,mAP = testset.evaluate_detections(all_boxes, save_folder, num_workers=num_workers)
 
     return mAP # for model storing
 
 # --------------------------------------------------------------------------- Finetune Part
 class FineTuner_vggresSSD:
-    def __init__(self, train_loader, testset, criterion, model):
+    def __init__(self, train_loader, testset, criterion, model, augment=None, amp=False, channels_last=False,
+                 qat=False, freeze_bn_epoch=-1, freeze_observer_epoch=-1):
         self.train_data_loader = train_loader
         self.testset = testset
+        self.augment = augment # BatchSSDAugmentation of the raw_collate batches, optional
+        # mixed precision: the loss scaling is only needed by float16 (cuda), bfloat16 has the float32 range
+        self.amp = amp
+        self.amp_device = 'cuda' if args.cuda else 'cpu'
+        self.amp_dtype = torch.float16 if args.cuda else torch.bfloat16
+        self.scaler = torch.amp.GradScaler(self.amp_device, enabled=amp and args.cuda)
+        self.channels_last = channels_last
+        # quantization-aware training: model prepared by prepare_qat_model(), the BN statistics
+        # and the observers of the fake quantization are frozen from the given epochs, counted from 1 (<= 0: never)
+        self.qat = qat
+        self.freeze_bn_epoch = freeze_bn_epoch
+        self.freeze_observer_epoch = freeze_observer_epoch
+        self.int8_model = None # converted by test() in qat mode
 
         self.model = model
+        if channels_last:
+            self.model.to(memory_format=torch.channels_last)
         self.criterion = criterion
         self.model.train()
 
     def test(self):
         self.model.eval()
+        net, cuda = self.model, args.cuda
+        if self.qat: # the int8 model, whose kernels only run on the cpu
+            self.int8_model = net = convert_qat(self.model)
+            cuda = False
         # evaluation
-        map = test_net('prunes/test', self.model, args.cuda, testset,
+        map = test_net('prunes/test', net, cuda, testset,
                  BaseTransform(self.model.size, cfg['dataset_mean']),
-                 args.max_per_image, thresh=0.01)
+                 args.max_per_image, thresh=0.01,
+                 batch_size=args.eval_batch_size, num_workers=args.eval_workers,
+                 cache=eval_cache)
         self.model.train()
         return map
 
@@ -147,6 +175,12 @@ class FineTuner_vggresSSD:
 
         for i in range(epoches):
             print("FineTune... Epoch: ", i+1)
+            if self.qat and i+1 == self.freeze_bn_epoch:
+                print("Freezing the BN statistics")
+                self.model.apply(freeze_bn_stats)
+            if self.qat and i+1 == self.freeze_observer_epoch:
+                print("Freezing the quantization ranges")
+                self.model.apply(disable_observer)
             self.train_epoch(optimizer) # no need for rank_filters
             if i == (epoches-1):
               map = self.test()
@@ -159,25 +193,36 @@ class FineTuner_vggresSSD:
         self.model.zero_grad() # same as optimizer.zero_grad() when SGD() get model.parameters
         # input = Variable(batch)
         input = batch
-        # make priors cuda()
-        loc_, conf_, priors_ = self.model(input)
-        if args.cuda:
-            priors_ = priors_.cuda()
-
-        loss_l, loss_c = self.criterion((loc_, conf_, priors_), label)
+        if self.channels_last:
+            input = input.contiguous(memory_format=torch.channels_last)
+        with torch.autocast(self.amp_device, dtype=self.amp_dtype, enabled=self.amp):
+            # make priors cuda()
+            loc_, conf_, priors_ = self.model(input)
+            if args.cuda:
+                priors_ = priors_.cuda()
+
+            loss_l, loss_c = self.criterion((loc_, conf_, priors_), label) # computed in float32
         loss = loss_l + loss_c
-        loss.backward()
-        optimizer.step() # update params
+        self.scaler.scale(loss).backward()
+        self.scaler.step(optimizer) # update params
+        self.scaler.update()
 
     # train for one epoch, so the data_loader will not pop StopIteration error
     def train_epoch(self, optimizer = None):
         num_batch = 0
-        for batch, label in self.train_data_loader:
+        for loaded in self.train_data_loader:
             num_batch += 1
             if num_batch % 50 == 0:
                 print("Training batch " + repr(num_batch) + "/" + repr(len(self.train_data_loader)-1) + "...")
-            batch = Variable(batch.cuda())
-            label = [Variable(ann.cuda(), volatile=True) for ann in label]
+            if self.augment is not None:
+                images, sizes, label = loaded
+                batch, label = self.augment(images.cuda(non_blocking=True), sizes, label)
+            else:
+                batch, label, num_objs = loaded
+                label = (label, num_objs)
+            # pinned batch: one non blocking copy of the images and of the padded targets
+            batch = batch.cuda(non_blocking=True)
+            label = tuple(t.cuda(non_blocking=True) for t in label)
             self.train_batch(optimizer, batch, label)
 
 if __name__ == '__main__':
@@ -190,21 +235,41 @@ if __name__ == '__main__':
 
     print(args)
     # load model from previous pruning
-    model = torch.load(args.pruned_model).cuda()
+    model = torch.load(args.pruned_model)
+    if args.qat:
+        # fake quantization inserted on the cpu, then moved with the model
+        model = prepare_qat_model(model.cpu(), args.qat_backend)
+    model = model.cuda()
     print('Finished loading model!')
 
     # data
-    dataset = VOCDetection(root=args.dataset_root,
-                           transform=SSDAugmentation(cfg['min_dim'], cfg['dataset_mean']))
-    testset = VOCDetection(root=args.dataset_root, image_sets=[('2007', 'test')],
-                                transform=BaseTransform(cfg['min_dim'], cfg['testset_mean']))
+    if args.train_shards is not None:
+        dataset = ShardDetection(args.train_shards,
+                                 transform=SSDAugmentation(cfg['min_dim'], cfg['dataset_mean']))
+    else:
+        dataset = VOCDetection(root=args.dataset_root,
+                               transform=SSDAugmentation(cfg['min_dim'], cfg['dataset_mean']))
+    if args.test_shards is not None:
+        testset = ShardDetection(args.test_shards,
+                                 transform=BaseTransform(cfg['min_dim'], cfg['testset_mean']))
+    else:
+        testset = VOCDetection(root=args.dataset_root, image_sets=[('2007', 'test')],
+                                    transform=BaseTransform(cfg['min_dim'], cfg['testset_mean']))
+    # batched augmentation on the gpu instead of SSDAugmentation in the workers
+    augment = None
+    if args.gpu_augment:
+        dataset.transform = None
+        augment = BatchSSDAugmentation(cfg['min_dim'], cfg['dataset_mean'])
     data_loader = data.DataLoader(dataset, 32, num_workers=4,
-                                  shuffle=True, collate_fn=detection_collate,
+                                  shuffle=True, collate_fn=raw_collate if args.gpu_augment else padded_collate,
                                   pin_memory=True) #len(data_loader) == 518
 
     criterion = MultiBoxLoss(cfg['num_classes'], 0.5, True, 0, True, 3, 0.5, False, args.cuda)
 
-    fine_tuner = FineTuner_vggresSSD(data_loader, testset, criterion, model)
+    fine_tuner = FineTuner_vggresSSD(data_loader, testset, criterion, model, augment,
+                                     amp=args.amp, channels_last=args.channels_last,
+                                     qat=args.qat, freeze_bn_epoch=args.qat_freeze_bn,
+                                     freeze_observer_epoch=args.qat_freeze_observer)
 
     # ------------------------ adjustable part
     optimizer = optim.SGD(model.parameters(), lr=args.lr, momentum=args.momentum)
@@ -212,7 +277,13 @@ if __name__ == '__main__':
     # ------------------------ adjustable part
 
     print('Saving finetuned model with map ', map, '...')
-    if args.use_res:
-        torch.save(model, 'prunes/resnetSSD_finetuned_{0:.2f}'.format(map*100))
+    model.to(memory_format=torch.contiguous_format)
+    name = 'resnetSSD' if args.use_res else 'vggSSD'
+    if args.qat:
+        # state_dicts, prepared/converted models don't pickle: the fake quantized float model, to resume
+        # the qat (prepare_qat_model(torch.load(args.pruned_model)).load_state_dict(...)), and the int8
+        # model: load_quantized(torch.load(args.pruned_model), state_dict, qat=True)
+        torch.save(model.state_dict(), 'prunes/{}_qat_{:.2f}.pth'.format(name, map*100))
+        torch.save(fine_tuner.int8_model.state_dict(), 'prunes/{}_qat_int8_{:.2f}.pth'.format(name, map*100))
     else:
-        torch.save(model, 'prunes/vggSSD_finetuned_{0:.2f}'.format(map*100))
+        torch.save(model, 'prunes/{}_finetuned_{:.2f}'.format(name, map*100))
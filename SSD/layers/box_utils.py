@@ -71,6 +71,27 @@ def jaccard(box_a, box_b):
     return inter / union  # [A,B]
 
 
+def batched_jaccard(box_a, box_b):
+    """Compute the jaccard overlap of G independent groups of boxes at once,
+    i.e. jaccard() applied to every group without a python loop.
+    Args:
+        box_a: (tensor) bounding boxes, Shape: [G,A,4].
+        box_b: (tensor) bounding boxes, Shape: [G,B,4].
+    Return:
+        jaccard overlap: (tensor) Shape: [G,A,B]
+    """
+    # one coordinate at a time, broadcasting [G,A,1] against [G,1,B] is much faster
+    # than working on [G,A,B,2] tensors with a strided last dim
+    a_x1, a_y1, a_x2, a_y2 = [c.unsqueeze(2) for c in box_a.unbind(2)]
+    b_x1, b_y1, b_x2, b_y2 = [c.unsqueeze(1) for c in box_b.unbind(2)]
+    inter = torch.clamp(torch.min(a_x2, b_x2) - torch.max(a_x1, b_x1), min=0) * \
+            torch.clamp(torch.min(a_y2, b_y2) - torch.max(a_y1, b_y1), min=0)  # [G,A,B]
+    area_a = (a_x2 - a_x1) * (a_y2 - a_y1)  # [G,A,1]
+    area_b = (b_x2 - b_x1) * (b_y2 - b_y1)  # [G,1,B]
+    union = area_a + area_b - inter
+    return inter / union  # [G,A,B]
+
+
 def match(threshold, truths, priors, variances, labels, loc_t, conf_t, idx):
     """Match each prior box with the ground truth box of the highest jaccard
     overlap, encode the bounding boxes, then return the matched indices
@@ -119,6 +140,62 @@ def match(threshold, truths, priors, variances, labels, loc_t, conf_t, idx):
     loc_t[idx] = loc    # [num_priors,4] encoded offsets for every default box to learn
     conf_t[idx] = conf  # [num_priors] top class label for each prior
 
+def pad_targets(targets):
+    """Stack the per image targets of a batch into one zero padded tensor.
+    Args:
+        targets: (list of tensors) Ground truth boxes and labels of each image, Shape: [num_obj,5].
+    Return:
+        targets: (tensor) Shape: [batch,max_objs,5], padded rows are zeros.
+        num_objs: (tensor) number of ground truths of each image, Shape: [batch].
+    """
+    num_objs = torch.tensor([t.size(0) for t in targets], dtype=torch.long, device=targets[0].device)
+    padded = targets[0].new_zeros(len(targets), max(1, int(num_objs.max())), 5)
+    for idx, t in enumerate(targets):
+        padded[idx, :t.size(0)] = t
+    return padded, num_objs
+
+
+def batched_match(threshold, truths, priors, variances, labels, num_objs):
+    """match() for a whole batch at once, on the device of truths: same targets
+    (same tie breaking and the last ground truth wins when several of them share
+    their best prior), without python loops over images and ground truths.
+    Args:
+        threshold: (float) The overlap threshold used when matching boxes.
+        truths: (tensor) Padded ground truth boxes, Shape: [batch,max_objs,4]. - point_form
+        priors: (tensor) Prior boxes from priorbox layers, Shape: [n_priors,4]. - center_form
+        variances: (list[float]) Variances of priorboxes
+        labels: (tensor) Padded class labels, Shape: [batch,max_objs].
+        num_objs: (tensor) number of valid ground truths of each image, Shape: [batch].
+    Return:
+        loc_t: (tensor) encoded location targets, Shape: [batch,num_priors,4].
+        conf_t: (tensor) matched labels, 0 is background, Shape: [batch,num_priors].
+    """
+    num, max_objs = truths.shape[:2]
+    num_priors = priors.size(0)
+    valid = torch.arange(max_objs, device=truths.device).unsqueeze(0) < num_objs.unsqueeze(1)  # [batch,max_objs]
+    # jaccard index - [batch,max_objs,num_priors], padded ground truths can never be matched
+    overlaps = batched_jaccard(truths, point_form(priors).unsqueeze(0))
+    overlaps.masked_fill_(~valid.unsqueeze(2), -1)
+    # (Bipartite Matching)
+    # [batch,max_objs] best prior for each ground truth
+    _, best_prior_idx = overlaps.max(2)
+    # [batch,num_priors] best ground truth for each prior
+    best_truth_overlap, best_truth_idx = overlaps.max(1)
+    # ensure every gt matches with its prior of max overlap, like the loop of match() the
+    # highest gt index wins when two of them share a best prior
+    gt_idx = torch.arange(max_objs, device=truths.device).unsqueeze(0).expand(num, max_objs)
+    forced = best_truth_idx.new_full((num, num_priors), -1).scatter_reduce_(
+        1, best_prior_idx, torch.where(valid, gt_idx, torch.full_like(gt_idx, -1)), reduce='amax')
+    best_truth_idx = torch.where(forced >= 0, forced, best_truth_idx)
+    best_truth_overlap.masked_fill_(forced >= 0, 2)
+    # [batch,num_priors,4] -> for each prior box, its corresponding gt box's coordinate
+    matches = truths.gather(1, best_truth_idx.unsqueeze(2).expand(num, num_priors, 4))
+    conf_t = labels.gather(1, best_truth_idx).long()  # Shape: [batch,num_priors]
+    conf_t[best_truth_overlap < threshold] = 0  # label as background
+    loc_t = encode(matches.view(-1, 4), priors.repeat(num, 1), variances).view(num, num_priors, 4)
+    return loc_t, conf_t
+
+
 def refine_match(threshold, truths, priors, variances, labels, loc_t, conf_t, idx, arm_loc):
     """Match each arm bbox with the ground truth box of the highest jaccard
     overlap, encode the bounding boxes, then return the matched indices
@@ -224,9 +301,43 @@ def log_sum_exp(x):
     all examples in a batch.
     Args:
         x (Variable(tensor)): conf_preds from conf layers
+    In float32, with the max of each row instead of the max of the batch: exp() of the rows
+    far below the batch max underflows to 0 in reduced precision (log(0) = -inf).
     """
-    x_max = x.data.max()
-    return torch.log(torch.sum(torch.exp(x-x_max), 1, keepdim=True)) + x_max
+    return torch.logsumexp(x.float(), 1, keepdim=True)
+
+
+def hard_negative_mining(loss_c, pos, negpos_ratio, method='topk'):
+    """Pick the negatives with the highest confidence loss of each image,
+    negpos_ratio of them per positive (at most num_priors-1).
+    Args:
+        loss_c: (tensor) confidence loss of each prior, positives already zeroed, Shape: [batch,num_priors].
+        pos: (tensor) positive priors, Shape: [batch,num_priors].
+        negpos_ratio: (int) number of negatives per positive.
+        method: (str) 'topk': one partial sort, only the top max(num_neg) losses of each row
+            are sorted; 'sort': the former double full sort to get the rank of every prior.
+    Return:
+        neg: (tensor) picked negatives, Shape: [batch,num_priors].
+    Ties: both methods keep exactly num_neg priors per image, when several priors share
+    the loss of the last picked one, which of them are picked is up to the sort/topk kernel.
+    The loss value does not depend on it (equal loss_c is equal cross entropy), only the
+    priors receiving the gradient may change.
+    """
+    num_pos = pos.long().sum(1, keepdim=True)
+    num_neg = torch.clamp(negpos_ratio*num_pos, max=pos.size(1)-1)
+    if method == 'sort':
+        _, loss_idx = loss_c.sort(1, descending=True)
+        _, idx_rank = loss_idx.sort(1)
+        #all pos are kept, only neg with rank > threshold are kept
+        return idx_rank < num_neg.expand_as(idx_rank)
+    k = int(num_neg.max())
+    neg = torch.zeros_like(pos, dtype=torch.bool)
+    if k == 0:
+        return neg
+    _, loss_idx = loss_c.topk(k, dim=1)  # [batch,k], sorted
+    # the first num_neg of the top k of each row
+    picked = torch.arange(k, device=loss_c.device).unsqueeze(0) < num_neg
+    return neg.scatter_(1, loss_idx, picked)
 
 
 # Original author: Francisco Massa:
@@ -264,10 +375,6 @@ def nms(boxes: torch.Tensor, scores: torch.Tensor, overlap: float =0.5, max_per_
     # yy2 = boxes.new()
     # w = boxes.new()
     # h = boxes.new()
-    xx1 = boxes.new_zeros(0)
-    yy1 = boxes.new_zeros(0)
-    xx2 = boxes.new_zeros(0)
-    yy2 = boxes.new_zeros(0)
 
     # keep = torch.Tensor()
     count = 0
@@ -280,10 +387,11 @@ def nms(boxes: torch.Tensor, scores: torch.Tensor, overlap: float =0.5, max_per_
             break
         idx = idx[:-1]  # remove kept element from view
         # load bboxes of next highest vals
-        torch.index_select(x1, 0, idx, out=xx1)
-        torch.index_select(y1, 0, idx, out=yy1)
-        torch.index_select(x2, 0, idx, out=xx2)
-        torch.index_select(y2, 0, idx, out=yy2)
+        # new tensors, not out=: resizing a non empty out tensor warns at every pass
+        xx1 = torch.index_select(x1, 0, idx)
+        yy1 = torch.index_select(y1, 0, idx)
+        xx2 = torch.index_select(x2, 0, idx)
+        yy2 = torch.index_select(y2, 0, idx)
         # store element-wise max with next highest score
         xx1 = torch.clamp(xx1, min=x1[i])
         yy1 = torch.clamp(yy1, min=y1[i])
@@ -307,6 +415,56 @@ def nms(boxes: torch.Tensor, scores: torch.Tensor, overlap: float =0.5, max_per_
     return keep[:count], scores[keep[:count]], count
 
 
+def batched_nms(boxes: torch.Tensor, valid: torch.Tensor, overlap: float =0.5) -> torch.Tensor:
+    """Apply greedy non-maximum suppression to G independent groups of boxes
+    (e.g. every (image, class) pair of a batch) at the same time.
+    Same result as nms() for each group, but the IoU matrix of every group is
+    computed once and suppression is resolved on it with a few batched ops.
+    Args:
+        boxes: (tensor) The location preds of every group, sorted by descending
+            score inside the group, Shape: [G,K,4].
+        valid: (tensor) bool mask of the real candidates (e.g. score > conf_thresh),
+            padded slots are False and never kept nor suppress anything, Shape: [G,K].
+        overlap: (float) The overlap thresh for suppressing unnecessary boxes.
+    Return:
+        keep: (tensor) bool mask of the boxes kept by nms, Shape: [G,K].
+    """
+    # suppress[g, i, j]: box i scores higher than box j and overlaps it too much
+    suppress = batched_jaccard(boxes, boxes).gt(overlap).triu(1) & valid.unsqueeze(2)
+    # a box is kept iff no KEPT higher-scoring box suppresses it. Iterating this
+    # from "keep everything" fixes at least one more box per pass (box 0 is always kept),
+    # and the fixed point is exactly the greedy nms result, so stop as soon as nothing changes
+    keep = valid
+    for _ in range(boxes.size(1)):
+        new_keep = valid & ~(suppress & keep.unsqueeze(2)).any(1)
+        if torch.equal(new_keep, keep):
+            break
+        keep = new_keep
+    return keep
+
+
+def nms_matrix(boxes: torch.Tensor, scores: torch.Tensor, overlap: float =0.5, max_per_image: int =200) -> Tuple[torch.Tensor, torch.Tensor, int]:
+    """Drop-in replacement of nms() (same args and returns), but instead of keeping one
+    box per loop pass, the IoU matrix of the top max_per_image candidates is computed
+    once and suppression is resolved on that matrix (see batched_nms()).
+    Faster when many candidates survive conf_thresh, e.g. conf_thresh=0.01 for mAP evaluation.
+    Args:
+        boxes: (tensor) The location preds for the img, Shape: [num_priors,4].
+        scores: (tensor) The class predscores for the img, Shape:[num_priors].
+        overlap: (float) The overlap thresh for suppressing unnecessary boxes.
+        max_per_image/top_k: (int) The Maximum number of box preds to consider.
+    Return:
+        The indices of the kept boxes with respect to num_priors, their scores and the count.
+    """
+    if boxes.numel() == 0:
+        return scores.new_zeros(scores.size(0)).long(), scores, 0
+    # indices of the top-k largest vals, in descending order
+    _, idx = scores.topk(min(max_per_image, scores.size(0)))
+    valid = torch.ones(1, idx.size(0), dtype=torch.bool, device=idx.device)
+    keep = idx[batched_nms(boxes[idx].unsqueeze(0), valid, overlap)[0]]
+    return keep, scores[keep], keep.size(0)
+
+
 def refine_nms(dets, thresh):
     """Pure Python NMS baseline."""
     x1 = dets[:, 0]
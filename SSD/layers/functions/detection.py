@@ -1,6 +1,6 @@
 import torch
 from torch.autograd import Function
-from ..box_utils import decode, nms
+from ..box_utils import decode, nms, nms_matrix, batched_nms
 from typing import List
 
 @torch.jit.script
@@ -10,8 +10,21 @@ class Detect: #(Function)
     apply non-maximum suppression to location predictions based on conf
     scores and threshold to a top_k/max_per_image number of output predictions for both
     confidence score and locations.
+
+    mode:
+        'loop': (default) for each image, for each class, threshold + nms one by one
+        'batched': threshold, decode and nms every (image, class) pair of the batch together
+            with batched tensor ops, same output as 'loop' (up to ties between equal scores)
+    nms_method: nms used by the 'loop' mode ('batched' always works on IoU matrices)
+        'loop': (default) box_utils.nms, keep one box per loop pass
+        'matrix': box_utils.nms_matrix, compute the IoU matrix of the candidates once
+    top_k: pre-nms budget, only the top_k highest scores of each class in each image are
+        decoded and sent to nms (<= 0: max_per_image, which is what nms considers anyway)
+    keep_top_k: post-nms cap across all classes of an image, only the keep_top_k highest
+        scoring detections are kept, the others are zeroed (<= 0: no cap)
     """
-    def __init__(self, num_classes: int, cfg, max_per_image: int, conf_thresh: float, nms_thresh: float):  #, bkg_label
+    def __init__(self, num_classes: int, cfg, max_per_image: int, conf_thresh: float, nms_thresh: float,
+                 mode: str = 'loop', nms_method: str = 'loop', top_k: int = -1, keep_top_k: int = -1):  #, bkg_label
         self.num_classes = num_classes
         # self.background_label = bkg_label
         self.max_per_image = max_per_image
@@ -22,6 +35,23 @@ class Detect: #(Function)
         self.conf_thresh = conf_thresh
         # self.variance = cfg['variance']
         self.variance = [0.1, 0.2]  #cfg['variance']
+        if mode not in ['loop', 'batched']:
+            raise ValueError('mode must be loop or batched.')
+        self.mode = mode
+        if nms_method not in ['loop', 'matrix']:
+            raise ValueError('nms_method must be loop or matrix.')
+        self.nms_method = nms_method
+        self.top_k = top_k if top_k > 0 else max_per_image
+        self.keep_top_k = keep_top_k
+
+    @torch.jit.unused
+    def __setstate__(self, state):
+        # Detect pickled with a whole model before mode/nms_method/top_k/keep_top_k: the defaults
+        self.__dict__.update(state)
+        self.__dict__.setdefault('mode', 'loop')
+        self.__dict__.setdefault('nms_method', 'loop')
+        self.__dict__.setdefault('top_k', self.max_per_image)
+        self.__dict__.setdefault('keep_top_k', -1)
 
     # def forward(self, loc_data, conf_data, prior_data):
     # def forward(self, loc_data: torch.Tensor, conf_data: torch.Tensor, prior_data: torch.Tensor):   #-> torch.Tensor
@@ -35,6 +65,11 @@ class Detect: #(Function)
             prior_data: (tensor) Prior boxes and variances from priorbox layers
                 Shape: [1,num_priors,4]
         """
+        # no autograd through the post-processing, detach() instead of a torch.no_grad() block,
+        # which the lite interpreter (models/export.py) doesn't support
+        loc_data, conf_data, prior_data = loc_data.detach(), conf_data.detach(), prior_data.detach()
+        if self.mode == 'batched':
+            return self.detect_batched(loc_data, conf_data, prior_data)
         num = loc_data.size(0)  # batch size
         num_priors = prior_data.size(0)
         # top_k is 200 by default, num is 1 when testing because image input one by one
@@ -42,43 +77,106 @@ class Detect: #(Function)
         # for each sample, every prior box will have #num_classes conf. scores for it
         conf_preds = conf_data.view(num, num_priors,
                                     self.num_classes).transpose(2, 1)
-        # Decode predictions into bboxes based on loc_data(offsets) and prior_data
+        k = min(self.top_k, num_priors)
         for i in range(num): # for each batch
-            decoded_boxes = decode(loc_data[i], prior_data, self.variance)
             # For each class, perform nms to get bbox for this class
             conf_scores = conf_preds[i].clone() # conf_scores = (num_classes, num_priors)
+            # only the top_k highest scores of each class are candidates, one topk for all classes
+            # sorted in descending order, so the scores greater than threshold are a prefix
+            top_scores, top_ids = conf_scores[1:].topk(k, dim=1) # (num_classes-1, k)
+            cand_mask = top_scores.gt(self.conf_thresh)
+            num_cands = cand_mask.sum(1)
+            # decode on demand: the union of the candidate priors of all classes is decoded once,
+            # prior_row maps a prior index to its row in decoded_boxes
+            cand_priors = top_ids[cand_mask]
+            if cand_priors.size(0) == 0:
+                continue
+            used = torch.zeros(num_priors, dtype=torch.bool, device=cand_priors.device)
+            used[cand_priors] = True
+            union = used.nonzero().view(-1)
+            decoded_boxes = decode(loc_data[i][union], prior_data[union], self.variance)
+            prior_row = torch.zeros(num_priors, dtype=torch.long, device=union.device)
+            prior_row[union] = torch.arange(union.size(0), device=union.device)
 
             for cl in range(1, self.num_classes):
             # for _,cl in enumerate([i for i in range(self.num_classes)]):
-                # for particular class, keep those boxes with score greater than threshold
-                c_mask = conf_scores[cl].gt(self.conf_thresh)
-                # scores are those higher than threshold
-                scores = conf_scores[cl][c_mask]
+                num_cand = int(num_cands[cl - 1])
                 # for this class, no object of this class exists in this image, because all scores < threshold
-                # if scores.dim() == 0:
-                if scores.size(0) == 0:
+                if num_cand == 0:
                     continue
-                #if scores.size(0) == 0:
-                #    continue
-                l_mask = c_mask.unsqueeze(1).expand_as(decoded_boxes)
+                # scores are those higher than threshold
+                scores = top_scores[cl - 1, :num_cand]
                 #step 1. remaining boxes for reasonable classes's objects, boxes being kept after conf_thresh
-                boxes = decoded_boxes[l_mask].view(-1, 4)
+                boxes = decoded_boxes[prior_row[top_ids[cl - 1, :num_cand]]]
                 #step 2. use NMS to remove redundant boxes bounding the same class's object
                 # idx of highest scoring and non-overlapping boxes per class
                 # ids, count = nms(boxes, scores, self.nms_thresh, self.max_per_image)
-                with torch.no_grad():    
-                    ids, scores, count = nms(boxes, scores, self.nms_thresh, self.max_per_image)
-                    output[i, cl, :count] = \
-                    torch.cat((scores.unsqueeze(1), boxes[ids]), 1)
-                    # torch.cat((scores[ids[:count]].unsqueeze(1),
-                            #    boxes[ids[:count]]), 1)
-        flt = output.contiguous().view(num, -1, 5)
-        _, idx = flt[:, :, 0].sort(1, descending=True)
-        _, rank = idx.sort(1)
-        flt[(rank < self.max_per_image).unsqueeze(-1).expand_as(flt)].fill_(0) # this code has no effect
-        return output # before
+                if self.nms_method == 'matrix':
+                    ids, scores, count = nms_matrix(boxes, scores, self.nms_thresh, k)
+                else:
+                    ids, scores, count = nms(boxes, scores, self.nms_thresh, k)
+                # top_k may be larger than max_per_image
+                count = min(count, self.max_per_image)
+                output[i, cl, :count] = \
+                torch.cat((scores[:count].unsqueeze(1), boxes[ids[:count]]), 1)
+        return self.keep_top_detections(output) # before
         #return flt # after
 
+    def detect_batched(self, loc_data: torch.Tensor, conf_data: torch.Tensor, prior_data: torch.Tensor) -> torch.Tensor:
+        """
+        Same as __call__ but without the python loops over images and classes:
+        every (image, class) pair becomes one group of at most max_per_image candidates.
+        Args:
+            loc_data: (tensor) Loc preds from loc layers
+                Shape: [batch,num_priors,4]
+            conf_data: (tensor) Shape: Conf preds from conf layers
+                Shape: [batch,num_priors,num_classes]
+            prior_data: (tensor) Prior boxes and variances from priorbox layers
+                Shape: [num_priors,4]
+        """
+        num = loc_data.size(0)  # batch size
+        num_priors = prior_data.size(0)
+        num_groups = num * (self.num_classes - 1) # skip background
+        output = torch.zeros(num, self.num_classes, self.max_per_image, 5,
+                             dtype=loc_data.dtype, device=loc_data.device)
+        # [batch, num_classes-1, num_priors], scores under threshold can never be picked
+        conf_preds = conf_data.view(num, num_priors, self.num_classes).transpose(2, 1)[:, 1:]
+        conf_preds = conf_preds.masked_fill(conf_preds.le(self.conf_thresh), -1.)
+        # step 1. nms only looks at the top_k highest scores of each class,
+        # so pick them for all pairs at once, already sorted in descending order
+        k = min(self.top_k, num_priors)
+        scores, idx = conf_preds.topk(k, dim=2)  # [batch, num_classes-1, k]
+        valid = scores.gt(self.conf_thresh).view(num_groups, k)
+        # step 2. decode only the picked boxes
+        idx = idx.reshape(num, -1)
+        loc = loc_data.gather(1, idx.unsqueeze(2).expand(num, idx.size(1), 4))
+        boxes = decode(loc.view(-1, 4), prior_data[idx.view(-1)], self.variance).view(num_groups, k, 4)
+        # step 3. nms inside every group
+        keep = batched_nms(boxes, valid, self.nms_thresh)
+        # step 4. move the kept boxes to the front of their group, keep their score order
+        # dropped boxes are sent to an extra slot k which is cut off afterwards
+        dst = torch.where(keep, keep.long().cumsum(1) - 1, torch.full_like(idx.view(num_groups, k), k))
+        dets = torch.cat((scores.view(num_groups, k, 1), boxes), 2)
+        packed = dets.new_zeros(num_groups, k + 1, 5).scatter_(1, dst.unsqueeze(2).expand(num_groups, k, 5), dets)
+        # top_k may be larger than max_per_image
+        k = min(k, self.max_per_image)
+        output[:, 1:, :k] = packed[:, :k].reshape(num, self.num_classes - 1, k, 5)
+        return self.keep_top_detections(output)
+
+    def keep_top_detections(self, output: torch.Tensor) -> torch.Tensor:
+        """
+        Zero every detection of an image that is not among its keep_top_k highest scores
+        over all classes. Shape of output: [batch,num_classes,max_per_image,5]
+        """
+        num = output.size(0)
+        flt = output.view(num, -1, 5)
+        if self.keep_top_k <= 0 or self.keep_top_k >= flt.size(1):
+            return output
+        _, idx = flt[:, :, 0].topk(self.keep_top_k, dim=1)
+        keep = torch.zeros(num, flt.size(1), dtype=torch.bool, device=flt.device).scatter_(1, idx, True)
+        flt.masked_fill_(~keep.unsqueeze(2), 0.)
+        return output
+
 
 
 # class Detect: #(Function)
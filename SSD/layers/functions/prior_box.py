@@ -1,8 +1,24 @@
 from __future__ import division
 from math import sqrt as sqrt
-from itertools import product as product
 import torch
 
+# process-wide cache of prior boxes, every model built with the same config shares them
+# key: prior_key(cfg), value: {(device, dtype): priors}, the float32 cpu priors are always there
+_PRIORS_CACHE = {}
+
+
+def prior_key(cfg):
+    """Only the config fields which change the prior boxes, as a hashable tuple
+    """
+    return (cfg['min_dim'],
+            tuple(cfg['feature_maps']),
+            tuple(cfg['steps']),
+            tuple(cfg['min_sizes']),
+            tuple(cfg['max_sizes']) if cfg['max_sizes'] else (),
+            tuple(tuple(ar) for ar in cfg['aspect_ratios']),
+            bool(cfg['clip']))
+
+
 # choosing scales and aspect_ratios for default boxes here
 # create default boxes
 class PriorBox(object):
@@ -22,40 +38,73 @@ class PriorBox(object):
         self.aspect_ratios = cfg['aspect_ratios']
         self.clip = cfg['clip']
         self.version = cfg['name']
+        self.key = prior_key(cfg)
         for v in self.variance:
             if v <= 0:
                 raise ValueError('Variances must be greater than 0')
 
-    def forward(self):
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'key' not in state: # pickled with a whole model before the cache
+            self.key = prior_key({'min_dim': self.image_size, 'feature_maps': self.feature_maps,
+                                  'steps': self.steps, 'min_sizes': self.min_sizes,
+                                  'max_sizes': self.max_sizes, 'aspect_ratios': self.aspect_ratios,
+                                  'clip': self.clip})
+
+    def forward(self, device=None, dtype=torch.float32):
+        """
+        Return the prior boxes [num_priors,4] on device with dtype. They are computed once
+        per config and then served from the cache, so the same tensor is returned to every
+        caller: don't modify it in place.
+        device None: the device of the default tensor type, like torch.Tensor(list) before
+        (cuda under torch.set_default_tensor_type('torch.cuda.FloatTensor'))
+        """
+        device = torch.empty(0).device if device is None else torch.device(device)
+        priors = _PRIORS_CACHE.get(self.key)
+        if priors is None:
+            priors = {(torch.device('cpu'), torch.float32): self.generate()}
+            _PRIORS_CACHE[self.key] = priors
+        output = priors.get((device, dtype))
+        if output is None:
+            output = priors[(torch.device('cpu'), torch.float32)].to(device=device, dtype=dtype)
+            priors[(device, dtype)] = output
+        return output
+
+    def generate(self):
+        """
+        Same boxes and order as the former loops: for each feature map k, for each location
+        (i: row, j: column), the boxes of aspect ratio 1 with min size and max size, then
+        the pair of boxes for each other aspect ratio
+        """
         mean = []
         for k, f in enumerate(self.feature_maps):# use k feature map for prediction
-            # per feature map location
-            for i, j in product(range(f), repeat=2):#nested loop with (A, A) where A in range(f)
-                f_k = self.image_size / self.steps[k] #size of k-th square feature map
-                # unit center x,y
-                cx = (j + 0.5) / f_k
-                cy = (i + 0.5) / f_k
-
-                # aspect_ratio: 1
-                # rel size: min_size
-                # when k = 1, s_k = s_min
-                s_k = self.min_sizes[k]/self.image_size # this is s_min i.e. min scale in fact
-                mean += [cx, cy, s_k, s_k]# because aspect_ratio is 1, so width = height
-
-                # aspect_ratio: 1
-                # rel size: sqrt(s_k * s_(k+1))
-                # when k = m, s_k = s_max
-                if self.max_sizes:
-                    s_k_prime = sqrt(s_k * (self.max_sizes[k]/self.image_size)) # this is s_max i.e. max scale in fact
-                    mean += [cx, cy, s_k_prime, s_k_prime]# because aspect_ratio is 1, so width = height
-
-                # rest of aspect ratios other than 1 and m, which means 2 ~ m-1
-                for ar in self.aspect_ratios[k]:
-                    mean += [cx, cy, s_k*sqrt(ar), s_k/sqrt(ar)]
-                    mean += [cx, cy, s_k/sqrt(ar), s_k*sqrt(ar)]
-        # back to torch land
-        # 6 default boxes (there are 6 [] in mean)
-        output = torch.Tensor(mean).view(-1, 4)
+            f_k = self.image_size / self.steps[k] #size of k-th square feature map
+            # unit center x,y of every location, in double like the python floats before
+            # explicit cpu: the cache stores them as the cpu priors whatever the default tensor type
+            i, j = torch.meshgrid(torch.arange(f, dtype=torch.float64, device='cpu'),
+                                  torch.arange(f, dtype=torch.float64, device='cpu'), indexing='ij')
+            cx = ((j + 0.5) / f_k).reshape(-1, 1)
+            cy = ((i + 0.5) / f_k).reshape(-1, 1)
+
+            # aspect_ratio: 1
+            # rel size: min_size
+            s_k = self.min_sizes[k]/self.image_size # this is s_min i.e. min scale in fact
+            wh = [[s_k, s_k]]# because aspect_ratio is 1, so width = height
+            # aspect_ratio: 1
+            # rel size: sqrt(s_k * s_(k+1))
+            if self.max_sizes:
+                s_k_prime = sqrt(s_k * (self.max_sizes[k]/self.image_size)) # this is s_max i.e. max scale in fact
+                wh += [[s_k_prime, s_k_prime]]
+            # rest of aspect ratios other than 1
+            for ar in self.aspect_ratios[k]:
+                wh += [[s_k*sqrt(ar), s_k/sqrt(ar)], [s_k/sqrt(ar), s_k*sqrt(ar)]]
+            wh = torch.tensor(wh, dtype=torch.float64, device='cpu')
+            # [f*f, boxes per location, 4]
+            boxes = torch.cat((torch.cat((cx, cy), 1).unsqueeze(1).expand(-1, wh.size(0), 2),
+                               wh.unsqueeze(0).expand(cx.size(0), -1, 2)), 2)
+            mean.append(boxes.reshape(-1, 4))
+        # back to float like torch.Tensor(list) did
+        output = torch.cat(mean, 0).float()
         if self.clip:
             output.clamp_(max=1, min=0)
         return output
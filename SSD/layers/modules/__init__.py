@@ -1,5 +1,6 @@
 from .l2norm import L2Norm
 from .multibox_loss import MultiBoxLoss
 from .refine_multibox_loss import RefineMultiBoxLoss
+from .multibox_head import MultiBoxHead
 
-__all__ = ['L2Norm', 'MultiBoxLoss', 'RefineMultiBoxLoss']
+__all__ = ['L2Norm', 'MultiBoxLoss', 'RefineMultiBoxLoss', 'MultiBoxHead']
@@ -18,8 +18,13 @@ class L2Norm(nn.Module):
         init.constant(self.weight,self.gamma)
 
     def forward(self, x):
+        # in float32 under autocast: the sum of squares overflows float16 and eps underflows it
+        dtype = x.dtype
+        x = x.float()
         norm = x.pow(2).sum(dim=1, keepdim=True).sqrt()+self.eps
         #x /= norm
         x = torch.div(x,norm)
-        out = self.weight.unsqueeze(0).unsqueeze(2).unsqueeze(3).expand_as(x) * x
-        return out
+        if self.weight is None: # scale folded into the next convs, see models/fusion.py
+            return x.to(dtype)
+        out = self.weight.float().unsqueeze(0).unsqueeze(2).unsqueeze(3).expand_as(x) * x
+        return out.to(dtype)
@@ -0,0 +1,54 @@
+import torch
+import torch.nn as nn
+from typing import List, Tuple
+
+
+# one conv per source instead of a loc conv and a conf conv, for inference
+class MultiBoxHead(nn.Module):
+    """loc and conf convs of the SSD multibox head merged into one conv per source layer
+
+    The output channels of the merged conv of a source are ordered per default box:
+    [4 loc, num_classes conf] of box 0, then of box 1, ... so that its output, permuted to
+    [batch,H,W,channels], is already the [batch,H*W*boxes,4+num_classes] block of the source:
+    it is written with one copy at its precomputed offset in the output buffer, instead of the
+    permute().contiguous(), view() and torch.cat() of each loc and conf output.
+
+    Args:
+        loc: (list of nn.Conv2d) loc conv of each source layer
+        conf: (list of nn.Conv2d) conf conv of each source layer
+        num_classes: number of classes, background included
+        feature_maps: (list of int) size of each source layer, cfg['feature_maps']
+    Return (of forward):
+        loc: Shape: [batch,num_priors,4], conf: Shape: [batch,num_priors,num_classes],
+        two views of one [batch,num_priors,4+num_classes] tensor, same values as the separate convs
+    """
+
+    def __init__(self, loc, conf, num_classes, feature_maps):
+        super(MultiBoxHead, self).__init__()
+        self.num_classes = num_classes
+        heads = []
+        offsets = [0]
+        for l, c, f in zip(loc, conf, feature_maps):
+            boxes = l.out_channels // 4
+            head = nn.Conv2d(l.in_channels, boxes * (4 + num_classes), l.kernel_size,
+                             stride=l.stride, padding=l.padding, dilation=l.dilation)
+            # box b: loc channels [4b, 4b+4) and conf channels [cb, cb+c)
+            weight = torch.cat([l.weight.data.reshape(boxes, 4, -1), c.weight.data.reshape(boxes, num_classes, -1)], 1)
+            bias = torch.cat([l.bias.data.view(boxes, 4), c.bias.data.view(boxes, num_classes)], 1)
+            head.weight.data.copy_(weight.view_as(head.weight))
+            head.bias.data.copy_(bias.view(-1))
+            heads.append(head)
+            offsets.append(offsets[-1] + f * f * boxes)
+        self.heads = nn.ModuleList(heads)
+        self.offsets: List[int] = offsets # first prior of each source, num_priors last
+
+    def forward(self, sources: List[torch.Tensor]) -> Tuple[torch.Tensor, torch.Tensor]:
+        ys = [head(sources[i]) for i, head in enumerate(self.heads)]
+        # dtype of the convs, float16 under autocast
+        out = torch.empty(ys[0].size(0), self.offsets[-1], 4 + self.num_classes,
+                          dtype=ys[0].dtype, device=ys[0].device)
+        for i, y in enumerate(ys):
+            # [batch,H,W,boxes*(4+num_classes)] view of the block of the source in out
+            out[:, self.offsets[i]:self.offsets[i + 1]].view(y.size(0), y.size(2), y.size(3), y.size(1)) \
+                .copy_(y.permute(0, 2, 3, 1))
+        return out[:, :, :4], out[:, :, 4:]
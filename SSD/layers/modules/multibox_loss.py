@@ -4,7 +4,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
 from data import coco as cfg
-from ..box_utils import match, log_sum_exp
+from ..box_utils import batched_match, pad_targets, log_sum_exp, hard_negative_mining
 
 #loss function
 class MultiBoxLoss(nn.Module):
@@ -27,12 +27,13 @@ class MultiBoxLoss(nn.Module):
             l: predicted boxes,
             g: ground truth boxes
             N: number of matched default boxes
+        mining: 'topk' (default) or 'sort', see box_utils.hard_negative_mining
         See: https://arxiv.org/pdf/1512.02325.pdf for more details.
     """
 
     def __init__(self, num_classes, overlap_thresh, prior_for_matching,
                  bkg_label, neg_mining, neg_pos, neg_overlap, encode_target,
-                 use_gpu=True):
+                 use_gpu=True, mining='topk'):
         super(MultiBoxLoss, self).__init__()
         self.use_gpu = use_gpu
         self.num_classes = num_classes
@@ -44,6 +45,9 @@ class MultiBoxLoss(nn.Module):
         self.negpos_ratio = neg_pos
         self.neg_overlap = neg_overlap
         self.variance = cfg['variance']
+        if mining not in ['topk', 'sort']:
+            raise ValueError('mining must be topk or sort.')
+        self.mining = mining
 
     def forward(self, predictions, targets):
         """Multibox Loss
@@ -54,30 +58,28 @@ class MultiBoxLoss(nn.Module):
                 loc shape: torch.size(batch_size,num_priors,4)
                 priors shape: torch.size(num_priors,4)
 
-            targets (tensor): Ground truth boxes and labels for a batch,
-                shape: [batch_size,num_objs,5] (last idx is the label).
+            targets (list of tensors or tuple): Ground truth boxes and labels of each image,
+                shape: [num_objs,5] (last idx is the label), or already padded like
+                data.padded_collate: (targets [batch_size,max_objs,5], num_objs [batch_size]).
         """
         loc_data, conf_data, priors = predictions
+        # the loss in float32 when the predictions come from autocast
+        loc_data, conf_data = loc_data.float(), conf_data.float()
         num = loc_data.size(0)#batch size
         priors = priors[:loc_data.size(1), :]
         num_priors = (priors.size(0))
         num_classes = self.num_classes
 
         # match priors (default boxes) and ground truth boxes
-        loc_t = torch.Tensor(num, num_priors, 4)
-        conf_t = torch.LongTensor(num, num_priors)
-        for idx in range(num):
-            truths = targets[idx][:, :-1].data
-            labels = targets[idx][:, -1].data
-            defaults = priors.data
-            match(self.threshold, truths, defaults, self.variance, labels,
-                  loc_t, conf_t, idx)
-        if self.use_gpu:
-            loc_t = loc_t.cuda()
-            conf_t = conf_t.cuda()
-        # wrap targets
-        loc_t = Variable(loc_t, requires_grad=False)
-        conf_t = Variable(conf_t, requires_grad=False)
+        # the whole batch at once, directly on the device of the predictions
+        if isinstance(targets, tuple):
+            targets, num_objs = targets
+            targets = targets.to(loc_data.device, torch.float32, non_blocking=True)
+            num_objs = num_objs.to(loc_data.device, non_blocking=True)
+        else:
+            targets, num_objs = pad_targets([t.data.to(loc_data.device) for t in targets])
+        loc_t, conf_t = batched_match(self.threshold, targets[:, :, :-1], priors.data.to(loc_data.device),
+                                      self.variance, targets[:, :, -1], num_objs)
 
         pos = conf_t > 0
 
@@ -86,7 +88,7 @@ class MultiBoxLoss(nn.Module):
         pos_idx = pos.unsqueeze(pos.dim()).expand_as(loc_data)
         loc_p = loc_data[pos_idx].view(-1, 4)
         loc_t = loc_t[pos_idx].view(-1, 4)
-        loss_l = F.smooth_l1_loss(loc_p, loc_t, size_average=False) #smooth_l1_loss between target location and predicted location
+        loss_l = F.smooth_l1_loss(loc_p, loc_t, reduction='sum') #smooth_l1_loss between target location and predicted location
 
         # Compute max conf across batch for hard negative mining
         batch_conf = conf_data.view(-1, self.num_classes)
@@ -96,23 +98,19 @@ class MultiBoxLoss(nn.Module):
         loss_c = loss_c.view(num, -1) #resize
         loss_c[pos] = 0  # filter out pos boxes for now
         #loss_c[pos.view(-1)] = 0  # filter out pos boxes for now
-        _, loss_idx = loss_c.sort(1, descending=True)
-        _, idx_rank = loss_idx.sort(1)
         num_pos = pos.long().sum(1, keepdim=True)
-        num_neg = torch.clamp(self.negpos_ratio*num_pos, max=pos.size(1)-1)
-        #all pos are kept, only neg with rank > threshold are kept
-        neg = idx_rank < num_neg.expand_as(idx_rank) #those > idx_rank is 1, others are 0
+        neg = hard_negative_mining(loss_c, pos, self.negpos_ratio, self.mining)
 
         # Confidence Loss Including Positive and Negative Examples
         pos_idx = pos.unsqueeze(2).expand_as(conf_data)
         neg_idx = neg.unsqueeze(2).expand_as(conf_data)
         conf_p = conf_data[(pos_idx+neg_idx).gt(0)].view(-1, self.num_classes)
         targets_weighted = conf_t[(pos+neg).gt(0)]
-        loss_c = F.cross_entropy(conf_p, targets_weighted, size_average=False)
+        loss_c = F.cross_entropy(conf_p, targets_weighted, reduction='sum')
 
         # Sum of losses: L(x,c,l,g) = (Lconf(x, c) + αLloc(x,l,g)) / N
 
-        N = num_pos.data.sum()
+        N = num_pos.data.sum().clamp(min=1).float() # a batch without positive is 0 loss, not nan
         #N = N.float()# for pytorch 0.4
         loss_l /= N
         loss_c /= N
@@ -3,7 +3,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
-from ..box_utils import match, refine_match, log_sum_exp, decode
+from ..box_utils import match, refine_match, log_sum_exp, decode, hard_negative_mining
 
 from data import coco as cfg # TODO: for self.variance, need to udpate for different dataset
 
@@ -27,11 +27,12 @@ class RefineMultiBoxLoss(nn.Module):
             l: predicted boxes,
             g: ground truth boxes
             N: number of matched default boxes
+        mining: 'topk' (default) or 'sort', see box_utils.hard_negative_mining
     """
 
     def __init__(self, num_classes, overlap_thresh, prior_for_matching,
                  bkg_label, neg_mining, neg_pos, neg_overlap, encode_target,
-                 object_score = 0, use_gpu=True):
+                 object_score = 0, use_gpu=True, mining='topk'):
         super(RefineMultiBoxLoss, self).__init__()
         self.use_gpu = use_gpu
         self.num_classes = num_classes
@@ -44,6 +45,9 @@ class RefineMultiBoxLoss(nn.Module):
         self.neg_overlap = neg_overlap
         self.object_score = object_score
         self.variance = [0.1,0.2]
+        if mining not in ['topk', 'sort']:
+            raise ValueError('mining must be topk or sort.')
+        self.mining = mining
 
     def forward(self, odm_data, priors, targets, arm_data = None, filter_object = False):
         """Multibox Loss for RefineSSD
@@ -64,9 +68,12 @@ class RefineMultiBoxLoss(nn.Module):
         """
 
         loc_data, conf_data = odm_data
+        # the loss in float32 when the predictions come from autocast
+        loc_data, conf_data = loc_data.float(), conf_data.float()
         # when base on ARM filtering result
         if arm_data:
             arm_loc, arm_conf = arm_data
+            arm_loc = arm_loc.float() # decoded by refine_match
         #priors = priors.data[:loc_data.size(1), :]
         priors = priors.data
         num = loc_data.size(0) #batch size
@@ -114,20 +121,18 @@ class RefineMultiBoxLoss(nn.Module):
         pos_idx = pos.unsqueeze(pos.dim()).expand_as(loc_data)
         loc_p = loc_data[pos_idx].view(-1,4)# filtering
         loc_t = loc_t[pos_idx].view(-1,4)
-        loss_l = F.smooth_l1_loss(loc_p, loc_t, size_average=False)
+        loss_l = F.smooth_l1_loss(loc_p, loc_t, reduction='sum')
 
         # Compute max conf across batch for hard negative mining
         batch_conf = conf_data.view(-1,self.num_classes) # batch_size*num_priors
         loss_c = log_sum_exp(batch_conf) - batch_conf.gather(1, conf_t.view(-1,1))# get the score indicated by the list named conf_t
 
         # Hard Negative Mining
-        loss_c[pos] = 0 # filter out pos boxes for now
         loss_c = loss_c.view(num, -1)
-        _,loss_idx = loss_c.sort(1, descending=True)# only sort within every image, so that filter negative based on one image itself
-        _,idx_rank = loss_idx.sort(1)# so that as long as the number itself < num_neg, the loss it represents should be kept
+        loss_c[pos] = 0 # filter out pos boxes for now
+        # only rank within every image, so that filter negative based on one image itself
         num_pos = pos.long().sum(1,keepdim=True)
-        num_neg = torch.clamp(self.negpos_ratio*num_pos, max=pos.size(1)-1)# keep how many neg example
-        neg = idx_rank < num_neg.expand_as(idx_rank)
+        neg = hard_negative_mining(loss_c, pos, self.negpos_ratio, self.mining)
 
         # Confidence Loss Including Positive and Negative Examples
         pos_idx = pos.unsqueeze(2).expand_as(conf_data) # pos_idx only focus on pos samples
@@ -135,10 +140,10 @@ class RefineMultiBoxLoss(nn.Module):
         # so adding them tgt won't affect each other, but doing combination
         conf_p = conf_data[(pos_idx+neg_idx).gt(0)].view(-1,self.num_classes) # score for every class for each box
         targets_weighted = conf_t[(pos+neg).gt(0)] # only the target label
-        loss_c = F.cross_entropy(conf_p, targets_weighted, size_average=False)
+        loss_c = F.cross_entropy(conf_p, targets_weighted, reduction='sum')
 
         # Sum of losses: L(x,c,l,g) = (Lconf(x, c) + αLloc(x,l,g)) / N
-        N = num_pos.data.sum()
+        N = num_pos.data.sum().clamp(min=1).float() # a batch without positive is 0 loss, not nan
         loss_l/=N
         loss_c/=N
         return loss_l,loss_c
@@ -45,10 +45,16 @@ class SSD_MobN1(nn.Module):
 
         self.loc = nn.ModuleList(head[0])#loc conv layer
         self.conf = nn.ModuleList(head[1])#conf conv layer
+        self.head = None # MultiBoxHead replacing loc and conf, set by fuse_multibox_heads()
 
         #if phase == 'test':
         self.softmax = nn.Softmax(dim=-1)
-        self.detect = Detect(num_classes, 0, self.cfg, max_per_image, 0.01, 0.45)
+        self.detect = Detect(num_classes, self.cfg, max_per_image, 0.01, 0.45)  #,0
+
+    def __setstate__(self, state):
+        super(SSD_MobN1, self).__setstate__(state)
+        if not hasattr(self, 'head'): # whole model pickled before the MultiBoxHead
+            self.head = None
 
     def forward(self, x, test=False):
         """Applies network layers and ops on input image(s) x.
@@ -90,14 +96,18 @@ class SSD_MobN1(nn.Module):
             if k % 2 == 1:
                 sources.append(x)
 
-        # apply multibox head to source layers
-        for (x, l, c) in zip(sources, self.loc, self.conf):
-            # l and c is two conv layers
-            loc.append(l(x).permute(0, 2, 3, 1).contiguous()) # store the output of loc conv layer
-            conf.append(c(x).permute(0, 2, 3, 1).contiguous()) # store the output of conf conv layer
-
-        loc = torch.cat([o.view(o.size(0), -1) for o in loc], 1)
-        conf = torch.cat([o.view(o.size(0), -1) for o in conf], 1)
+        if self.head is not None:
+            # loc + conf convs merged at inference (MultiBoxHead, see models/fusion.py)
+            loc, conf = self.head(sources)
+        else:
+            # apply multibox head to source layers
+            for (x, l, c) in zip(sources, self.loc, self.conf):
+                # l and c is two conv layers
+                loc.append(l(x).permute(0, 2, 3, 1).contiguous()) # store the output of loc conv layer
+                conf.append(c(x).permute(0, 2, 3, 1).contiguous()) # store the output of conf conv layer
+
+            loc = torch.cat([o.view(o.size(0), -1) for o in loc], 1)
+            conf = torch.cat([o.view(o.size(0), -1) for o in conf], 1)
         #if self.phase == "test":
         if test:
             output = self.detect(
@@ -148,10 +158,16 @@ class SSD_MobN2(nn.Module):
 
         self.loc = nn.ModuleList(head[0])#loc conv layer
         self.conf = nn.ModuleList(head[1])#conf conv layer
+        self.head = None # MultiBoxHead replacing loc and conf, set by fuse_multibox_heads()
 
         #if phase == 'test':
         self.softmax = nn.Softmax(dim=-1)
-        self.detect = Detect(num_classes, 0, self.cfg, max_per_image, 0.01, 0.45)
+        self.detect = Detect(num_classes, self.cfg, max_per_image, 0.01, 0.45)  #,0
+
+    def __setstate__(self, state):
+        super(SSD_MobN2, self).__setstate__(state)
+        if not hasattr(self, 'head'): # whole model pickled before the MultiBoxHead
+            self.head = None
 
     def forward(self, x, test=False):
         """Applies network layers and ops on input image(s) x.
@@ -178,14 +194,18 @@ class SSD_MobN2(nn.Module):
             if k % 2 == 1:
                 sources.append(x)
 
-        # apply multibox head to source layers
-        for (x, l, c) in zip(sources, self.loc, self.conf):
-            # l and c is two conv layers
-            loc.append(l(x).permute(0, 2, 3, 1).contiguous()) # store the output of loc conv layer
-            conf.append(c(x).permute(0, 2, 3, 1).contiguous()) # store the output of conf conv layer
-
-        loc = torch.cat([o.view(o.size(0), -1) for o in loc], 1)
-        conf = torch.cat([o.view(o.size(0), -1) for o in conf], 1)
+        if self.head is not None:
+            # loc + conf convs merged at inference (MultiBoxHead, see models/fusion.py)
+            loc, conf = self.head(sources)
+        else:
+            # apply multibox head to source layers
+            for (x, l, c) in zip(sources, self.loc, self.conf):
+                # l and c is two conv layers
+                loc.append(l(x).permute(0, 2, 3, 1).contiguous()) # store the output of loc conv layer
+                conf.append(c(x).permute(0, 2, 3, 1).contiguous()) # store the output of conf conv layer
+
+            loc = torch.cat([o.view(o.size(0), -1) for o in loc], 1)
+            conf = torch.cat([o.view(o.size(0), -1) for o in conf], 1)
         #if self.phase == "test":
         if test:
             output = self.detect(
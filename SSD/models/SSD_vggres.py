@@ -45,10 +45,17 @@ class SSD_VGG(nn.Module):
 
         self.loc = nn.ModuleList(head[0])#loc conv layer
         self.conf = nn.ModuleList(head[1])#conf conv layer
+        self.head = None # MultiBoxHead replacing loc and conf, set by fuse_multibox_heads()
 
         # if phase == 'test':
         self.softmax = nn.Softmax(dim=-1)      
         self.detect = Detect(num_classes, self.cfg, max_per_image, 0.01, 0.45)  #,0
+
+    def __setstate__(self, state):
+        super(SSD_VGG, self).__setstate__(state)
+        if not hasattr(self, 'head'): # whole model pickled before the MultiBoxHead
+            self.head = None
+
     # @torch.jit.unused
     # @torch.jit.ignore
     # def detect_forward(self, loc, conf, priors):
@@ -125,25 +132,29 @@ class SSD_VGG(nn.Module):
         #         # c is a conv layer
         #         conf.append(c(x).permute(0, 2, 3, 1).contiguous()) # store the output of conf conv layer
                 
-        loc = []
-        conf = []
-        i = 0
-        for l in self.loc:
-            s = sources[i]
-            loc.append(l(s).permute(0, 2, 3, 1).contiguous()) # store the output of loc conv layer
-            i += 1
-
-        i = 0
-        for c in self.conf:
-            s = sources[i]
-            conf.append(c(s).permute(0, 2, 3, 1).contiguous()) # store the output of conf conv layer
-            i += 1
-        # for x in sources:
-        #     loc.append(self.loc(x).permute(0, 2, 3, 1).contiguous())
-        #     conf.append(self.conf(x).permute(0, 2, 3, 1).contiguous())
+        if self.head is not None:
+            # loc + conf convs merged at inference (MultiBoxHead, see models/fusion.py)
+            loc, conf = self.head(sources)
+        else:
+            loc = []
+            conf = []
+            i = 0
+            for l in self.loc:
+                s = sources[i]
+                loc.append(l(s).permute(0, 2, 3, 1).contiguous()) # store the output of loc conv layer
+                i += 1
+
+            i = 0
+            for c in self.conf:
+                s = sources[i]
+                conf.append(c(s).permute(0, 2, 3, 1).contiguous()) # store the output of conf conv layer
+                i += 1
+            # for x in sources:
+            #     loc.append(self.loc(x).permute(0, 2, 3, 1).contiguous())
+            #     conf.append(self.conf(x).permute(0, 2, 3, 1).contiguous())
             
-        loc = torch.cat([o.view(o.size(0), -1) for o in loc], 1)
-        conf = torch.cat([o.view(o.size(0), -1) for o in conf], 1)
+            loc = torch.cat([o.view(o.size(0), -1) for o in loc], 1)
+            conf = torch.cat([o.view(o.size(0), -1) for o in conf], 1)
         if self.phase == "test":
         # if test:
         #   with torch.no_grad():
@@ -151,7 +162,7 @@ class SSD_VGG(nn.Module):
             # detection_output = self.detect_forward(
                 loc.view(loc.size(0), -1, 4),                   # loc preds
                 self.softmax(conf.view(conf.size(0), -1, self.num_classes)),   # conf preds
-                self.priors.to(x.dtype)  #.type(type(x.data))                  # default boxes
+                self.priors.to(loc.dtype)  #.type(type(x.data))                  # default boxes, x is int8 once quantized
             # )
             ), None, None)
             # output = (detection_output, None, None)
@@ -199,10 +210,16 @@ class SSD_RESNET(nn.Module):
 
         self.loc = nn.ModuleList(head[0])#loc conv layer
         self.conf = nn.ModuleList(head[1])#conf conv layer
+        self.head = None # MultiBoxHead replacing loc and conf, set by fuse_multibox_heads()
 
         #if phase == 'test':
         self.softmax = nn.Softmax(dim=-1)
-        self.detect = Detect(num_classes, 0, self.cfg, max_per_image, 0.01, 0.45)
+        self.detect = Detect(num_classes, self.cfg, max_per_image, 0.01, 0.45)  #,0
+
+    def __setstate__(self, state):
+        super(SSD_RESNET, self).__setstate__(state)
+        if not hasattr(self, 'head'): # whole model pickled before the MultiBoxHead
+            self.head = None
 
     def forward(self, x, test=False):
         """Applies network layers and ops on input image(s) x.
@@ -230,18 +247,22 @@ class SSD_RESNET(nn.Module):
             if k % 2 == 1:
                 sources.append(x)
 
-        # apply multibox head to source layers
-        for (x, l, c) in zip(sources, self.loc, self.conf):
-            # l and c is two conv layers
-            loc.append(l(x).permute(0, 2, 3, 1).contiguous()) # store the output of loc conv layer
-            conf.append(c(x).permute(0, 2, 3, 1).contiguous()) # store the output of conf conv layer
-
-        loc = torch.cat([o.view(o.size(0), -1) for o in loc], 1)
-        conf = torch.cat([o.view(o.size(0), -1) for o in conf], 1)
+        if self.head is not None:
+            # loc + conf convs merged at inference (MultiBoxHead, see models/fusion.py)
+            loc, conf = self.head(sources)
+        else:
+            # apply multibox head to source layers
+            for (x, l, c) in zip(sources, self.loc, self.conf):
+                # l and c is two conv layers
+                loc.append(l(x).permute(0, 2, 3, 1).contiguous()) # store the output of loc conv layer
+                conf.append(c(x).permute(0, 2, 3, 1).contiguous()) # store the output of conf conv layer
+
+            loc = torch.cat([o.view(o.size(0), -1) for o in loc], 1)
+            conf = torch.cat([o.view(o.size(0), -1) for o in conf], 1)
         #if self.phase == "test":
         if test:
            with torch.no_grad():
-            output = self.detect.forward(
+            output = self.detect(
                 loc.view(loc.size(0), -1, 4),                   # loc preds
                 self.softmax(conf.view(conf.size(0), -1, self.num_classes)),                # conf preds
                 self.priors.type(type(x.data))                  # default boxes
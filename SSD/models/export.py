@@ -0,0 +1,163 @@
+'''
+    Export of a trained SSD model (SSD_VGG, SSD_RESNET, SSD_MobN1, SSD_MobN2) for the lite
+    interpreter of PyTorch Mobile, what demo/demo.ipynb did by hand for the android app:
+
+        1) fuse_for_inference() (models/fusion.py), optionally followed by a quantization step,
+           or nothing for a model already fused/converted (fuse=False)
+        2) the convs are traced at the static input size [1,3,size,size] and wrapped with the
+           softmax, the priors and Detect into one scripted module (SSDExport): the forwards of
+           SSD_RESNET/MobN1/MobN2 index their ModuleLists with loop variables, they don't script,
+           the traced convs do, whatever the model
+        3) optimize_for_mobile() and _save_for_lite_interpreter() to <name>.ptl
+        4) <name>.json next to it: everything the app needs to pre/post-process the images
+           (input size, mean, classes, layout of the output) and the sha256 of the priors the
+           boxes are decoded with, to tell apart exports of different prior configs
+        5) the .ptl is loaded back with the lite interpreter and its detections are compared to
+           the eager ones
+
+    The output is the one of SSD_VGG in test phase: (detections, None, None), detections
+    Shape: [1,num_classes,max_per_image,5], (score, x1, y1, x2, y2) relative to the image size.
+'''
+import hashlib
+import json
+import os
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from typing import Optional, Tuple
+from .fusion import fuse_for_inference, _raw_outputs
+
+
+class _Convs(nn.Module):
+    # loc/conf outputs of an SSD model, whatever its phase: what gets traced
+    def __init__(self, model):
+        super(_Convs, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        loc, conf = _raw_outputs(self.model, x)[:2]
+        return loc, conf
+
+
+class SSDExport(nn.Module):
+    """Scriptable SSD for deployment: traced convs + softmax + Detect
+
+    Args:
+        convs: traced module, x Shape: [1,3,size,size] -> (loc [1,num_priors,4],
+            conf [1,num_priors,num_classes])
+        priors: (tensor) prior boxes of the model, Shape: [num_priors,4]
+        num_classes: number of classes, background included
+        detect: Detect of the model
+    """
+
+    def __init__(self, convs, priors, num_classes, detect):
+        super(SSDExport, self).__init__()
+        self.convs = convs
+        self.register_buffer('priors', priors)
+        self.num_classes = num_classes
+        self.detect = detect
+
+    def forward(self, x: torch.Tensor) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[torch.Tensor]]:
+        loc, conf = self.convs(x)
+        # the convs may run in float16/int8 + dequant, Detect decodes in float32
+        conf = F.softmax(conf.float().view(conf.size(0), -1, self.num_classes), dim=-1)
+        return self.detect(loc.float(), conf, self.priors), None, None
+
+
+def priors_hash(priors):
+    """sha256 of the float32 prior boxes"""
+    priors = priors.detach().to('cpu', torch.float32).contiguous()
+    return hashlib.sha256(priors.numpy().tobytes()).hexdigest()
+
+
+def _is_quantized(model):
+    # int8 weights in the state_dict: a converted model
+    return any(isinstance(t, torch.Tensor) and t.is_quantized for t in model.state_dict().values())
+
+
+def script_model(model, size=None):
+    """SSDExport of an SSD model in eval mode, scripted, for an input Shape: [1,3,size,size]"""
+    if not hasattr(model, 'detect'):
+        raise ValueError('{} has no Detect, only SSD_VGG/RESNET/MobN1/MobN2 can be exported'
+                         .format(type(model).__name__))
+    size = size or model.size
+    model.eval()
+    param = next(model.parameters(), None) # None in an int8 model, which runs on the cpu
+    device = param.device if param is not None else torch.device('cpu')
+    x = torch.zeros(1, 3, size, size, device='cpu').to(device)
+    with torch.no_grad():
+        convs = torch.jit.trace(_Convs(model), x, check_trace=False)
+    priors = model.priors.detach().to(device, torch.float32).clone()
+    return torch.jit.script(SSDExport(convs, priors, model.num_classes, model.detect))
+
+
+def export_model(model, cfg, path, classes, quantize=None, size=None, check=True, rtol=1e-3, atol=1e-3,
+                 fuse=True):
+    """Fuse, (quantize), script and optimize an SSD model, save it for the lite interpreter
+
+    Args:
+        model: trained SSD_VGG, SSD_RESNET, SSD_MobN1 or SSD_MobN2, changed in place (fused)
+        cfg: config of the model (data/config.py), for its mean
+        path: output file, <name>.ptl, the manifest is written to <name>.json
+        classes: (list of str) names of the classes, index 0 is the background (VOC_CLASSES)
+        quantize: None, or a function model -> model run after the fusion (e.g. int8 convert)
+        fuse: run fuse_for_inference() and quantize, False for a model exported as it is, e.g.
+            the int8 model of quantize_static()
+        size: input size of the export, model.size by default
+        check: compare the detections of the saved file to the ones of the eager model
+        rtol, atol: tolerance of the check, on the scores and the box coordinates
+    Return:
+        manifest (dict), also written to <name>.json
+    """
+    import torch.backends.xnnpack
+    from torch.utils.mobile_optimizer import optimize_for_mobile
+    from torch.jit.mobile import _load_for_lite_interpreter
+
+    size = size or model.size
+    model = model.cpu().eval()
+    if fuse:
+        fuse_for_inference(model)
+        if quantize is not None:
+            model = quantize(model)
+    # ~ mean subtracted pixels, the same image for the eager and the exported model
+    x = torch.randn(1, 3, size, size, generator=torch.Generator().manual_seed(0),
+                    device='cpu').mul_(64)
+    scripted = script_model(model, size)
+    if torch.backends.xnnpack.enabled:
+        scripted = optimize_for_mobile(scripted)
+    else: # optimize_for_mobile asserts on builds without XNNPACK
+        print('WARNING: torch built without XNNPACK, saving the model without optimize_for_mobile')
+    scripted._save_for_lite_interpreter(path)
+
+    manifest = {
+        'model': type(model).__name__,
+        'input_size': [1, 3, size, size],
+        # BaseTransform subtracts the mean from the BGR image, VOCDetection then swaps to RGB
+        'input_format': 'RGB, resized to input_size, mean subtracted, not scaled',
+        'mean': [float(m) for m in cfg['dataset_mean']][::-1],
+        'classes': list(classes),
+        'num_priors': int(model.priors.size(0)),
+        'priors_sha256': priors_hash(model.priors),
+        'variance': list(cfg['variance']),
+        'conf_thresh': model.detect.conf_thresh,
+        'nms_thresh': model.detect.nms_thresh,
+        'max_per_image': model.detect.max_per_image,
+        'output': 'detections Shape: [1,num_classes,max_per_image,5]: score, x1, y1, x2, y2 '
+                  'relative to the image size, zero padded',
+        'quantized': _is_quantized(model),
+    }
+    with open(os.path.splitext(path)[0] + '.json', 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    if check:
+        with torch.no_grad():
+            expected = SSDExport(_Convs(model), model.priors.detach().float(), model.num_classes,
+                                 model.detect)(x)[0]
+            exported = _load_for_lite_interpreter(path)(x)[0]
+        if exported.shape != expected.shape or \
+                not torch.allclose(exported, expected, rtol=rtol, atol=atol, equal_nan=True):
+            raise RuntimeError('exported model differs from the eager model: max abs diff {:g}'.format(
+                (exported - expected).abs().max().item() if exported.shape == expected.shape else float('inf')))
+        print('Exported detections match the eager model')
+    print('Saved {} and its manifest'.format(path))
+    return manifest
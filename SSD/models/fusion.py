@@ -0,0 +1,181 @@
+'''
+    Inference-time folding of the SSD models (SSD_VGG, SSD_RESNET, SSD_MobN1, SSD_MobN2, RefineSSD)
+
+    fuse_for_inference(model) rewrites a trained model in place, for evaluation/deployment only:
+        1) the learnable scale of L2Norm is folded into the input channels of the convs which
+           consume the normalized features (multibox heads, TCB of RefineSSD), L2Norm keeps the
+           normalization only
+        2) every Conv+BN(+ReLU) and Conv+ReLU group is fused with torch.ao.quantization.fuse_modules:
+           the BN is folded into the conv weights and bias, the ReLU is merged into a ConvReLU2d
+           (nothing to fold in float, but the quantized backends run it as one kernel)
+        3) the loc and conf convs of each source are merged into one conv writing straight into
+           the [batch,num_priors,4+num_classes] output (MultiBoxHead), SSD_VGG/RESNET/MobN1/MobN2
+    and checks that the outputs of the model did not change.
+
+    fusion_groups(model) lists the groups, also usable with fuse_modules_qat() for QAT.
+'''
+import torch
+import torch.nn as nn
+from torch.ao.nn.intrinsic import _FusedModule
+from torch.ao.quantization import fuse_modules
+from layers import MultiBoxHead
+from .SSD_vggres import SSD_VGG
+
+
+def fusion_groups(model):
+    """Groups of submodule names of model which can go through fuse_modules, e.g.
+    ['base.0.0', 'base.0.1', 'base.0.2'] for a conv_bn of mobilenet v1
+
+    - consecutive Conv2d, BatchNorm2d, ReLU (or Conv2d, BatchNorm2d / Conv2d, ReLU) of an
+      nn.Sequential or an nn.ModuleList: the lists of SSD run their layers one after the other
+    - convN/bnN attributes of a module (resnet blocks), without their relu which is shared
+      by several layers of the block
+    ReLU6 (mobilenet v2) has no fused module, only its Conv2d+BatchNorm2d are grouped.
+    """
+    groups = []
+    for name, module in model.named_modules():
+        prefix = name + '.' if name else ''
+        if isinstance(module, _FusedModule):
+            continue
+        children = list(module.named_children())
+        if type(module) in (nn.Sequential, nn.ModuleList):
+            i = 0
+            while i < len(children):
+                group = [i]
+                if type(children[i][1]) is nn.Conv2d:
+                    if i + 1 < len(children) and type(children[i + 1][1]) is nn.BatchNorm2d:
+                        group.append(i + 1)
+                    if group[-1] + 1 < len(children) and type(children[group[-1] + 1][1]) is nn.ReLU:
+                        group.append(group[-1] + 1)
+                if len(group) > 1:
+                    groups.append([prefix + children[j][0] for j in group])
+                i = group[-1] + 1
+        else:
+            children = dict(children)
+            for key, child in children.items():
+                bn = 'bn' + key[len('conv'):]
+                if key.startswith('conv') and type(child) is nn.Conv2d and \
+                        type(children.get(bn)) is nn.BatchNorm2d:
+                    groups.append([prefix + key, prefix + bn])
+    return groups
+
+
+def l2norm_consumers(model):
+    """[(L2Norm, [convs applied to its output]), ...] of an SSD model"""
+    if hasattr(model, 'L2Norm_4_3'): # RefineSSD: conv4_3 and conv5_3 are the sources 0 and 1
+        pairs = []
+        for i, l2norm in enumerate([model.L2Norm_4_3, model.L2Norm_5_3]):
+            convs = []
+            if model.use_refine:
+                convs += [model.arm_loc[i], model.arm_conf[i]]
+            if model.use_tcb:
+                convs += [model.trans_layers[i][0]]
+            else: # the arm sources are the odm sources
+                convs += [model.odm_loc[i], model.odm_conf[i]]
+            pairs.append((l2norm, convs))
+        return pairs
+    if hasattr(model, 'L2Norm'): # SSD_VGG/RESNET/MobN1/MobN2: first source of the heads
+        return [(model.L2Norm, [model.loc[0], model.conf[0]])]
+    return []
+
+
+def fold_l2norm(model):
+    """Fold the scale of each L2Norm into the convs consuming its output:
+    conv(w * x) == conv'(x) with the input channels of the conv weight scaled by w, the zero
+    padding of the conv stays zero. Only done when all the consumers are plain convs.
+    Return: number of folded L2Norm
+    """
+    folded = 0
+    for l2norm, convs in l2norm_consumers(model):
+        if l2norm.weight is None:
+            continue
+        if not all(type(c) is nn.Conv2d and c.groups == 1 for c in convs):
+            continue
+        scale = l2norm.weight.data.view(1, -1, 1, 1)
+        for conv in convs:
+            conv.weight.data.mul_(scale.to(conv.weight.dtype))
+        l2norm.weight = None # L2Norm.forward skips the scale
+        folded += 1
+    return folded
+
+
+def fuse_multibox_heads(model):
+    """Replace the loc/conf convs of an SSD model by a MultiBoxHead, used by its forward
+    (the loc/conf convs stay in the model for its state_dict).
+    Return: True if the model has a multibox head to merge (not RefineSSD)
+    """
+    if not hasattr(model, 'head'):
+        return False
+    model.head = MultiBoxHead(model.loc, model.conf, model.num_classes, model.cfg['feature_maps'])
+    weight = model.loc[0].weight
+    model.head.to(weight.device)
+    if not weight.is_contiguous() and weight.is_contiguous(memory_format=torch.channels_last):
+        model.head.to(memory_format=torch.channels_last)
+    return True
+
+
+def _raw_outputs(model, x):
+    # loc/conf of the heads, not the detections: SSD_VGG/SSD_RESNET pick the output with the
+    # phase, the other models with forward(x, test=False)
+    phase = getattr(model, 'phase', None)
+    if phase is not None:
+        model.phase = 'train'
+    try:
+        with torch.no_grad():
+            out = model(x)
+    finally:
+        if phase is not None:
+            model.phase = phase
+    return [o for o in out if isinstance(o, torch.Tensor)]
+
+
+def detections(model):
+    """forward of a model in test mode: images -> detections [batch,num_classes,max_per_image,5]
+    SSD_VGG picks its output with the phase, (detections, None, None), switched to 'test' for
+    the call only (the model may be in the middle of its training), SSD_RESNET/MobN1/MobN2
+    with forward(x, test=True)
+    """
+    if isinstance(model, SSD_VGG):
+        def forward(x):
+            phase, model.phase = model.phase, 'test'
+            try:
+                return model(x)[0]
+            finally:
+                model.phase = phase
+        return forward
+    return lambda x: model(x, test=True)
+
+
+def fuse_for_inference(model, check=True, rtol=1e-3, atol=1e-3, heads=True):
+    """Fold L2Norm scales and fuse the Conv+BN(+ReLU) groups of a trained SSD model, in place
+
+    Args:
+        model: SSD_VGG, SSD_RESNET, SSD_MobN1, SSD_MobN2 or RefineSSD, switched to eval()
+        heads: also merge the loc/conf convs into a MultiBoxHead
+        check: compare the head outputs of a random image before and after the folding
+        rtol, atol: tolerance of the check, relative to the largest output
+    Return:
+        model (same object)
+    """
+    model.eval()
+    if check:
+        param = next(model.parameters())
+        x = torch.randn(1, 3, model.size, model.size, generator=torch.Generator().manual_seed(0),
+                        device='cpu').mul_(64).to(param.device, param.dtype) # ~ mean subtracted pixels
+        before = _raw_outputs(model, x)
+    num_l2norm = fold_l2norm(model)
+    groups = fusion_groups(model)
+    if groups: # fuse_modules takes an empty list for one empty group
+        fuse_modules(model, groups, inplace=True)
+    # after fold_l2norm: MultiBoxHead copies the scaled head weights
+    merged = heads and fuse_multibox_heads(model)
+    print('Fused {:d} conv groups, folded {:d} L2Norm scales{:s}'.format(
+        len(groups), num_l2norm, ', merged the multibox heads' if merged else ''))
+    if check:
+        after = _raw_outputs(model, x)
+        for b, a in zip(before, after):
+            diff = (a - b).abs().max().item()
+            if diff > atol + rtol * b.abs().max().item():
+                raise RuntimeError('fused model differs from the original one: max abs diff {:g} '
+                                   '(max output {:g})'.format(diff, b.abs().max().item()))
+    return model
@@ -3,6 +3,7 @@
 '''
 
 import torch.nn as nn
+from torch.ao.nn.quantized import FloatFunctional
 import math
 
 ## kernel_size=(3, 3) pad = 1
@@ -42,10 +43,17 @@ class InvertedResidual(nn.Module):
             nn.Conv2d(inp * expand_ratio, oup, 1, 1, 0, bias=False),
             nn.BatchNorm2d(oup),
         )
+        # the residual add as a module, so that the int8 quantization can convert it
+        self.skip_add = FloatFunctional()
+
+    def __setstate__(self, state):
+        super(InvertedResidual, self).__setstate__(state)
+        if 'skip_add' not in self._modules: # whole model pickled before skip_add
+            self.skip_add = FloatFunctional()
 
     def forward(self, x):
         if self.use_res_connect:
-                    return x + self.conv(x)
+                    return self.skip_add.add(x, self.conv(x))
         else:
             return self.conv(x)
 
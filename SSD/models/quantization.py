@@ -0,0 +1,162 @@
+'''
+    Int8 quantization of the SSD models (SSD_VGG, SSD_RESNET, SSD_MobN1, SSD_MobN2), eager mode
+    like QAT.ipynb
+
+    Post-training static quantization, quantize_static(model, dataset):
+        1) fuse_for_inference() (models/fusion.py): Conv+BN(+ReLU) groups folded, L2Norm scale
+           folded into the heads
+        2) make_quantizable(): quant/dequant stubs around what stays in float
+        3) observers inserted with the default qconfig of the backend (fbgemm on x86 servers,
+           qnnpack on arm phones), calibrated on a few batches of the dataset
+        4) converted to int8
+
+    Quantization-aware training, prepare_qat_model(model) (see finetune_vggresSSD.py --qat):
+        the Conv+BN(+ReLU) groups are fused with fuse_modules_qat (the BN keeps training), the
+        same stubs are inserted and fake quantization is added with the default qat qconfig of
+        the backend; convert_qat(model) gives the int8 model of the trained one.
+
+    What stays in float: L2Norm (a reduction over the channels), the permute/cat of the head
+    outputs, the softmax and Detect. Everything else (base, extras, heads convs, the residual
+    adds of resnet/mobilenet v2) runs in int8.
+'''
+import copy
+import io
+import time
+import warnings
+import torch
+import torch.nn as nn
+import torch.utils.data as data
+from torch.ao.quantization import QuantStub, DeQuantStub, get_default_qconfig, get_default_qat_qconfig, \
+    prepare, prepare_qat, convert, fuse_modules_qat
+from data import detection_collate
+from .fusion import fuse_for_inference, fusion_groups, _raw_outputs
+
+
+def make_quantizable(model):
+    """Insert QuantStub/DeQuantStub into a (fused) SSD model, in place
+        - QuantStub before the first layer of the base network
+        - DeQuantStub before L2Norm and QuantStub after it
+        - DeQuantStub after each loc and conf conv, the rest of the forward is float
+    The MultiBoxHead of fuse_for_inference() is dropped: the loc and conf convs keep separate
+    int8 output scales, box offsets and class scores don't have the same range.
+    """
+    base = model.vgg if hasattr(model, 'vgg') else model.base
+    base[0] = nn.Sequential(QuantStub(), base[0])
+    model.L2Norm = nn.Sequential(DeQuantStub(), model.L2Norm, QuantStub())
+    model.L2Norm[1].qconfig = None # no int8 L2Norm
+    model.softmax.qconfig = None
+    model.head = None
+    for heads in [model.loc, model.conf]:
+        for i in range(len(heads)):
+            heads[i] = nn.Sequential(heads[i], DeQuantStub())
+    return model
+
+
+def set_backend(backend):
+    """Quantized engine used by the converted model, and its default qconfig"""
+    torch.backends.quantized.engine = backend
+    return get_default_qconfig(backend)
+
+
+def calibrate(model, dataset, num_batches=32, batch_size=8, num_workers=4):
+    """Run num_batches batches of dataset (BaseTransform images) through the observers of a
+    prepared model, heads only, no Detect"""
+    loader = data.DataLoader(dataset, batch_size, shuffle=True, num_workers=num_workers,
+                             collate_fn=detection_collate, generator=torch.Generator(device='cpu'))
+    model.eval()
+    for i, (images, _) in enumerate(loader):
+        if i == num_batches:
+            break
+        _raw_outputs(model, images)
+    return model
+
+
+def prepare_static(model, backend='fbgemm', check=True):
+    """Fused, quantizable model with observers, in place, to calibrate then convert()"""
+    model = model.cpu().eval()
+    model.priors = model.priors.cpu() # not a buffer, .cpu() leaves it where it was
+    fuse_for_inference(model, check=check)
+    make_quantizable(model)
+    model.qconfig = set_backend(backend)
+    prepare(model, inplace=True)
+    return model
+
+
+def quantize_static(model, dataset, backend='fbgemm', num_batches=32, batch_size=8, num_workers=4):
+    """Post-training static int8 quantization of a trained SSD model, in place
+
+    Args:
+        model: trained SSD_VGG, SSD_MobN1 or SSD_MobN2 (float, cpu)
+        dataset: calibration images, VOCDetection with BaseTransform
+        backend: 'fbgemm' (x86) or 'qnnpack' (arm)
+        num_batches, batch_size: calibration set size
+    Return:
+        the converted int8 model
+    """
+    prepare_static(model, backend)
+    calibrate(model, dataset, num_batches, batch_size, num_workers)
+    convert(model, inplace=True)
+    return model
+
+
+def prepare_qat_model(model, backend='fbgemm'):
+    """Fused, quantizable model with fake quantization, in place, for quantization-aware training"""
+    model.train() # fuse_modules_qat keeps the BN of the train mode
+    groups = fusion_groups(model)
+    if groups:
+        fuse_modules_qat(model, groups, inplace=True)
+    make_quantizable(model)
+    torch.backends.quantized.engine = backend
+    model.qconfig = get_default_qat_qconfig(backend)
+    prepare_qat(model, inplace=True)
+    return model
+
+
+def convert_qat(model):
+    """Int8 copy of a model prepared by prepare_qat_model(), on the cpu, in eval mode"""
+    model = copy.deepcopy(model).cpu().eval()
+    convert(model, inplace=True)
+    model.priors = model.priors.cpu()
+    return model
+
+
+def load_quantized(model, state_dict, backend='fbgemm', qat=False):
+    """Int8 model from its float architecture and the state_dict of the converted model
+
+    A converted model can't be pickled whole (torch.save(model)), its quantized modules don't
+    unpickle; the int8 weights and scales are saved as a state_dict instead, like QAT.ipynb.
+    Args:
+        model: the float model which was quantized (any weights, e.g. a freshly built one)
+        state_dict: state_dict of the converted model
+        qat: the model was converted after quantization-aware training (convert_qat()), not
+            by quantize_static()
+    """
+    if qat:
+        prepare_qat_model(model.cpu(), backend).eval()
+    else:
+        prepare_static(model, backend, check=False)
+    with warnings.catch_warnings(): # the observers did not see any data, their state is loaded
+        warnings.simplefilter('ignore')
+        convert(model, inplace=True)
+    model.priors = model.priors.cpu()
+    model.load_state_dict(state_dict)
+    return model
+
+
+def model_size(model):
+    """Size in bytes of the serialized state_dict of model"""
+    buf = io.BytesIO()
+    torch.save(model.state_dict(), buf)
+    return buf.tell()
+
+
+def measure_latency(forward, size=300, num_samples=50, num_warmups=5):
+    """Mean time in seconds of forward() on one random [1,3,size,size] image, on the cpu"""
+    x = torch.randn(1, 3, size, size, device='cpu').mul_(64)
+    with torch.no_grad():
+        for _ in range(num_warmups):
+            forward(x)
+        start = time.time()
+        for _ in range(num_samples):
+            forward(x)
+    return (time.time() - start) / num_samples
@@ -1,4 +1,5 @@
 import torch.nn as nn
+from torch.ao.nn.quantized import FloatFunctional
 import math
 import torch.utils.model_zoo as model_zoo
 import warnings
@@ -37,6 +38,13 @@ class BasicBlock(nn.Module):
         self.bn2 = nn.BatchNorm2d(planes)
         self.downsample = downsample
         self.stride = stride
+        # the residual add as a module, so that the int8 quantization can convert it
+        self.skip_add = FloatFunctional()
+
+    def __setstate__(self, state):
+        super(BasicBlock, self).__setstate__(state)
+        if 'skip_add' not in self._modules: # whole model pickled before skip_add
+            self.skip_add = FloatFunctional()
 
     def forward(self, x):
         residual = x
@@ -51,7 +59,7 @@ class BasicBlock(nn.Module):
         if self.downsample is not None:
             residual = self.downsample(x)
 
-        out += residual
+        out = self.skip_add.add(out, residual)
         out = self.relu(out)
 
         return out
@@ -75,6 +83,13 @@ class Bottleneck(nn.Module):
         self.relu = nn.ReLU(inplace=True)
         self.downsample = downsample
         self.stride = stride
+        # the residual add as a module, so that the int8 quantization can convert it
+        self.skip_add = FloatFunctional()
+
+    def __setstate__(self, state):
+        super(Bottleneck, self).__setstate__(state)
+        if 'skip_add' not in self._modules: # whole model pickled before skip_add
+            self.skip_add = FloatFunctional()
 
     def forward(self, x):
         residual = x
@@ -93,7 +108,7 @@ class Bottleneck(nn.Module):
         # when downsample, the residual part x also need to downsample to match the size
         if self.downsample is not None:
             residual = self.downsample(x)
-        out += residual
+        out = self.skip_add.add(out, residual)
         out = self.relu(out)
 
         return out
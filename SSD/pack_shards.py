@@ -0,0 +1,43 @@
+'''
+    Pack the images and annotations of a VOC/XL dataset into a few large shard files,
+    read back by data.ShardDetection (see data/shards.py)
+
+    Pack VOC2007 + VOC2012 trainval and VOC2007 test
+    Execute: python3 pack_shards.py --image_sets 2007/trainval 2012/trainval --out shards/voc0712_trainval
+    Execute: python3 pack_shards.py --image_sets 2007/test --out shards/voc07_test
+
+    Pack the XL trainval set, without the images XLDetection would skip
+    Execute: python3 pack_shards.py --dataset XL --dataset_root /cephfs/share/data/VOC_xlab_products --image_sets trainval --drop_empty --out shards/xl_trainval
+'''
+from data import *
+import argparse
+
+parser = argparse.ArgumentParser(
+    description='Pack a VOC/XL dataset into memory-mapped image shards')
+parser.add_argument('--dataset', default='VOC', choices=['VOC', 'XL'],
+                    type=str, help='VOC or XL')
+parser.add_argument('--dataset_root', default=VOC_ROOT,
+                    help='Dataset root directory path')
+parser.add_argument('--image_sets', default=['2007/trainval'], nargs='+',
+                    help='Image sets to pack, year/name for VOC (e.g. 2007/test), name for XL')
+parser.add_argument('--out', required=True,
+                    help='Directory of the packed dataset')
+parser.add_argument('--shard_size', default=1024, type=int,
+                    help='Size of each shard file in MB')
+parser.add_argument('--drop_empty', default=False, action='store_true',
+                    help='Drop the images without any non-difficult object')
+args = parser.parse_args()
+
+if __name__ == '__main__':
+    if args.dataset == 'VOC':
+        image_sets = [tuple(image_set.split('/')) for image_set in args.image_sets]
+        dataset = VOCDetection(root=args.dataset_root, image_sets=image_sets)
+        classes = VOC_CLASSES
+        # The PASCAL VOC metric changed in 2010
+        use_07_metric = all(int(year) < 2010 for year, name in image_sets)
+    else:
+        dataset = XLDetection(root=args.dataset_root, image_sets=args.image_sets)
+        classes = XL_CLASSES
+        use_07_metric = True
+    pack_shards(dataset, args.out, classes, use_07_metric,
+                shard_size=args.shard_size << 20, drop_empty=args.drop_empty)
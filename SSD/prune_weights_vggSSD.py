@@ -31,6 +31,8 @@ from data import VOC_CLASSES as labelmap
 import torch.utils.data as data
 from layers.modules import MultiBoxLoss
 from models.SSD_vggres import build_ssd
+from models.fusion import detections
+from utils.eval_engine import detect_all, EvalImageCache
 
 def str2bool(v):
     return v.lower() in ("yes", "true", "t", "1")
@@ -44,70 +46,45 @@ parser.add_argument('--cuda', default=True, type=str2bool, help='Use cuda to tra
 #for test_net 200 in SSD paper, 200 for COCO, 300 for VOC
 parser.add_argument('--max_per_image', default=200, type=int,
                     help='Top number of detections kept per image, further restrict the number of predictions to parse')
+parser.add_argument('--eval_batch_size', default=8, type=int,
+                    help='Number of images per forward pass in test_net')
+parser.add_argument('--eval_workers', default=4, type=int,
+                    help='Number of workers used in test_net dataloading and AP evaluation')
+parser.add_argument('--eval_cache', default=None, type=str,
+                    help='Local directory caching the resized test images between evaluations (off by default)')
+parser.add_argument('--eval_cache_size', default=16, type=int,
+                    help='Size limit of the eval_cache directory in GB')
 args = parser.parse_args()
 
+# resized test images kept between the evaluations, see EvalImageCache
+eval_cache = EvalImageCache(args.eval_cache, args.eval_cache_size << 30) if args.eval_cache else None
+
 cfg = voc
 
 def test_net(save_folder, net, cuda,
-             testset, transform, max_per_image=200, thresh=0.05):
+             testset, transform, max_per_image=200, thresh=0.05,
+             batch_size=8, num_workers=4, cache=None):
 
     if not os.path.exists(save_folder):
         os.mkdir(save_folder)
 
-    num_images = len(testset)
     num_classes = len(labelmap)                      # +1 for background
-    # all detections are collected into:
-    #    all_boxes[cls][image] = N x 5 array of detections in
-    #    (x1, y1, x2, y2, score)
-    all_boxes = [[[] for _ in range(num_images)]
-                 for _ in range(num_classes)]
-
-    # timers
-    _t = {'im_detect': Timer(), 'misc': Timer()}
     #output_dir = get_output_dir('ssd300_120000', set_type) #directory storing output results
     #det_file = os.path.join(output_dir, 'detections.pkl') #file storing output result under output_dir
     det_file = os.path.join(save_folder, 'detections.pkl')
 
-    for i in range(num_images):
-        im, gt, h, w = testset.pull_item(i) # include BaseTransform inside
-
-        x = Variable(im.unsqueeze(0)) #insert a dimension of size one at the dim 0
-        if cuda:
-            x = x.cuda()
-
-        _t['im_detect'].tic()
-        detections = net(x=x, test=True).data # get the detection results
-        detect_time = _t['im_detect'].toc(average=False) #store the detection time
-
-        # skip j = 0, because it's the background class
-        for j in range(1, detections.size(1)): # for every class
-            dets = detections[0, j, :]#size( ** , 5)
-            mask = dets[:, 0].gt(0.).expand(5, dets.size(0)).t()
-            dets = torch.masked_select(dets, mask).view(-1, 5)
-            if dets.dim() == 0:
-                continue
-            #if dets.size(0) == 0:
-            #    continue
-            boxes = dets[:, 1:]
-            boxes[:, 0] *= w
-            boxes[:, 2] *= w
-            boxes[:, 1] *= h
-            boxes[:, 3] *= h
-            scores = dets[:, 0].cpu().numpy()
-            cls_dets = np.hstack((boxes.cpu().numpy(),
-                                  scores[:, np.newaxis])).astype(np.float32,
-                                                                 copy=False)
-            all_boxes[j][i] = cls_dets #[class][imageID] = 1 x 5 where 5 is box_coord + score
-
-        if (i + 1) % 100 == 0:
-            print('im_detect: {:d}/{:d} {:.3f}s'.format(i + 1, num_images, detect_time))
+    # all detections are collected into:
+    #    all_boxes[cls][image] = N x 5 array of detections in
+    #    (x1, y1, x2, y2, score)
+    all_boxes = detect_all(detections(net), testset, num_classes, cuda,
+                           batch_size=batch_size, num_workers=num_workers, cache=cache)
 
     #write the detection results into det_file
     with open(det_file, 'wb') as f:
         pickle.dump(all_boxes, f, pickle.HIGHEST_PROTOCOL)
 
     print('Evaluating detections')
-    APs,mAP = testset.evaluate_detections(all_boxes, save_folder)
+    APs,mAP = testset.evaluate_detections(all_boxes, save_folder, num_workers=num_workers)
 
 # --------------------------------------------------------------------------- Pruning Part
 class Prunner_vggSSD:
@@ -123,7 +100,9 @@ class Prunner_vggSSD:
         # evaluation
         # test_net('prunes/test', self.model, args.cuda, testset,
         #          BaseTransform(self.model.size, cfg['dataset_mean']),
-        #          args.max_per_image, thresh=0.01)
+        #          args.max_per_image, thresh=0.01,
+        #          batch_size=args.eval_batch_size, num_workers=args.eval_workers,
+        #          cache=eval_cache)
 
         self.model.train()
 
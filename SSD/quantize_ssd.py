@@ -0,0 +1,163 @@
+from __future__ import print_function
+'''
+    Post-training static int8 quantization of a trained SSD model (see models/quantization.py):
+    calibrated on VOC2007 trainval, evaluated on VOC2007 test against the float model
+    (size, cpu latency, mAP)
+
+    mobileSSD v2, fbgemm backend (x86)
+    Execute: python3 quantize_ssd.py --use_m2 --trained_model weights/_your_trained_SSD_model_.pth --out weights/ssd300_mobilev2_int8.pth
+
+    The state_dict of the int8 model is reloaded with models.quantization.load_quantized(float model, state_dict)
+
+    vggSSD, qnnpack backend (arm), also exported for the android app
+    Execute: python3 quantize_ssd.py --trained_model weights/ssd300_mAP_77.43_v2.pth --backend qnnpack --export weights/ssd300_vgg_int8.ptl
+
+    pruned/finetuned model saved whole with torch.save (finetune_vggresSSD.py)
+    Execute: python3 quantize_ssd.py --pruned_model prunes/vggSSD_finetuned_71.73.pth --out prunes/vggSSD_finetuned_int8_state.pth
+'''
+import torch
+from data import *
+from data import VOC_CLASSES as labelmap
+from layers import Detect
+from utils.eval_engine import detect_all, EvalImageCache
+from models.SSD_vggres import build_ssd
+from models.SSD_mobile import build_mssd
+from models.fusion import detections
+from models.quantization import quantize_static, model_size, measure_latency
+from models.export import export_model
+
+import os
+import copy
+import pickle
+import argparse
+
+
+def str2bool(v):
+    return v.lower() in ("yes", "true", "t", "1")
+
+
+parser = argparse.ArgumentParser(
+    description='Single Shot MultiBox Detector post-training int8 quantization')
+parser.add_argument('--trained_model',
+                    default='weights/ssd300_mAP_77.43_v2.pth', type=str,
+                    help='Trained state_dict file path to open')
+parser.add_argument('--pruned_model', default=None, type=str,
+                    help='Whole model saved with torch.save (pruned/finetuned), used instead of --trained_model')
+parser.add_argument('--backend', default='fbgemm', choices=['fbgemm', 'qnnpack'],
+                    type=str, help='Quantized engine: fbgemm for x86, qnnpack for arm')
+parser.add_argument('--calib_batches', default=32, type=int,
+                    help='Number of VOC2007 trainval batches the observers are calibrated on')
+parser.add_argument('--calib_batch_size', default=8, type=int,
+                    help='Batch size of the calibration')
+parser.add_argument('--out', default=None, type=str,
+                    help='Save the state_dict of the int8 model to this file (models.quantization.load_quantized)')
+parser.add_argument('--export', default=None, type=str,
+                    help='Also export the int8 model for the lite interpreter to this .ptl file (models/export.py)')
+parser.add_argument('--eval', default=True, type=str2bool,
+                    help='Evaluate the float and int8 models on VOC2007 test')
+parser.add_argument('--save_folder', default='eval/', type=str,
+                    help='File path to save results')
+parser.add_argument('--confidence_threshold', default=0.01, type=float,
+                    help='Detection confidence threshold')
+parser.add_argument('--max_per_image', default=200, type=int,
+                    help='Top number of detections kept per image, further restrict the number of predictions to parse')
+parser.add_argument('--eval_batch_size', default=8, type=int,
+                    help='Number of images per forward pass in test_net')
+parser.add_argument('--eval_workers', default=4, type=int,
+                    help='Number of workers used in calibration/test_net dataloading and AP evaluation')
+parser.add_argument('--eval_cache', default=None, type=str,
+                    help='Local directory caching the resized test images between evaluations (off by default)')
+parser.add_argument('--eval_cache_size', default=16, type=int,
+                    help='Size limit of the eval_cache directory in GB')
+parser.add_argument('--latency_samples', default=50, type=int,
+                    help='Number of single image forward passes timed for the latency')
+parser.add_argument('--voc_root', default=VOC_ROOT,
+                    help='Location of VOC root directory')
+# for mobilev1 backbone
+parser.add_argument("--use_m1", dest="use_m1", action="store_true")
+parser.set_defaults(use_m1=False)
+# for mobilev2 backbone
+parser.add_argument("--use_m2", dest="use_m2", action="store_true")
+parser.set_defaults(use_m2=False)
+args = parser.parse_args()
+
+# resized test images kept between the evaluations, see EvalImageCache
+eval_cache = EvalImageCache(args.eval_cache, args.eval_cache_size << 30) if args.eval_cache else None
+
+if not os.path.exists(args.save_folder):
+    os.mkdir(args.save_folder)
+
+cfg = voc
+
+
+def test_net(save_folder, net, cuda, testset, batch_size=8, num_workers=4, cache=None):
+
+    if not os.path.exists(save_folder):
+        os.mkdir(save_folder)
+
+    num_classes = len(labelmap)                      # +1 for background
+    det_file = os.path.join(save_folder, 'detections.pkl')
+
+    # all detections are collected into:
+    #    all_boxes[cls][image] = N x 5 array of detections in
+    #    (x1, y1, x2, y2, score)
+    all_boxes = detect_all(detections(net), testset, num_classes, cuda,
+                           batch_size=batch_size, num_workers=num_workers, cache=cache)
+
+    #write the detection results into det_file
+    with open(det_file, 'wb') as f:
+        pickle.dump(all_boxes, f, pickle.HIGHEST_PROTOCOL)
+
+    print('Evaluating detections')
+    APs,mAP = testset.evaluate_detections(all_boxes, save_folder, num_workers=num_workers)
+
+    return mAP
+
+
+if __name__ == '__main__':
+    # int8 kernels only run on the cpu, the float model is measured there too
+    torch.set_default_tensor_type('torch.FloatTensor')
+    num_classes = cfg['num_classes']
+    if args.pruned_model:
+        net = torch.load(args.pruned_model, map_location='cpu')
+    else:
+        if args.use_m1:
+            net = build_mssd('test', cfg, 300, num_classes, base='m1', max_per_image=args.max_per_image)
+        elif args.use_m2:
+            net = build_mssd('test', cfg, 300, num_classes, base='m2', max_per_image=args.max_per_image)
+        else:
+            net = build_ssd('test', cfg, 300, num_classes, base='vgg', max_per_image=args.max_per_image)
+        net.load_state_dict(torch.load(args.trained_model, map_location='cpu'))
+    net.detect = Detect(num_classes, cfg, args.max_per_image, args.confidence_threshold, 0.45)
+    net = net.cpu().eval()
+    print('Finished loading model!')
+
+    calibset = VOCDetection(args.voc_root, [('2007', 'trainval')],
+                            BaseTransform(300, cfg['dataset_mean']),
+                            VOCAnnotationTransform())
+    qnet = quantize_static(copy.deepcopy(net), calibset, args.backend, args.calib_batches,
+                           args.calib_batch_size, args.eval_workers)
+    print('Finished quantizing model!')
+
+    report = {'size (MB)': (model_size(net) / 2 ** 20, model_size(qnet) / 2 ** 20),
+              'latency (ms)': tuple(measure_latency(detections(n), net.size, args.latency_samples) * 1000
+                                    for n in (net, qnet))}
+    if args.eval:
+        testset = VOCDetection(args.voc_root, [('2007', 'test')],
+                               BaseTransform(300, cfg['dataset_mean']),
+                               VOCAnnotationTransform())
+        report['mAP'] = tuple(test_net(os.path.join(args.save_folder, name), n, False, testset,
+                                       batch_size=args.eval_batch_size, num_workers=args.eval_workers,
+                                       cache=eval_cache)
+                              for name, n in (('float', net), ('int8', qnet)))
+
+    print('{:>14s}  {:>10s}  {:>10s}  {:>10s}'.format('', 'float32', 'int8 ' + args.backend, 'delta'))
+    for key, (f, q) in report.items():
+        print('{:>14s}  {:10.4f}  {:10.4f}  {:+10.4f}'.format(key, f, q, q - f))
+
+    if args.out:
+        torch.save(qnet.state_dict(), args.out)
+        print('Saved', args.out)
+    if args.export:
+        # the int8 model evaluated above as it is, already fused and converted
+        export_model(qnet, cfg, args.export, labelmap, fuse=False)
@@ -20,9 +20,14 @@
 '''
 from data import *
 from utils.augmentations import SSDAugmentation
+from utils.batch_augmentations import BatchSSDAugmentation, raw_collate
 from layers.modules import MultiBoxLoss
+from layers import Detect
+from utils.eval_engine import detect_all, EvalImageCache
+from utils.checkpoint import AsyncCheckpointer, ResumableRandomSampler
 from models.SSD_vggres import build_ssd
 from models.SSD_mobile import build_mssd
+from models.fusion import detections
 import os
 import sys
 import time
@@ -52,13 +57,25 @@ parser.add_argument('--dataset_root', default=VOC_ROOT,
 parser.add_argument('--batch_size', default=32, type=int,
                     help='Batch size for training')
 parser.add_argument('--resume', default=None, type=str,
-                    help='Checkpoint state_dict file to resume training from')
+                    help='Checkpoint (.ckpt) or state_dict file to resume training from')
 parser.add_argument('--start_iter', default=0, type=int,
-                    help='Resume training at this iter')
+                    help='Resume training at this iter (state_dict files only, a .ckpt has it)')
+parser.add_argument('--checkpoint_interval', default=3000, type=int,
+                    help='Save the weights and a resumable checkpoint every this many iterations')
+parser.add_argument('--keep_checkpoints', default=3, type=int,
+                    help='Number of resumable checkpoints kept in save_folder (<= 0: all)')
+parser.add_argument('--seed', default=None, type=int,
+                    help='Seed of the training data order (random by default, restored by --resume)')
 parser.add_argument('--num_workers', default=4, type=int,
                     help='Number of workers used in dataloading')
+parser.add_argument('--gpu_augment', default=False, type=str2bool,
+                    help='Augment the training batches with torch ops on the training device, the workers only decode the images')
 parser.add_argument('--cuda', default=True, type=str2bool,
                     help='Use CUDA to train model')
+parser.add_argument('--amp', default=False, type=str2bool,
+                    help='Mixed precision training: float16 autocast + loss scaling with cuda, bfloat16 autocast on the cpu')
+parser.add_argument('--channels_last', default=False, type=str2bool,
+                    help='Train in the channels_last (NHWC) memory format')
 parser.add_argument('-we','--warm_epoch', default=1,
                     type=int, help='max epoch for retraining')
 parser.add_argument('--lr', '--learning_rate', default=1e-3, type=float,
@@ -85,6 +102,28 @@ parser.add_argument('--confidence_threshold', default=0.01, type=float,
 # 200 in SSD paper, 200 for COCO, 300 for VOC
 parser.add_argument('--max_per_image', default=200, type=int,
                     help='Top number of detections kept per image, further restrict the number of predictions to parse')
+# 'batched' runs threshold + nms for all classes of all images together
+parser.add_argument('--detect_mode', default='loop', choices=['loop', 'batched'],
+                    type=str, help='Post-processing mode of Detect')
+parser.add_argument('--nms_method', default='loop', choices=['loop', 'matrix'],
+                    type=str, help='nms used by Detect in loop mode')
+parser.add_argument('--top_k', default=-1, type=int,
+                    help='Max candidates per class sent to nms (<= 0: max_per_image)')
+parser.add_argument('--keep_top_k', default=-1, type=int,
+                    help='Max detections kept per image over all classes (<= 0: no cap)')
+parser.add_argument('--eval_batch_size', default=8, type=int,
+                    help='Number of images per forward pass in test_net')
+parser.add_argument('--eval_workers', default=4, type=int,
+                    help='Number of workers used in test_net dataloading and AP evaluation')
+parser.add_argument('--eval_cache', default=None, type=str,
+                    help='Local directory caching the resized test images between evaluations (off by default)')
+parser.add_argument('--eval_cache_size', default=16, type=int,
+                    help='Size limit of the eval_cache directory in GB')
+# datasets packed by pack_shards.py, used instead of the VOC/XL dataset_root
+parser.add_argument('--train_shards', default=None, type=str,
+                    help='Directory of the packed training dataset')
+parser.add_argument('--val_shards', default=None, type=str,
+                    help='Directory of the packed validation dataset')
 # for WEISHI dataset
 parser.add_argument('--jpg_xml_path', default='', #'/cephfs/share/data/weishi_xh/train_58_0713.txt'
                     help='Image XML mapping path')
@@ -102,6 +141,9 @@ parser.set_defaults(use_m2=False)
 
 args = parser.parse_args()
 
+# resized test images kept between the evaluations, see EvalImageCache
+eval_cache = EvalImageCache(args.eval_cache, args.eval_cache_size << 30) if args.eval_cache else None
+
 
 if torch.cuda.is_available():
     if args.cuda:
@@ -158,6 +200,17 @@ elif args.dataset == 'COCO':
                             transform=SSDAugmentation(cfg['min_dim'], cfg['dataset_mean']))
     val_dataset = COCODetection(root=coco_val_dataset_root, \
                                 transform=BaseTransform(cfg['min_dim'], cfg['testset_mean'])) # 300 originally
+if args.train_shards is not None:
+    dataset = ShardDetection(args.train_shards,
+                             transform=SSDAugmentation(cfg['min_dim'], cfg['dataset_mean']))
+if args.val_shards is not None:
+    val_dataset = ShardDetection(args.val_shards,
+                                 transform=BaseTransform(cfg['min_dim'], cfg['testset_mean']))
+# batched augmentation on the training device instead of SSDAugmentation in the workers
+batch_augment = None
+if args.gpu_augment:
+    dataset.transform = None
+    batch_augment = BatchSSDAugmentation(cfg['min_dim'], cfg['dataset_mean'])
 
 def train():
     # network set-up
@@ -169,13 +222,21 @@ def train():
         ssd_net = build_mssd('train', cfg, cfg['min_dim'], cfg['num_classes'], base='m2', max_per_image = args.max_per_image) # backbone network is m2
     else:
         ssd_net = build_ssd('train', cfg, cfg['min_dim'], cfg['num_classes'], base='vgg', max_per_image = args.max_per_image) # backbone network is vgg
+    ssd_net.detect = Detect(cfg['num_classes'], cfg, args.max_per_image, args.confidence_threshold, 0.45, mode=args.detect_mode,
+                        nms_method=args.nms_method, top_k=args.top_k, keep_top_k=args.keep_top_k)
     net = ssd_net
 
     if args.cuda:
         net = torch.nn.DataParallel(ssd_net)
         cudnn.benchmark = True
 
-    if args.resume:
+    checkpoint = None
+    if args.resume and args.resume.endswith('.ckpt'):
+        # model, optimizer and data order, restored below
+        print('Resuming training, loading {}...'.format(args.resume))
+        checkpoint = torch.load(args.resume, map_location='cpu')
+        ssd_net.load_state_dict(checkpoint['model'])
+    elif args.resume:
         print('Resuming training, loading {}...'.format(args.resume))
         ssd_net.load_weights(args.resume)
     else:
@@ -188,10 +249,16 @@ def train():
 
     if args.cuda:
         net = net.cuda()
+    if args.channels_last:
+        net = net.to(memory_format=torch.channels_last)
 
     # training set-up
     optimizer = optim.SGD(net.parameters(), lr=args.lr, momentum=args.momentum,
                           weight_decay=args.weight_decay)
+    # mixed precision: the loss scaling is only needed by float16 (cuda), bfloat16 has the float32 range
+    amp_device = 'cuda' if args.cuda else 'cpu'
+    amp_dtype = torch.float16 if args.cuda else torch.bfloat16
+    scaler = torch.amp.GradScaler(amp_device, enabled=args.amp and args.cuda)
     criterion = MultiBoxLoss(cfg['num_classes'], 0.5, True, 0, True, 3, 0.5, False, args.cuda)
 
     net.train()
@@ -199,6 +266,30 @@ def train():
     loc_loss = 0
     conf_loss = 0
     epoch = 0
+    step_index = 0
+    start_iter = args.start_iter
+    # shuffling which can restart in the middle of an epoch
+    sampler = ResumableRandomSampler(dataset, seed=args.seed if args.seed is not None
+                                     else int(torch.randint(1 << 31, (1,), device='cpu')))
+    if checkpoint is not None:
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        sampler.load_state_dict(checkpoint['sampler'])
+        if checkpoint.get('scaler'): # empty when saved without --amp
+            scaler.load_state_dict(checkpoint['scaler'])
+        start_iter = checkpoint['iteration']
+        epoch, step_index = checkpoint['epoch'], checkpoint['step_index']
+        loc_loss, conf_loss = checkpoint['loc_loss'], checkpoint['conf_loss']
+        checkpoint = None
+    # checkpoints copied to cpu memory, then written by a background thread
+    checkpointer = AsyncCheckpointer(keep=args.keep_checkpoints)
+    if args.use_res:
+        prefix = 'ssd300_resnet_'
+    elif args.use_m1:
+        prefix = 'ssd300_mobilev1_'
+    elif args.use_m2:
+        prefix = 'ssd300_mobilev2_'
+    else:
+        prefix = 'ssd300_vgg_'
     print('Loading the dataset...')
 
     epoch_size = len(dataset) // args.batch_size
@@ -218,21 +309,31 @@ def train():
     stepvalues_VOC = (150 * epoch_size, 200 * epoch_size, 250 * epoch_size)
     stepvalues_COCO = (90 * epoch_size, 120 * epoch_size, 140 * epoch_size)
     stepvalues = (stepvalues_VOC,stepvalues_COCO)[args.dataset=='COCO']
-    step_index = 0
 
     # training data loader
     data_loader = data.DataLoader(dataset, args.batch_size,
                                   num_workers=args.num_workers,
-                                  shuffle=True, collate_fn=detection_collate,
+                                  sampler=sampler, collate_fn=raw_collate if args.gpu_augment else padded_collate,
                                   pin_memory=True,generator=torch.Generator(device='cuda'),)
     # create batch iterator
     batch_iterator = iter(data_loader)
-    for iteration in range(args.start_iter, cfg['max_epoch']*epoch_size + 10):
+    consumed = 0 # samples of the current pass over the dataset, for the checkpoints
+    for iteration in range(start_iter, cfg['max_epoch']*epoch_size + 10):
         try:
-            images, targets = next(batch_iterator)
+            batch = next(batch_iterator)
         except StopIteration:
             batch_iterator = iter(data_loader)# the dataloader cannot re-initilize
-            images, targets = next(batch_iterator)
+            batch = next(batch_iterator)
+            consumed = 0
+        consumed += batch[0].size(0)
+        if batch_augment is not None:
+            images, sizes, targets = batch
+            if args.cuda:
+                images = images.cuda(non_blocking=True)
+            images, targets = batch_augment(images, sizes, targets)
+        else:
+            images, targets, num_objs = batch
+            targets = (targets, num_objs)
 
         if args.visdom and iteration != 0 and (iteration % epoch_size == 0):
             update_vis_plot(epoch, loc_loss, conf_loss, epoch_plot, None,
@@ -249,7 +350,9 @@ def train():
                 net.eval()
                 APs,mAP = test_net(args.eval_folder, net, args.cuda, val_dataset,
                          BaseTransform(net.module.size, cfg['testset_mean']),
-                         args.max_per_image, thresh=args.confidence_threshold) # 300 is for cfg['min_dim'] originally
+                         args.max_per_image, thresh=args.confidence_threshold, # 300 is for cfg['min_dim'] originally
+                         batch_size=args.eval_batch_size, num_workers=args.eval_workers,
+                         cache=eval_cache)
                 net.train()
             epoch += 1
 
@@ -259,20 +362,22 @@ def train():
         lr = adjust_learning_rate(optimizer, args.gamma, epoch, step_index, iteration, epoch_size)
 
         if args.cuda:
-            images = Variable(images.cuda())
-            targets = [Variable(ann.cuda(), volatile=True) for ann in targets]
-        else:
-            images = Variable(images)
-            targets = [Variable(ann, volatile=True) for ann in targets]
+            # pinned batch: one non blocking copy of the images and of the padded targets
+            images = images.cuda(non_blocking=True)
+            targets = tuple(t.cuda(non_blocking=True) for t in targets)
+        if args.channels_last:
+            images = images.contiguous(memory_format=torch.channels_last)
         # forward
         t0 = time.time()
-        out = net(images)
-        # backprop
-        optimizer.zero_grad()
-        loss_l, loss_c = criterion(out, targets)
+        with torch.autocast(amp_device, dtype=amp_dtype, enabled=args.amp):
+            out = net(images)
+            # backprop
+            optimizer.zero_grad()
+            loss_l, loss_c = criterion(out, targets) # computed in float32
         loss = loss_l + loss_c
-        loss.backward()
-        optimizer.step()
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
         t1 = time.time()
         loc_loss += loss_l.item()
         conf_loss += loss_c.item()
@@ -287,24 +392,21 @@ def train():
             update_vis_plot(iteration, loss_l.item(), loss_c.item(),
                             iter_plot, epoch_plot, 'append')
 
-        if iteration != 0 and iteration % 3000 == 0:
+        if iteration != 0 and iteration % args.checkpoint_interval == 0:
             print('Saving state, iter:', iteration)
-            if args.use_res:
-                print('Save resnet-ssd.')
-                torch.save(ssd_net.state_dict(), 'weights/ssd300_resnet_' + # for resnet
-                           repr(iteration) + '.pth')
-            elif args.use_m1:
-                torch.save(ssd_net.state_dict(), 'weights/ssd300_mobilev1_' +
-                           repr(iteration) + '.pth')
-            elif args.use_m2:
-                torch.save(ssd_net.state_dict(), 'weights/ssd300_mobilev2_' +
-                           repr(iteration) + '.pth')
-            else:
-                torch.save(ssd_net.state_dict(), 'weights/ssd300_vgg_' +
-                           repr(iteration) + '.pth')
-
-    torch.save(ssd_net.state_dict(),
-               args.save_folder + '' + args.dataset + '.pth')
+            # the training only waits for the copy to cpu memory (and for the previous write)
+            state = checkpointer.snapshot({
+                'model': ssd_net.state_dict(), 'optimizer': optimizer.state_dict(),
+                'scaler': scaler.state_dict(),
+                'sampler': sampler.state_dict(consumed), 'iteration': iteration + 1,
+                'epoch': epoch, 'step_index': step_index,
+                'loc_loss': loc_loss, 'conf_loss': conf_loss})
+            checkpointer.write([('weights/' + prefix + repr(iteration) + '.pth', state['model'], None),
+                                (args.save_folder + prefix + repr(iteration) + '.ckpt', state,
+                                 args.save_folder + prefix + '*.ckpt')])
+
+    checkpointer.save(args.save_folder + '' + args.dataset + '.pth', ssd_net.state_dict())
+    checkpointer.wait()
 
 def adjust_learning_rate(optimizer, gamma, epoch, step_index, iteration, epoch_size):
     """Sets the learning rate
@@ -367,59 +469,22 @@ def update_vis_plot(iteration, loc, conf, window1, window2, update_type,
         max_per_image/top_k：The Maximum number of box preds to consider
 """
 def test_net(save_folder, net, cuda,
-             testset, transform, max_per_image=200, thresh=0.05):
+             testset, transform, max_per_image=200, thresh=0.05,
+             batch_size=8, num_workers=4, cache=None):
 
     if not os.path.exists(save_folder):
         os.mkdir(save_folder)
 
-    num_images = len(testset)
     num_classes = cfg['num_classes']
-    # all detections are collected into:
-    #    all_boxes[cls][image] = N x 5 array of detections in
-    #    (x1, y1, x2, y2, score)
-    all_boxes = [[[] for _ in range(num_images)]
-                 for _ in range(num_classes)]
-
-    # timers
-    _t = {'im_detect': Timer(), 'misc': Timer()}
     #output_dir = get_output_dir('ssd300_120000', set_type) #directory storing output results
     #det_file = os.path.join(output_dir, 'detections.pkl') #file storing output result under output_dir
     det_file = os.path.join(save_folder, 'detections.pkl')
 
-    for i in range(num_images):
-        im, gt, h, w = testset.pull_item(i) # include BaseTransform inside
-
-        x = Variable(im.unsqueeze(0)) #insert a dimension of size one at the dim 0
-        if cuda:
-            x = x.cuda()
-
-        _t['im_detect'].tic()
-        detections = net(x=x, test=True).data # get the detection results
-        detect_time = _t['im_detect'].toc(average=False) #store the detection time
-
-        # skip j = 0, because it's the background class
-        for j in range(1, detections.size(1)): # for every class
-            dets = detections[0, j, :]#size( ** , 5)
-            mask = dets[:, 0].gt(0.).expand(5, dets.size(0)).t()
-            dets = torch.masked_select(dets, mask).view(-1, 5)
-            if dets.dim() == 0:
-                continue
-            #if dets.size(0) == 0:
-            #    continue
-            boxes = dets[:, 1:]
-            boxes[:, 0] *= w
-            boxes[:, 2] *= w
-            boxes[:, 1] *= h
-            boxes[:, 3] *= h
-            scores = dets[:, 0].cpu().numpy()
-            cls_dets = np.hstack((boxes.cpu().numpy(),
-                                  scores[:, np.newaxis])).astype(np.float32,
-                                                                 copy=False)
-            all_boxes[j][i] = cls_dets #[class][imageID] = 1 x 5 where 5 is box_coord + score
-
-        if (i + 1) % 100 == 0:
-            print('im_detect: {:d}/{:d} {:.3f}s'.format(i + 1,
-                                                        num_images, detect_time)) # nms time is included in detect_time for normal SSD
+    # all detections are collected into:
+    #    all_boxes[cls][image] = N x 5 array of detections in
+    #    (x1, y1, x2, y2, score)
+    all_boxes = detect_all(detections(net), testset, num_classes, cuda,
+                           batch_size=batch_size, num_workers=num_workers, cache=cache)
 
     #write the detection results into det_file
     with open(det_file, 'wb') as f:
@@ -427,7 +492,7 @@ def test_net(save_folder, net, cuda,
 
     print('Evaluating detections')
 
-    APs,mAP = testset.evaluate_detections(all_boxes, save_folder)
+    APs,mAP = testset.evaluate_detections(all_boxes, save_folder, num_workers=num_workers)
     return APs,mAP
 
 if __name__ == '__main__':
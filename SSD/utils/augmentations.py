@@ -37,6 +37,26 @@ def jaccard_numpy(box_a, box_b):
     return inter / union  # [A,B]
 
 
+def jaccard_rects(boxes, rects):
+    """Compute the jaccard overlap of every rect with every box, in one broadcast
+    Args:
+        boxes: bounding boxes, Shape: [num_boxes,4]
+        rects: candidate crops, Shape: [num_rects,4]
+    Return:
+        jaccard overlap: Shape: [num_rects, num_boxes]
+    """
+    max_xy = np.minimum(boxes[None, :, 2:], rects[:, None, 2:])
+    min_xy = np.maximum(boxes[None, :, :2], rects[:, None, :2])
+    inter = np.clip((max_xy - min_xy), a_min=0, a_max=np.inf)
+    inter = inter[:, :, 0] * inter[:, :, 1]
+    area_boxes = ((boxes[:, 2]-boxes[:, 0]) *
+                  (boxes[:, 3]-boxes[:, 1]))[None, :]
+    area_rects = ((rects[:, 2]-rects[:, 0]) *
+                  (rects[:, 3]-rects[:, 1]))[:, None]
+    union = area_boxes + area_rects - inter
+    return inter / union
+
+
 class Compose(object):
     """Composes several augmentations together.
     Args:
@@ -220,13 +240,15 @@ class RandomSampleCrop(object):
         boxes (Tensor): the original bounding boxes in pt form
         labels (Tensor): the class labels for each bbox
         mode (float tuple): the min and max jaccard overlaps
+        max_trials (int): candidate crops drawn at once for a mode
+        max_rounds (int): modes tried before giving up and keeping the whole image
     Return:
         (img, boxes, classes)
             img (Image): the cropped image
             boxes (Tensor): the adjusted bounding boxes in pt form (after moving the box left/right/up/down when you crop left/right/up/down)
             labels (Tensor): the class labels for each bbox
     """
-    def __init__(self):
+    def __init__(self, max_trials=50, max_rounds=10):
         self.sample_options = (
             # using entire original input image
             None,
@@ -238,14 +260,40 @@ class RandomSampleCrop(object):
             # randomly sample a patch
             (None, None),
         )
+        self.max_trials = max_trials
+        self.max_rounds = max_rounds
 
     def __call__(self, image, boxes=None, labels=None):
         height, width, _ = image.shape
-        while True:
+        sample = self.sample(height, width, boxes)
+        if sample is None:
+            return image, boxes, labels
+        rect, mask = sample
+
+        # cut the crop from the image
+        current_image = image[rect[1]:rect[3], rect[0]:rect[2], :]
+
+        # take only matching gt boxes
+        current_boxes = crop_boxes(boxes, rect, mask)
+
+        # take only matching gt labels
+        current_labels = labels[mask]
+
+        return current_image, current_boxes, current_labels
+
+    def sample(self, height, width, boxes):
+        """Draw the crop of an image of size (height, width) with boxes
+        Return:
+            None to keep the whole image, otherwise
+            rect (ndarray): the crop x1,y1,x2,y2 in pixels, Shape: [4]
+            mask (ndarray): the boxes whose center is in the crop, Shape: [num_boxes]
+        """
+        # used to be `while True`: images with tiny or many objects could loop for long
+        for _ in range(self.max_rounds):
             # randomly choose a mode
-            mode = random.choice(self.sample_options)
+            mode = self.sample_options[random.randint(len(self.sample_options))]
             if mode is None:
-                return image, boxes, labels
+                return None
 
             min_iou, max_iou = mode
             if min_iou is None:
@@ -253,68 +301,56 @@ class RandomSampleCrop(object):
             if max_iou is None:
                 max_iou = float('inf')
 
-            # max trails (50)
-            for _ in range(50):
-                current_image = image
-
-                w = random.uniform(0.3 * width, width)
-                h = random.uniform(0.3 * height, height)
-
-                # aspect ratio constraint b/t .5 & 2
-                if h / w < 0.5 or h / w > 2:
-                    continue
-
-                left = random.uniform(width - w)
-                top = random.uniform(height - h)
-
-                # convert to integer rect x1,y1,x2,y2
-                rect = np.array([int(left), int(top), int(left+w), int(top+h)])
+            # all the trials at once, the first valid one is kept like the former trial loop did
+            w = random.uniform(0.3 * width, width, self.max_trials)
+            h = random.uniform(0.3 * height, height, self.max_trials)
 
-                # calculate IoU (jaccard overlap) b/t the cropped and gt boxes
-                overlap = jaccard_numpy(boxes, rect)
+            # same as the former random.uniform(width - w): low=width - w, high=1
+            left = random.uniform(width - w, 1.)
+            top = random.uniform(height - h, 1.)
 
-                # is min and max overlap constraint satisfied? if not try again
-                if overlap.min() < min_iou or max_iou < overlap.max():
-                    continue
+            # convert to integer rects x1,y1,x2,y2
+            rects = np.stack((left, top, left + w, top + h), 1).astype(int)
 
-                # cut the crop from the image
-                current_image = current_image[rect[1]:rect[3], rect[0]:rect[2],
-                                              :]
+            # aspect ratio constraint b/t .5 & 2
+            valid = (h / w >= 0.5) & (h / w <= 2)
 
-                # keep overlap with gt box IF center in sampled patch
-                centers = (boxes[:, :2] + boxes[:, 2:]) / 2.0
+            # calculate IoU (jaccard overlap) b/t the cropped and gt boxes
+            overlap = jaccard_rects(boxes, rects)
 
-                # mask in all gt boxes that above and to the left of centers
-                m1 = (rect[0] < centers[:, 0]) * (rect[1] < centers[:, 1])
+            # is min and max overlap constraint satisfied?
+            valid &= (overlap.min(1, initial=np.inf) >= min_iou) & (overlap.max(1, initial=-np.inf) <= max_iou)
 
-                # mask in all gt boxes that under and to the right of centers
-                m2 = (rect[2] > centers[:, 0]) * (rect[3] > centers[:, 1])
+            # keep overlap with gt box IF center in sampled patch
+            centers = (boxes[:, :2] + boxes[:, 2:]) / 2.0
+            # mask in all gt boxes that above and to the left of centers and under and to the right of centers
+            masks = (rects[:, None, 0] < centers[None, :, 0]) & (rects[:, None, 1] < centers[None, :, 1]) & \
+                    (rects[:, None, 2] > centers[None, :, 0]) & (rects[:, None, 3] > centers[None, :, 1])
 
-                # mask in that both m1 and m2 are true
-                mask = m1 * m2
+            # have any valid boxes?
+            valid &= masks.any(1)
+            if valid.any():
+                trial = valid.argmax()
+                return rects[trial], masks[trial]
+        # no valid crop after max_rounds: the whole image
+        return None
 
-                # have any valid boxes? try again if not
-                if not mask.any():
-                    continue
 
-                # take only matching gt boxes
-                current_boxes = boxes[mask, :].copy()
+def crop_boxes(boxes, rect, mask):
+    """The boxes of mask clipped to the crop rect, in the crop coordinates"""
+    current_boxes = boxes[mask, :].copy()
 
-                # take only matching gt labels
-                current_labels = labels[mask]
+    # should we use the box left and top corner or the crop's
+    current_boxes[:, :2] = np.maximum(current_boxes[:, :2],
+                                      rect[:2])
+    # adjust to crop (by substracting crop's left,top)
+    current_boxes[:, :2] -= rect[:2]
 
-                # should we use the box left and top corner or the crop's
-                current_boxes[:, :2] = np.maximum(current_boxes[:, :2],
-                                                  rect[:2])
-                # adjust to crop (by substracting crop's left,top)
-                current_boxes[:, :2] -= rect[:2]
-
-                current_boxes[:, 2:] = np.minimum(current_boxes[:, 2:],
-                                                  rect[2:])
-                # adjust to crop (by substracting crop's left,top)
-                current_boxes[:, 2:] -= rect[:2]
-
-                return current_image, current_boxes, current_labels
+    current_boxes[:, 2:] = np.minimum(current_boxes[:, 2:],
+                                      rect[2:])
+    # adjust to crop (by substracting crop's left,top)
+    current_boxes[:, 2:] -= rect[:2]
+    return current_boxes
 
 
 class Expand(object):
@@ -322,13 +358,11 @@ class Expand(object):
         self.mean = mean
 
     def __call__(self, image, boxes, labels):
-        if random.randint(2):
-            return image, boxes, labels
-
         height, width, depth = image.shape
-        ratio = random.uniform(1, 4)
-        left = random.uniform(0, width*ratio - width)
-        top = random.uniform(0, height*ratio - height)
+        sample = self.sample(height, width)
+        if sample is None:
+            return image, boxes, labels
+        ratio, left, top = sample
 
         expand_image = np.zeros(
             (int(height*ratio), int(width*ratio), depth),
@@ -344,6 +378,19 @@ class Expand(object):
 
         return image, boxes, labels
 
+    @staticmethod
+    def sample(height, width):
+        """Draw the expansion of an image of size (height, width)
+        Return None to keep the image, otherwise (ratio, left, top): the image is put at
+        (int(left), int(top)) of a (int(height*ratio), int(width*ratio)) canvas of mean
+        """
+        if random.randint(2):
+            return None
+        ratio = random.uniform(1, 4)
+        left = random.uniform(0, width*ratio - width)
+        top = random.uniform(0, height*ratio - height)
+        return ratio, left, top
+
 
 class RandomMirror(object):
     def __call__(self, image, boxes, classes):
@@ -382,27 +429,92 @@ class SwapChannels(object):
 
 
 class PhotometricDistort(object):
+    """Random brightness, contrast, saturation, hue and channel swap, fused into as few
+    full-image passes as possible, in a buffer kept by the transform:
+        1) brightness and the contrast applied before the HSV part: one affine op, which also
+           converts the (uint8 or float) input image to float32
+        2) HSV round-trip only if the saturation or the hue is sampled, in place
+        3) contrast applied after the HSV part: in place
+        4) channel swap
+    The random draws are the ones of the former chain RandomBrightness, then RandomContrast,
+    ConvertColor, RandomSaturation, RandomHue, ConvertColor, RandomContrast without one of the
+    contrasts, then RandomLightingNoise, in the same order, so a seed gives the same parameters.
+    The returned image is the buffer, it is overwritten by the next call: copy it to keep it
+    (SSDAugmentation always resizes it into a new image).
+    """
     def __init__(self):
-        self.pd = [
-            RandomContrast(),
-            ConvertColor(transform='HSV'),
-            RandomSaturation(),
-            RandomHue(),
-            ConvertColor(current='HSV', transform='BGR'),
-            RandomContrast()
-        ]
+        self.rand_contrast = RandomContrast()
+        self.rand_saturation = RandomSaturation()
+        self.rand_hue = RandomHue()
         self.rand_brightness = RandomBrightness()
         self.rand_light_noise = RandomLightingNoise()
+        self.buffer = np.empty(0, dtype=np.float32)
 
     def __call__(self, image, boxes, labels):
-        im = image.copy()
-        im, boxes, labels = self.rand_brightness(im, boxes, labels)
+        delta, alpha, hsv, saturation, hue, alpha_last, swap = self.sample()
+
+        # (grown) buffer of the image size
+        if self.buffer.size < image.size:
+            self.buffer = np.empty(image.size, dtype=np.float32)
+        im = self.buffer[:image.size].reshape(image.shape)
+
+        # 1) (image + delta) * alpha
+        cv2.addWeighted(image, alpha, image, 0., delta * alpha, dst=im, dtype=cv2.CV_32F)
+
+        # 2) HSV part
+        if hsv:
+            cv2.cvtColor(im, cv2.COLOR_BGR2HSV, dst=im)
+            if saturation is not None:
+                im[:, :, 1] *= saturation
+            if hue is not None:
+                h = im[:, :, 0]
+                h += hue
+                h[h > 360.0] -= 360.0
+                h[h < 0.0] += 360.0
+            cv2.cvtColor(im, cv2.COLOR_HSV2BGR, dst=im)
+            # 3) contrast after the HSV part
+            if alpha_last is not None:
+                im *= alpha_last
+
+        # 4) shuffle channels
+        if swap is not None:
+            im[...] = im[:, :, swap]
+        return im, boxes, labels
+
+    def sample(self):
+        """Draw the distortion, in the order of the former chain
+        Return:
+            delta, alpha: brightness and contrast of step 1), (image + delta) * alpha
+            hsv: do the HSV part, saturation, hue: None when not sampled
+            alpha_last: contrast after the HSV part, None when not sampled or already in alpha
+            swap: channel permutation, None when not sampled
+        """
+        delta = random.uniform(-self.rand_brightness.delta, self.rand_brightness.delta) \
+            if random.randint(2) else 0.
+        contrast_first = random.randint(2)
+        alpha_first = self.draw(self.rand_contrast.lower, self.rand_contrast.upper) \
+            if contrast_first else None
+        saturation = self.draw(self.rand_saturation.lower, self.rand_saturation.upper)
+        hue = self.draw(-self.rand_hue.delta, self.rand_hue.delta)
+        alpha_last = self.draw(self.rand_contrast.lower, self.rand_contrast.upper) \
+            if not contrast_first else None
+        swap = self.rand_light_noise.perms[random.randint(len(self.rand_light_noise.perms))] \
+            if random.randint(2) else None
+        hsv = saturation is not None or hue is not None
+
+        # the contrast after the HSV part joins step 1) when there is no HSV part
+        alpha = alpha_first if hsv else (alpha_first if contrast_first else alpha_last)
+        alpha = 1. if alpha is None else alpha
+        if not hsv:
+            alpha_last = None
+        return delta, alpha, hsv, saturation, hue, alpha_last, swap
+
+    @staticmethod
+    def draw(lower, upper):
+        """random.randint(2) then, if 1, random.uniform(lower, upper), like the Random* transforms"""
         if random.randint(2):
-            distort = Compose(self.pd[:-1])
-        else:
-            distort = Compose(self.pd[1:])
-        im, boxes, labels = distort(im, boxes, labels)
-        return self.rand_light_noise(im, boxes, labels)
+            return random.uniform(lower, upper)
+        return None
 
 #final one - integrate all above
 class SSDAugmentation(object):
@@ -411,8 +523,7 @@ class SSDAugmentation(object):
         self.mean = mean
         self.size = size
         self.augment = Compose([
-            ConvertFromInts(),
-            ToAbsoluteCoords(),
+            ToAbsoluteCoords(), # PhotometricDistort() converts the image to float32
             PhotometricDistort(),
             Expand(self.mean),
             RandomSampleCrop(),
@@ -0,0 +1,205 @@
+'''
+    Batched SSDAugmentation on the training device
+
+    The DataLoader workers only decode the images (dataset transform=None) and raw_collate()
+    pads them into one uint8 batch. BatchSSDAugmentation then draws the augmentation of every
+    image on the cpu with the samplers of SSDAugmentation (same numpy.random draws, in the same
+    order, and the boxes are transformed by the same numpy code), and applies all of them to
+    the pixels of the whole batch with torch ops, on any device:
+        1) photometric distortion: one affine op, HSV round-trip of the images which need it,
+           channel swap
+        2) mean subtraction, the padding becomes 0 i.e. the mean like the Expand canvas
+        3) expand + crop + mirror + resize: one affine sampling grid per image, one grid_sample
+           per interpolation method
+'''
+import numpy as np
+import torch
+import torch.nn.functional as F
+from numpy import random
+
+from utils.augmentations import PhotometricDistort, Expand, RandomSampleCrop, crop_boxes
+from layers.box_utils import pad_targets
+
+FLT_EPSILON = float(np.finfo(np.float32).eps)
+
+# cv2 interpolation of Resize (random.randint(5)) -> grid_sample mode, INTER_AREA and
+# INTER_LANCZOS4 have no grid_sample counterpart
+INTERP_MODES = ['bilinear', 'bicubic', 'bilinear', 'nearest', 'bicubic']
+
+
+def raw_collate(batch):
+    """Collate fn for datasets without transform (decoded bgr images of different sizes)
+
+    Return:
+        A tuple containing:
+            1) (tensor) uint8 images padded with 0 at the bottom right, Shape: [batch,3,H,W]
+            2) (tensor) (h, w) of each image, Shape: [batch,2]
+            3) (list of tensors) annotations for a given image are stacked on 0 dim,
+                                 in percent coordinates like detection_collate, but kept in
+                                 float64 so that the crops are drawn like SSDAugmentation
+    """
+    imgs = [sample[0] for sample in batch]
+    height = max(img.size(1) for img in imgs)
+    width = max(img.size(2) for img in imgs)
+    # explicit cpu: the workers must not follow a cuda default tensor type
+    padded = torch.zeros(len(imgs), 3, height, width, dtype=torch.uint8, device='cpu')
+    for i, img in enumerate(imgs):
+        padded[i, :, :img.size(1), :img.size(2)] = img
+    sizes = torch.tensor([[img.size(1), img.size(2)] for img in imgs], dtype=torch.int64, device='cpu')
+    targets = [torch.from_numpy(np.asarray(sample[1], dtype=np.float64).reshape(-1, 5)) for sample in batch]
+    return padded, sizes, targets
+
+
+def bgr_to_hsv(x):
+    """cv2.COLOR_BGR2HSV of float images, Shape: [batch,3,H,W], H in degrees"""
+    b, g, r = x.unbind(1)
+    v, _ = x.max(1)
+    vmin, _ = x.min(1)
+    diff = v - vmin
+    s = diff / (v.abs() + FLT_EPSILON)
+    diff = 60. / (diff + FLT_EPSILON)
+    h = torch.where(v == r, (g - b) * diff,
+                    torch.where(v == g, (b - r) * diff + 120., (r - g) * diff + 240.))
+    h = torch.where(h < 0, h + 360., h)
+    return torch.stack((h, s, v), 1)
+
+
+def hsv_to_bgr(x):
+    """cv2.COLOR_HSV2BGR of float images, Shape: [batch,3,H,W], H in degrees"""
+    h, s, v = x.unbind(1)
+    h = torch.remainder(h * (1. / 60.), 6.)
+    sector = h.floor()
+    h = h - sector
+    sector = sector.long().clamp_(0, 5)
+    tab = torch.stack((v, v * (1. - s), v * (1. - s * h), v * (1. - s * (1. - h))), 1)
+    # b, g, r of each sector in tab
+    sector_data = torch.tensor([[1, 3, 0], [1, 0, 2], [3, 0, 1], [0, 2, 1], [0, 1, 3], [2, 1, 0]],
+                               device=x.device)
+    bgr = tab.gather(1, sector_data[sector].permute(0, 3, 1, 2))
+    # no saturation: gray
+    return torch.where((s == 0).unsqueeze(1), v.unsqueeze(1).expand_as(bgr), bgr)
+
+
+class BatchSSDAugmentation(object):
+    """SSDAugmentation of a batch of raw_collate() on the device of the images
+
+    Arguments:
+        size (int): output size of the images
+        mean (tuple): bgr mean, subtracted and used for the Expand canvas
+    Return (of __call__):
+        images (tensor): augmented rgb images, Shape: [batch,3,size,size]
+        targets (tuple): percent [xmin, ymin, xmax, ymax, label] of the kept boxes, zero padded
+            like data.padded_collate (targets [batch,max_objs,5], num_objs [batch]), on the device
+            of the images
+    """
+    def __init__(self, size=300, mean=(104, 117, 123)):
+        self.size = size
+        self.mean = mean
+        self.photometric = PhotometricDistort()
+        self.crop = RandomSampleCrop()
+
+    def sample(self, height, width, target):
+        """Draw the augmentation of one image like SSDAugmentation does, boxes included
+        Return (photometric params, (sx, bx, sy, by): output pixel -> source pixel,
+        interpolation index, percent boxes and labels [num_kept,5])
+        """
+        boxes = target[:, :4] * np.array([width, height, width, height], dtype=np.float64)
+        labels = target[:, 4]
+        # ToAbsoluteCoords, PhotometricDistort
+        photometric = self.photometric.sample()
+        # Expand
+        expand = Expand.sample(height, width)
+        if expand is None:
+            ex_left, ex_top, canvas_h, canvas_w = 0, 0, height, width
+        else:
+            ratio, left, top = expand
+            ex_left, ex_top = int(left), int(top)
+            canvas_h, canvas_w = int(height*ratio), int(width*ratio)
+            boxes = boxes.copy()
+            boxes[:, :2] += (ex_left, ex_top)
+            boxes[:, 2:] += (ex_left, ex_top)
+        # RandomSampleCrop
+        crop = self.crop.sample(canvas_h, canvas_w, boxes)
+        if crop is None:
+            x1, y1, x2, y2 = 0, 0, canvas_w, canvas_h
+        else:
+            rect, mask = crop
+            boxes, labels = crop_boxes(boxes, rect, mask), labels[mask]
+            # rect past the canvas is clipped by the slicing of the image
+            x1, y1, x2, y2 = rect[0], rect[1], min(rect[2], canvas_w), min(rect[3], canvas_h)
+        crop_w, crop_h = x2 - x1, y2 - y1
+        # RandomMirror
+        mirror = random.randint(2)
+        if mirror:
+            boxes = boxes.copy()
+            boxes[:, 0::2] = crop_w - boxes[:, 2::-2]
+        # ToPercentCoords
+        boxes = boxes / np.array([crop_w, crop_h, crop_w, crop_h], dtype=np.float64)
+        # Resize
+        interp = random.randint(5)
+
+        # output pixel u -> crop pixel (u + 0.5) * crop_w / size - 0.5 like cv2.resize, mirrored,
+        # then canvas pixel + x1 and source pixel - ex_left
+        sx = crop_w / self.size
+        bx = 0.5 * sx - 0.5
+        if mirror:
+            sx, bx = -sx, crop_w - 1 - bx
+        sy = crop_h / self.size
+        by = 0.5 * sy - 0.5
+        affine = (sx, bx + x1 - ex_left, sy, by + y1 - ex_top)
+        return photometric, affine, interp, np.hstack((boxes, labels[:, None]))
+
+    def __call__(self, images, sizes, targets):
+        device = images.device
+        num = images.size(0)
+        pad_h, pad_w = images.shape[2:]
+        samples = [self.sample(int(h), int(w), target.numpy())
+                   for (h, w), target in zip(sizes.tolist(), targets)]
+
+        # 1) photometric distortion, (image + delta) * alpha first
+        delta, alpha, hsv, saturation, hue, alpha_last, swap = zip(*[s[0] for s in samples])
+        alpha = torch.tensor(alpha, dtype=torch.float32, device=device).view(-1, 1, 1, 1)
+        delta = torch.tensor(delta, dtype=torch.float32, device=device).view(-1, 1, 1, 1)
+        x = images.float() * alpha + delta * alpha
+        idx = [i for i in range(num) if hsv[i]]
+        if idx:
+            sub = bgr_to_hsv(x[idx])
+            sub[:, 1] *= torch.tensor([1. if saturation[i] is None else saturation[i] for i in idx],
+                                      dtype=torch.float32, device=device).view(-1, 1, 1)
+            h = sub[:, 0] + torch.tensor([0. if hue[i] is None else hue[i] for i in idx],
+                                         dtype=torch.float32, device=device).view(-1, 1, 1)
+            h = torch.where(h > 360., h - 360., h)
+            sub[:, 0] = torch.where(h < 0., h + 360., h)
+            sub = hsv_to_bgr(sub)
+            sub *= torch.tensor([1. if alpha_last[i] is None else alpha_last[i] for i in idx],
+                                dtype=torch.float32, device=device).view(-1, 1, 1, 1)
+            x[idx] = sub
+        perms = torch.tensor([(0, 1, 2) if p is None else p for p in swap], device=device)
+        x = x.gather(1, perms.view(num, 3, 1, 1).expand_as(x))
+
+        # 2) SubtractMeans, and the padding (out of the image) is the mean of the Expand canvas
+        x -= torch.tensor(self.mean, dtype=torch.float32, device=device).view(1, 3, 1, 1)
+        rows = torch.arange(pad_h, device=device).view(1, -1, 1) < sizes[:, :1].to(device).view(-1, 1, 1)
+        cols = torch.arange(pad_w, device=device).view(1, 1, -1) < sizes[:, 1:].to(device).view(-1, 1, 1)
+        x *= (rows & cols).unsqueeze(1)
+
+        # 3) Expand, RandomSampleCrop, RandomMirror, Resize: source pixel = s * output pixel + b,
+        # as affine_grid normalized coordinates (align_corners=False)
+        theta = torch.zeros(num, 2, 3, dtype=torch.float32, device='cpu')
+        for i, (_, (sx, bx, sy, by), _, _) in enumerate(samples):
+            theta[i, 0, 0] = sx * self.size / pad_w
+            theta[i, 0, 2] = (sx * (self.size - 1) + 2 * bx + 1) / pad_w - 1
+            theta[i, 1, 1] = sy * self.size / pad_h
+            theta[i, 1, 2] = (sy * (self.size - 1) + 2 * by + 1) / pad_h - 1
+        grid = F.affine_grid(theta.to(device), [num, 3, self.size, self.size], align_corners=False)
+        out = x.new_empty(num, 3, self.size, self.size)
+        interps = np.array([s[2] for s in samples])
+        for mode in set(INTERP_MODES[i] for i in interps):
+            idx = torch.tensor([i for i in range(num) if INTERP_MODES[interps[i]] == mode], device=device)
+            out[idx] = F.grid_sample(x[idx], grid[idx], mode=mode, padding_mode='zeros', align_corners=False)
+
+        # to rgb
+        out = out[:, (2, 1, 0)].contiguous()
+        # padded on the cpu, then one copy of the whole batch
+        targets, num_objs = pad_targets([torch.from_numpy(s[3]).float() for s in samples])
+        return out, (targets.to(device, non_blocking=True), num_objs.to(device, non_blocking=True))
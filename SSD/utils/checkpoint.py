@@ -0,0 +1,142 @@
+'''
+    Resumable training state: checkpoints written in the background, and a shuffling sampler
+    which can restart in the middle of a pass over the dataset.
+
+    A checkpoint is a plain dict (see train_test_vrmSSD.py):
+        model, optimizer, sampler (ResumableRandomSampler.state_dict()), iteration (next one to
+        run), epoch, step_index, ...
+    AsyncCheckpointer copies it to cpu memory (the only part the training waits for) and a
+    background thread writes it to a temporary file which is renamed over the checkpoint once
+    it is complete, so an interrupted write never leaves a truncated checkpoint behind.
+'''
+import glob
+import os
+import threading
+import torch
+import torch.utils.data as data
+
+
+class ResumableRandomSampler(data.Sampler):
+    """RandomSampler whose order only depends on (seed, epoch), so that a pass over the
+    dataset can be restarted at any sample from a checkpoint.
+
+    Every iter() is the next pass, a new permutation; a pass restored by load_state_dict()
+    starts at its saved position. The state of the pass in progress is
+    state_dict(consumed), with the number of samples the training consumed in the pass:
+    the DataLoader workers prefetch batches, the sampler alone can't tell.
+
+    Arguments:
+        data_source (Dataset): dataset to sample from
+        seed (int): seed of the permutations
+    """
+    def __init__(self, data_source, seed=0):
+        self.num_samples = len(data_source)
+        self.seed = seed
+        self.epoch = 0 # next pass
+        self.start = 0 # first sample of the next pass
+        self._pass = (0, 0) # (epoch, start) of the pass in progress
+
+    def __iter__(self):
+        generator = torch.Generator(device='cpu')
+        generator.manual_seed(self.seed + self.epoch)
+        # explicit cpu: don't follow a cuda default tensor type
+        order = torch.randperm(self.num_samples, generator=generator, device='cpu')[self.start:]
+        self._pass = (self.epoch, self.start)
+        self.epoch += 1
+        self.start = 0
+        return iter(order.tolist())
+
+    def __len__(self):
+        return self.num_samples - self.start
+
+    def state_dict(self, consumed=0):
+        """State restarting the pass in progress after its first consumed samples"""
+        epoch, start = self._pass
+        return {'seed': self.seed, 'epoch': epoch, 'start': start + consumed}
+
+    def load_state_dict(self, state):
+        self.seed = state['seed']
+        self.epoch = state['epoch']
+        self.start = state['start']
+
+
+class AsyncCheckpointer(object):
+    """Write checkpoints from a background thread
+
+    snapshot() copies the tensors of a state (model/optimizer state_dicts, ...) to cpu memory,
+    pinned and reused from one checkpoint to the next, and write() hands the copies to a
+    thread which torch.save()s each file to <path>.tmp, fsyncs it and renames it to <path>.
+    One write is in flight at most: snapshot() first waits for the previous one, so a slow
+    storage delays the next checkpoint instead of piling up copies in memory.
+
+    Arguments:
+        keep (int): number of files kept for each retention pattern of write()
+    """
+    def __init__(self, keep=3):
+        self.keep = keep
+        self._thread = None
+        self._error = None
+        self._buffers = {}
+
+    def snapshot(self, state):
+        """Copy of state with its tensors in cpu memory, valid until the next snapshot()"""
+        self.wait()
+        copies = []
+        snap = self._copy(state, (), copies)
+        if any(t.is_cuda for t in copies):
+            torch.cuda.synchronize()
+        return snap
+
+    def _copy(self, obj, key, copies):
+        if isinstance(obj, torch.Tensor):
+            buf = self._buffers.get(key)
+            if buf is None or buf.shape != obj.shape or buf.dtype != obj.dtype:
+                # explicit cpu: don't follow a cuda default tensor type
+                buf = torch.empty(obj.shape, dtype=obj.dtype, device='cpu',
+                                  pin_memory=obj.is_cuda)
+                self._buffers[key] = buf
+            buf.copy_(obj.detach(), non_blocking=obj.is_cuda)
+            copies.append(obj)
+            return buf
+        if isinstance(obj, dict):
+            return type(obj)((k, self._copy(v, key + (k,), copies)) for k, v in obj.items())
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._copy(v, key + (i,), copies) for i, v in enumerate(obj))
+        return obj
+
+    def write(self, files):
+        """Write [(path, snapshot, retention pattern or None), ...] in the background
+
+        Once a file is written, only the newest `keep` files matching its pattern are kept.
+        """
+        self.wait()
+        self._thread = threading.Thread(target=self._write, args=(files,))
+        self._thread.start()
+
+    def save(self, path, state, pattern=None):
+        self.write([(path, self.snapshot(state), pattern)])
+
+    def _write(self, files):
+        try:
+            for path, snap, pattern in files:
+                tmp = path + '.tmp'
+                with open(tmp, 'wb') as f:
+                    torch.save(snap, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, path)
+                if pattern is not None:
+                    old = sorted(glob.glob(pattern), key=os.path.getmtime)[:-self.keep]
+                    for p in old:
+                        os.remove(p)
+        except Exception as e: # raised in the training thread by the next wait()
+            self._error = e
+
+    def wait(self):
+        """Wait for the write in flight, and raise its error if it failed"""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
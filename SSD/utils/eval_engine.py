@@ -0,0 +1,248 @@
+'''
+    Shared evaluation engine for the test_net of train_test_vrmSSD.py, eval_voc_vrmSSD.py,
+    finetune_vggresSSD.py and prune_weights_vggSSD.py
+
+    Images are read by DataLoader workers (pull_item, BaseTransform included), several of them
+    go through the network at once, and the next batch is copied to the GPU on a side stream
+    while the current one is computed. The result is the all_boxes[cls][image] structure that
+    evaluate_detections() expects.
+
+    Optionally (EvalImageCache), the resized images are kept on local disk so that the next
+    evaluations of the same testset skip the JPEG decode and the resize.
+'''
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+import torch
+import torch.utils.data as data
+
+from data import Timer, BaseTransform
+
+
+class EvalImageCache(object):
+    """Disk cache of the resized images of the testsets evaluated with BaseTransform
+
+    Each (dataset name, image set, image ids, size) gets an entry in cache_dir: a memory-mapped
+    uint8 array of the resized BGR images [num_images,size,size,3] (the mean is subtracted when
+    reading, exactly like BaseTransform does, so any mean shares the entry) and the original
+    (h, w) of every image. The entry is filled by the first evaluation and then read by the
+    next ones. The least recently used entries are removed to keep cache_dir under max_bytes.
+    Changing the image files themselves is not detected: clear cache_dir then.
+    """
+    def __init__(self, cache_dir, max_bytes=16 << 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def open(self, testset):
+        """Return the CachedImages of testset, None if it can't be cached"""
+        transform = getattr(testset, 'transform', None)
+        if not isinstance(transform, BaseTransform):
+            return None
+        ids = hashlib.sha1(repr(list(testset.ids)).encode()).hexdigest()
+        key = {'dataset': testset.name, 'image_set': repr(getattr(testset, 'image_set', None)),
+               'ids': ids, 'size': transform.size}
+        path = os.path.join(self.cache_dir, hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest())
+        num_images = len(testset)
+        if not os.path.isdir(path):
+            nbytes = num_images * transform.size * transform.size * 3
+            if not self.evict(nbytes):
+                print('The eval image cache can\'t hold {:.1f}GB, not caching'.format(nbytes / 2**30))
+                return None
+            # create the entry under a temporary name so that other processes never see half of it
+            tmp = tempfile.mkdtemp(dir=self.cache_dir)
+            np.lib.format.open_memmap(os.path.join(tmp, 'images.npy'), mode='w+', dtype=np.uint8,
+                                      shape=(num_images, transform.size, transform.size, 3))
+            np.save(os.path.join(tmp, 'sizes.npy'), np.zeros((num_images, 2), dtype=np.int32))
+            np.save(os.path.join(tmp, 'done.npy'), np.zeros(num_images, dtype=bool))
+            with open(os.path.join(tmp, 'key.json'), 'w') as f:
+                json.dump(key, f)
+            try:
+                os.rename(tmp, path)
+            except OSError: # created by another process meanwhile
+                shutil.rmtree(tmp)
+        os.utime(os.path.join(path, 'key.json')) # most recently used
+        return CachedImages(path, transform.mean)
+
+    def evict(self, nbytes):
+        """Remove the least recently used entries until nbytes more fit in the cache,
+        return False if they can't fit at all"""
+        if nbytes > self.max_bytes:
+            return False
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            key = os.path.join(self.cache_dir, name, 'key.json')
+            if os.path.exists(key):
+                size = sum(os.path.getsize(os.path.join(self.cache_dir, name, f))
+                           for f in os.listdir(os.path.join(self.cache_dir, name)))
+                entries.append((os.path.getmtime(key), size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total + nbytes <= self.max_bytes:
+                break
+            print('Removing {:s} from the eval image cache'.format(name))
+            shutil.rmtree(os.path.join(self.cache_dir, name), ignore_errors=True)
+            total -= size
+        return True
+
+
+class CachedImages(object):
+    """One entry of EvalImageCache, the arrays are memory-mapped on first use in each DataLoader worker"""
+    def __init__(self, path, mean):
+        self.path = path
+        self.mean = np.array(mean, dtype=np.float32)
+        self.arrays = None
+
+    def __getstate__(self):
+        # don't pickle the mapped arrays to the DataLoader workers
+        state = self.__dict__.copy()
+        state['arrays'] = None
+        return state
+
+    def map(self):
+        if self.arrays is None:
+            self.arrays = {k: np.load(os.path.join(self.path, k + '.npy'), mmap_mode='r+')
+                           for k in ['images', 'sizes', 'done']}
+        return self.arrays
+
+    def get(self, index):
+        """(im, h, w) like EvalDataset, None if the image isn't cached yet"""
+        arrays = self.map()
+        if not arrays['done'][index]:
+            return None
+        # same float32 subtraction as base_transform(), then to rgb
+        x = arrays['images'][index].astype(np.float32) - self.mean
+        h, w = arrays['sizes'][index]
+        return torch.from_numpy(x[:, :, (2, 1, 0)]).permute(2, 0, 1), int(h), int(w)
+
+    def put(self, index, im, h, w):
+        """Store the output of pull_item(): back to the resized bgr uint8 image"""
+        arrays = self.map()
+        x = im.permute(1, 2, 0).numpy()[:, :, (2, 1, 0)] + self.mean
+        arrays['images'][index] = np.rint(x).astype(np.uint8)
+        arrays['sizes'][index] = (h, w)
+        arrays['done'][index] = True # after the image, a half written image is never read
+
+
+class EvalDataset(data.Dataset):
+    """Wrap a VOCDetection/XLDetection-like testset so that a DataLoader also gets
+    the original (h, w) of every image, the ground truths are not needed for detection.
+    cache: CachedImages of the testset, read instead of pull_item() when it has the image
+    """
+    def __init__(self, testset, cache=None):
+        self.testset = testset
+        self.cache = cache
+
+    def __getitem__(self, index):
+        if self.cache is not None:
+            item = self.cache.get(index)
+            if item is not None:
+                return item
+        im, gt, h, w = self.testset.pull_item(index) # include BaseTransform inside
+        if self.cache is not None:
+            self.cache.put(index, im, h, w)
+        return im, h, w
+
+    def __len__(self):
+        return len(self.testset)
+
+
+def eval_collate(batch):
+    """Collate fn of EvalDataset
+
+    Return:
+        A tuple containing:
+            1) (tensor) batch of images stacked on their 0 dim
+            2) (ndarray) original (h, w) of each image, Shape: [batch, 2]
+    """
+    imgs = torch.stack([sample[0] for sample in batch], 0)
+    sizes = np.array([[sample[1], sample[2]] for sample in batch], dtype=np.float32)
+    return imgs, sizes
+
+
+class CudaPrefetcher(object):
+    """Iterate over a DataLoader, copying the next batch of images to the GPU
+    on a side stream while the current one is used on the default stream.
+    """
+    def __init__(self, loader, cuda):
+        self.loader = iter(loader)
+        self.cuda = cuda and torch.cuda.is_available()
+        self.stream = torch.cuda.Stream() if self.cuda else None
+        self.preload()
+
+    def preload(self):
+        try:
+            self.next_imgs, self.next_sizes = next(self.loader)
+        except StopIteration:
+            self.next_imgs = None
+            return
+        if self.cuda:
+            with torch.cuda.stream(self.stream):
+                self.next_imgs = self.next_imgs.cuda(non_blocking=True)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.next_imgs is None:
+            raise StopIteration
+        if self.cuda:
+            torch.cuda.current_stream().wait_stream(self.stream)
+            self.next_imgs.record_stream(torch.cuda.current_stream())
+        imgs, sizes = self.next_imgs, self.next_sizes
+        self.preload()
+        return imgs, sizes
+
+
+def detect_all(forward, testset, num_classes, cuda, batch_size=8, num_workers=4, cache=None):
+    """Run the detector over the whole testset
+    Args:
+        forward: function mapping a batch of images [batch,3,size,size] to the detections
+            of the test-type ssd net, Shape: [batch,num_classes,max_per_image,5]
+        testset: validation dataset with pull_item(), BaseTransform included
+        num_classes: number of classes, background included
+        cuda: copy the images to the GPU
+        batch_size: number of images per forward pass
+        num_workers: number of DataLoader workers reading the images
+        cache: EvalImageCache keeping the resized images of testset for the next calls, optional
+    Return:
+        all_boxes[cls][image] = N x 5 array of detections in (x1, y1, x2, y2, score)
+    """
+    num_images = len(testset)
+    all_boxes = [[[] for _ in range(num_images)]
+                 for _ in range(num_classes)]
+    cached = cache.open(testset) if cache is not None else None
+    loader = data.DataLoader(EvalDataset(testset, cached), batch_size, shuffle=False,
+                             num_workers=num_workers, collate_fn=eval_collate,
+                             pin_memory=cuda and torch.cuda.is_available())
+    _t = {'im_detect': Timer()}
+
+    i = 0
+    for x, sizes in CudaPrefetcher(loader, cuda):
+        _t['im_detect'].tic()
+        with torch.no_grad():
+            detections = forward(x) # get the detection results
+        # one copy per batch, [batch, num_classes, max_per_image, 5]
+        detections = detections.float().cpu().numpy()
+        detect_time = _t['im_detect'].toc(average=False) #store the detection time
+
+        # scale the boxes back to the original image size: [w, h, w, h]
+        scales = sizes[:, [1, 0, 1, 0]]
+        for b in range(detections.shape[0]):
+            # skip j = 0, because it's the background class
+            for j in range(1, detections.shape[1]): # for every class
+                dets = detections[b, j]
+                dets = dets[dets[:, 0] > 0.]
+                cls_dets = np.hstack((dets[:, 1:] * scales[b],
+                                      dets[:, :1])).astype(np.float32, copy=False)
+                all_boxes[j][i + b] = cls_dets #[class][imageID] = N x 5 where 5 is box_coord + score
+        i += detections.shape[0]
+
+        if i // 100 != (i - detections.shape[0]) // 100:
+            print('im_detect: {:d}/{:d} {:.3f}s'.format(i, num_images, detect_time))
+
+    return all_boxes